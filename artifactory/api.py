@@ -5,19 +5,27 @@ import sys
 
 from requests.auth import HTTPBasicAuth
 
-from artifactory import downloader
+from artifactory import cache, downloader, extraction, ranges, scheduler, staging, stats
 from artifactory.logger import make_logger
+from artifactory.metadata import MetadataCache
+from artifactory.transport import Transport, DEFAULT_POOL_SIZE, DEFAULT_RETRIES, DEFAULT_TIMEOUT
 
 info_file = downloader.info_file
 
 
-def execute_tasks(tasks, cred_str=None):
+def execute_tasks(tasks, cred_str=None, store_path=None, store_size_cap=cache.DEFAULT_SIZE_CAP,
+                  pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT,
+                  range_threshold=ranges.DEFAULT_THRESHOLD, range_segments=ranges.DEFAULT_SEGMENTS,
+                  staged=False, incremental=False, order=scheduler.ORDER_CRITICAL, network_concurrency=None,
+                  extraction_concurrency=scheduler.DEFAULT_EXTRACTION_CONCURRENCY, bandwidth=None,
+                  extraction_writers=extraction.DEFAULT_WRITERS, gzip_decoder=extraction.DECODER_AUTO):
     """
     
     формат task:
         {
             'url': str,
             'info_url': str,
+            'priority': int,
             'destination': {
                 'folder': str,
                 'file': str,
@@ -26,20 +34,92 @@ def execute_tasks(tasks, cred_str=None):
     
     если ключ folder отсутствует, то подставляется abspath('.')
     если ключ info_url отсутствует, то проверки на необходимость загрузки не происходит
+    priority необязателен, таски с большим priority запускаются раньше (order='critical')
+    
+    большие артефакты качаются частями во временный файл, недокачанный файл докачивается при следующем запуске
+
+    если задан store_path, то скачанные файлы складываются в локальное хранилище по чексумме из info_url
+    и повторно по сети не загружаются
     
     :param tasks: 
     :param cred_str: 
+    :param store_path: папка хранилища артефактов, None - не использовать хранилище
+    :param store_size_cap: максимальный размер хранилища в байтах
+    :param pool_size: количество потоков загрузки и размер пула http соединений
+    :param retries: количество повторов запроса при ошибках соединения и 5xx
+    :param timeout: таймаут (connect, read) в секундах для каждого запроса
+    :param range_threshold: артефакты больше этого размера в байтах качаются несколькими range запросами сразу;
+        любой артефакт известного размера после обрыва докачивается, а не качается заново
+    :param range_segments: на сколько параллельных range запросов делится большой артефакт
+    :param staged: распаковывать в новую версию рядом с folder, переключение - через activate_tasks
+    :param incremental: при распаковке архива записывать только изменившиеся файлы (сравнение с манифестом
+        предыдущей распаковки), удаленные из архива файлы удаляются
+    :param order: порядок запуска тасок, см. artifactory.scheduler.order_tasks
+    :param network_concurrency: сколько артефактов одновременно качается, по умолчанию pool_size
+    :param extraction_concurrency: сколько артефактов одновременно распаковывается на диск
+    :param bandwidth: ограничение суммарной скорости загрузки в байтах в секунду, чтобы не мешать работающему сервису
+    :param extraction_writers: сколько потоков пишут на диск файлы одного архива, 1 - как tarfile.extractall
+    :param gzip_decoder: команда распаковки gzip в отдельном процессе, 'auto' - pigz, если он установлен,
+        None - gzip модуль питона
     :return: 
     """
     logger = make_logger()
     auth = HTTPBasicAuth(*cred_str.split(':')) if cred_str else None
+    store = cache.ArtifactStore(store_path, size_cap=store_size_cap) if store_path else None
+
+    # соединений с запасом под range запросы больших артефактов
+    session = Transport(pool_size=pool_size + range_segments, retries=retries, timeout=timeout, bandwidth=bandwidth)
+
+    # метаданные всех артефактов одним заходом, дальше переиспользуются и для проверки, и для dump_info
+    metadata = MetadataCache(auth, session=session)
+    metadata.prefetch(tasks)
+
+    limits = scheduler.Limits(network=network_concurrency or pool_size, extraction=extraction_concurrency)
 
-    results = downloader.execute_download_tasks(tasks, auth)
-    fails = filter(lambda x: isinstance(x[1], Exception), results)
+    download_stats = stats.DownloadStats()
+    results = downloader.iter_download_tasks(
+        tasks, auth, store=store, metadata=metadata, session=session, pool_size=pool_size,
+        order=order, limits=limits, stats=download_stats, range_threshold=range_threshold,
+        range_segments=range_segments, staged=staged, incremental=incremental,
+        extractor=extraction.Extractor(writers=extraction_writers, decoder=gzip_decoder),
+    )
 
-    for url, exception in fails:
-        logger.error('During url {} donwload exception occurs: {}'.format(url, exception))
+    fails = []
+    for url, result in results:
+        # ошибки выводятся сразу, не дожидаясь остальных тасок
+        if isinstance(result, Exception):
+            logger.error('During url {} donwload exception occurs: {}'.format(url, result))
+            fails.append((url, result))
+
+    # сводка одной строкой для деплой-хоста, см. artifactory.stats.parse
+    print(download_stats.dump())
 
     if fails:
         logger.error('Complete with errors, aborting')
         sys.exit(1)
+
+
+def activate_tasks(tasks, retention=staging.DEFAULT_RETENTION):
+    """Атомарно переключает папки назначения на подготовленные через execute_tasks(staged=True) версии
+
+    :param tasks: те же таски, что и для execute_tasks
+    :param retention: сколько последних версий хранить
+    :return:
+    """
+    logger = make_logger()
+
+    for folder in downloader.activate_staged(tasks, retention=retention):
+        logger.info('Activated staged version of {}'.format(folder))
+
+
+def rollback_tasks(tasks):
+    """Возвращает папки назначения на версии, которые были активны до последнего activate_tasks
+
+    Откаченные версии снова становятся подготовленными, следующий activate_tasks переключит на них без загрузки.
+    :param tasks: те же таски, что и для activate_tasks
+    :return:
+    """
+    logger = make_logger()
+
+    for folder in downloader.rollback_activated(tasks):
+        logger.info('Rolled back {} to the previous version'.format(folder))
@@ -0,0 +1,216 @@
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+DEFAULT_SIZE_CAP = 50 * 1024 ** 3
+# eviction frees the store down to this share of its cap, so a full store is not walked on every commit
+EVICT_TO = 0.9
+
+_tmp_dir_name = 'tmp'
+
+
+def checksum_of(info):
+    """Content key of an artifact from the storage api response: (algorithm, hexdigest), sha256 preferred.
+
+    :param info: parsed json from `info_url`
+    :return: tuple or None if artifactory did not report any suitable checksum
+    """
+    checksums = (info or {}).get('checksums') or {}
+    for algorithm in ('sha256', 'sha1'):
+        if checksums.get(algorithm):
+            return algorithm, checksums[algorithm].lower()
+
+
+def file_digest(path, algorithm, chunk_size=1024 * 1024):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst, falls back to copying if src and dst are on different devices"""
+    makedirs(os.path.dirname(dst))
+    remove_if_exists(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def copy_file(src, dst):
+    """Copies src to dst, dst is replaced, not written through, in case it is a hardlink to another file"""
+    makedirs(os.path.dirname(dst))
+    remove_if_exists(dst)
+    shutil.copyfile(src, dst)
+
+
+def make_tmp_dir(folder):
+    """Hidden temporary directory next to `folder`, on the same filesystem, so its content can be renamed into it"""
+    parent = os.path.dirname(os.path.abspath(folder))
+    makedirs(parent)
+    return tempfile.mkdtemp(prefix='.%s-' % os.path.basename(folder), suffix='.download', dir=parent)
+
+
+def move_tree(src, dst):
+    """Moves content of `src` into `dst` entry by entry: existing files are replaced, directories are merged"""
+    makedirs(dst)
+    for name in os.listdir(src):
+        src_path = os.path.join(src, name)
+        dst_path = os.path.join(dst, name)
+        src_is_dir = os.path.isdir(src_path) and not os.path.islink(src_path)
+        dst_is_dir = os.path.isdir(dst_path) and not os.path.islink(dst_path)
+        if src_is_dir and dst_is_dir:
+            move_tree(src_path, dst_path)
+            shutil.copystat(src_path, dst_path)
+            continue
+
+        if dst_is_dir:
+            shutil.rmtree(dst_path)
+        elif src_is_dir:
+            remove_if_exists(dst_path)
+        os.rename(src_path, dst_path)
+
+
+class ArtifactStore(object):
+    """Content-addressed store of downloaded artifacts, keyed by artifactory checksum.
+
+    Blobs live in `root/<algorithm>/<xx>/<hexdigest>`. Total size is kept under `size_cap`,
+    least recently used blobs are evicted first (mtime is bumped on every hit, so blobs are never hardlinked
+    into destinations). The store is shared between workers and between deploys, so identical tarballs are
+    downloaded once, at the cost of keeping them on disk next to their extracted copies.
+    """
+
+    def __init__(self, root, size_cap=DEFAULT_SIZE_CAP):
+        self.root = root
+        self.size_cap = size_cap
+        self._lock = threading.Lock()
+        # running total of the store size, None until the store is walked
+        self._size = None
+
+    def path(self, key):
+        algorithm, digest = key
+        return os.path.join(self.root, algorithm, digest[:2], digest)
+
+    def get(self, key):
+        """Path to the blob or None if there is no such blob in the store"""
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+
+        return path
+
+    def partial_path(self, key):
+        """Stable location of an unfinished download, so it can be resumed by the next run"""
+        makedirs(os.path.join(self.root, _tmp_dir_name))
+        return os.path.join(self.root, _tmp_dir_name, '%s-%s.part' % key)
+
+    def writer(self, key):
+        return BlobWriter(self, key)
+
+    def commit(self, key, tmp_path):
+        path = self.path(key)
+        makedirs(os.path.dirname(path))
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, path)
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+        self.evict()
+
+        return path
+
+    def evict(self):
+        """Removes least recently used blobs while the store is over `size_cap`, down to EVICT_TO of it.
+
+        The store is walked only on first use and when the running total gets over the cap. Other processes
+        commit to the same store, the walk brings the total up to date.
+        """
+        with self._lock:
+            if self._size is not None and self._size <= self.size_cap:
+                return
+
+            blobs = self._blobs()
+            total = sum(size for _, size, _ in blobs)
+            target = self.size_cap if total <= self.size_cap else self.size_cap * EVICT_TO
+            for _, size, path in sorted(blobs):
+                if total <= target:
+                    break
+                remove_if_exists(path)
+                total -= size
+            self._size = total
+
+    def _blobs(self):
+        """(mtime, size, path) of every blob in the store"""
+        blobs = []
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            if dir_path == self.root and _tmp_dir_name in dir_names:
+                dir_names.remove(_tmp_dir_name)
+
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, path))
+
+        return blobs
+
+
+class BlobWriter(object):
+    """File-like sink for a blob being downloaded. Checksum is verified before the blob gets into the store"""
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self._hash = hashlib.new(key[0])
+
+        tmp_dir = os.path.join(store.root, _tmp_dir_name)
+        makedirs(tmp_dir)
+        fd, self.tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def commit(self):
+        self._file.close()
+        digest = self._hash.hexdigest()
+        if digest != self.key[1]:
+            raise ValueError('%s checksum mismatch: expected %s, got %s' % (self.key[0], self.key[1], digest))
+
+        path = self.store.commit(self.key, self.tmp_path)
+        self.tmp_path = None
+
+        return path
+
+    def discard(self):
+        self._file.close()
+        if self.tmp_path:
+            remove_if_exists(self.tmp_path)
+            self.tmp_path = None
@@ -1,25 +1,32 @@
+import hashlib
 import json
 import multiprocessing.dummy
 import os
-import tarfile
-from StringIO import StringIO
+import shutil
+import time
+from contextlib import closing
 
 import requests
 
+from artifactory import cache, extraction, manifest, ranges, scheduler, staging
+from artifactory.metadata import MetadataCache, is_not_newer
+from artifactory.transport import Transport, DEFAULT_POOL_SIZE
 from artifactory.logger import make_logger
 
 info_file = 'artifactory_info.json'
 
+# size of a single read from the socket and of a single write to the disk
+CHUNK_SIZE = 1024 * 1024
 
-def no_need_to_reload(folder, info_url, auth):
+
+def no_need_to_reload(folder, info):
     try:
         with open(os.path.join(folder, info_file)) as f:
             old_info = json.load(f)
     except (IOError, OSError):
         return
 
-    info = requests.get(info_url, auth=auth).json()
-    return info['lastUpdated'] <= old_info['lastUpdated']
+    return is_not_newer(info, old_info)
 
 
 def dump_info(info, folder):
@@ -30,14 +37,69 @@ def dump_info(info, folder):
         json.dump(obj=info, fp=f)
 
 
-def put_file(resp, folder, file=None):
+def is_tar_gz(url):
+    return '/' in url and '.tar.gz' in url.rsplit('/')[-1]
+
+
+class TeeReader(object):
+    """File-like wrapper, copies everything read from `fileobj` into `sink`"""
+
+    def __init__(self, fileobj, sink):
+        self.fileobj = fileobj
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self.sink.write(data)
+        return data
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def extract(tar, folder, previous=None, writers=1):
+    """
+    :param tar: tarfile opened in stream mode
+    :param folder:
+    :param previous: folder with the previous version of the artifact, if given only changed files are written,
+        see artifactory.manifest.sync
+    :param writers: threads writing files of the archive, see artifactory.extraction.extract_parallel
+    """
+    if previous is None:
+        if writers > 1:
+            extraction.extract_parallel(tar, folder, writers=writers)
+        else:
+            tar.extractall(folder)
+    else:
+        written, kept, removed = manifest.sync(tar, folder, previous)
+        make_logger('artifactory-cli-downloader').info(
+            'Incremental extraction into %s: %d written, %d unchanged, %d removed' % (folder, written, kept, removed)
+        )
+
+
+def put_file(resp, folder, file=None, sink=None, previous=None, extractor=None):
+    """Writes streamed response to the disk chunk by chunk.
+
+    Archive is unpacked in tarfile stream mode directly from the socket, so peak memory does not depend
+    on artifact size and decompression goes along with the download.
+    If `sink` is given, raw payload is copied into it as well.
+
+    :param extractor: artifactory.extraction.Extractor, gzip decoder and writer threads of archives
+    """
     url = resp.url
+    resp.raw.decode_content = True
+    extractor = extractor or extraction.Extractor()
 
-    if '/' in url and '.tar.gz' in url.rsplit('/')[-1]:
+    if is_tar_gz(url):
         # tar archive
-        tar = tarfile.open(fileobj=StringIO(resp.content), mode="r:gz")
-        tar.extractall(folder)
-        tar.close()
+        fileobj = TeeReader(resp.raw, sink) if sink else resp.raw
+        with extractor.open(fileobj=fileobj) as tar:
+            extract(tar, folder, previous=previous, writers=extractor.writers)
+        if sink:
+            # tar end-of-archive padding is not consumed by tarfile but it is a part of the blob
+            fileobj.drain()
     else:
         assert file is not None
         try:
@@ -49,16 +111,160 @@ def put_file(resp, folder, file=None):
             else:
                 raise
         path = os.path.join(folder, file)
+        # file may be a hardlink to the store blob, it must not be overwritten in place
+        cache.remove_if_exists(path)
         with open(path, 'wb') as f:
-            resp.raw.decode_content = True
-            f.write(resp.content)
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                if sink:
+                    sink.write(chunk)
+
+
+def put_blob(blob_path, url, folder, file=None, previous=None, extractor=None):
+    """Same as `put_file`, but the payload is taken from the local store"""
+    if is_tar_gz(url):
+        extractor = extractor or extraction.Extractor()
+        with extractor.open(path=blob_path) as tar:
+            extract(tar, folder, previous=previous, writers=extractor.writers)
+    else:
+        assert file is not None
+        # a hardlink would share mtime, which is the LRU clock of the store, with the destination file
+        cache.copy_file(blob_path, os.path.join(folder, file))
+
+
+def partial_path(url, folder, key, store=None):
+    if store and key:
+        return store.partial_path(key)
+
+    # next to the destination folder, not inside it; without a checksum the partial file is named after the url
+    key = key or ('url', hashlib.sha1(url).hexdigest())
+    return os.path.join(os.path.dirname(os.path.abspath(folder)), '.%s-%s.part' % key)
+
+
+def download_ranged(url, destination, size, key=None, auth=None, store=None, session=requests,
+                    segments=ranges.DEFAULT_SEGMENTS, previous=None, limits=None, extractor=None):
+    """Artifacts are fetched into a resumable partial file by one or several range requests and then put in place
+
+    The partial file is checked against `key` checksum, without it - only that it is complete: all `size` bytes
+    are downloaded and, if resumed, the artifact has the same ETag as when the download was started.
+    """
+    limits = limits or scheduler.Limits()
+    path = partial_path(url, destination.get('folder', os.path.abspath('.')), key, store=store)
+    ranged = ranges.RangedDownload(session, url, path, size, auth=auth, segments=segments)
+    with limits.network:
+        try:
+            ranged.run()
+        except ranges.RangeNotSupported:
+            # the single stream fallback does not resume from the partial file, it must not be left behind
+            ranged.discard()
+            raise
+
+    if key:
+        digest = cache.file_digest(path, key[0])
+        if digest != key[1]:
+            ranged.discard()
+            raise ValueError('%s checksum mismatch: expected %s, got %s' % (key[0], key[1], digest))
+
+    with limits.extraction:
+        put_blob(path, url, previous=previous, extractor=extractor, **destination)
+    if store and key:
+        store.commit(key, path)
+    else:
+        ranged.discard()
+
+
+def download(url, destination, auth=None, store=None, key=None, session=requests, size=None,
+             range_threshold=ranges.DEFAULT_THRESHOLD, range_segments=ranges.DEFAULT_SEGMENTS, previous=None,
+             limits=None, extractor=None):
+    """Downloads the artifact and puts it into `destination`
+
+    If its size is known, it is downloaded through a resumable partial file (see `download_ranged`): a dropped
+    connection, in this run or in the previous one, costs only the bytes not downloaded yet. Artifacts of at least
+    `range_threshold` bytes are fetched by `range_segments` concurrent range requests, smaller ones by one.
+    Without the size, or if the server does not support ranges, the payload is extracted right from the stream.
+    """
+    limits = limits or scheduler.Limits()
+    if size:
+        try:
+            return download_ranged(
+                url, destination, size, key, auth=auth, store=store, session=session,
+                segments=range_segments if range_threshold and size >= range_threshold else 1,
+                previous=previous, limits=limits, extractor=extractor,
+            )
+        except ranges.RangeNotSupported as e:
+            make_logger('artifactory-cli-downloader').warning('%s, fall back to a single stream' % e)
 
+    writer = store.writer(key) if store and key else None
+    if writer is None:
+        # streamed payload is extracted while it is downloaded, so both slots are taken
+        with limits.network, limits.extraction:
+            with closing(session.get(url, auth=auth, stream=True)) as resp:
+                resp.raise_for_status()
+                put_file(resp, previous=previous, extractor=extractor, **destination)
+        return
+
+    # payload is extracted into a temporary folder and moved into place only after its checksum is verified,
+    # so a corrupted download never gets into the destination
+    folder = os.path.abspath(destination.get('folder', '.'))
+    tmp_folder = cache.make_tmp_dir(folder)
+    try:
+        with limits.network, limits.extraction:
+            with closing(session.get(url, auth=auth, stream=True)) as resp:
+                resp.raise_for_status()
+                put_file(
+                    resp, sink=writer, previous=previous, extractor=extractor, **dict(destination, folder=tmp_folder)
+                )
+
+        writer.commit()
+        move_into_place(tmp_folder, folder, previous=previous)
+    finally:
+        writer.discard()
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def move_into_place(tmp_folder, folder, previous=None):
+    """Moves extracted payload from `tmp_folder` into `folder`, see `download`"""
+    old_manifest = None
+    if previous is not None and os.path.abspath(previous) == folder:
+        # in place incremental extraction: files removed from the archive are deleted from `folder`
+        old_manifest = manifest.load(folder)
+
+    cache.move_tree(tmp_folder, folder)
+    if old_manifest is not None:
+        manifest.remove_missing(folder, old_manifest, manifest.load(folder))
+
+
+def fetch_blob(url, key, store, session=requests, **kwargs):
+    """Downloads payload into the store as is, without putting it anywhere else
 
-def execute_download_task(task, auth=None):
+    :return: path to the blob
+    """
+    writer = store.writer(key)
+    try:
+        with closing(session.get(url, stream=True, **kwargs)) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                writer.write(chunk)
+
+        return writer.commit()
+    finally:
+        writer.discard()
+
+
+def execute_download_task(task, auth=None, store=None, metadata=None, session=None, staged=False,
+                          incremental=False, limits=None, extractor=None, **download_options):
     """
     :param task:
     :param auth:
-    :return: tuple (url, smth), where smth or is belongs to {'success', 'skipped'} either is Exception object
+    :param store: artifactory.cache.ArtifactStore, optional
+    :param metadata: artifactory.metadata.MetadataCache shared by the tasks of the run
+    :param session: artifactory.transport.Transport shared by the tasks of the run
+    :param staged: extract into a new version next to the destination, see artifactory.staging.Stage
+    :param incremental: write only changed files of archives, see artifactory.manifest.sync
+    :param limits: artifactory.scheduler.Limits shared by the tasks of the run
+    :param extractor: artifactory.extraction.Extractor shared by the tasks of the run
+    :param download_options: range_threshold and range_segments, see `download`
+    :return: tuple (url, smth), where smth or is belongs to {'success', 'cached', 'skipped'} either is Exception object
 
     """
     logger = make_logger('artifactory-cli-downloader')
@@ -66,27 +272,123 @@ def execute_download_task(task, auth=None):
     folder = task['destination'].get('folder', os.path.abspath('.'))
     url = task['url']
     info_url = task.get('info_url')
+    session = session or requests
+    metadata = metadata or MetadataCache(auth, session=session)
+    limits = limits or scheduler.Limits()
+    extractor = extractor or extraction.Extractor()
 
-    flag = no_need_to_reload(folder, info_url, auth) if info_url else None
-    if not flag:
-        try:
-            resp = requests.get(url, auth=auth)
-            put_file(resp, **task['destination'])
+    try:
+        info = metadata.get(info_url) if info_url else None
 
-            info = requests.get(info_url, auth=auth).json()
-            dump_info(info, folder)
-            logger.info("Finish task %s with %s" % (url, resp))
+        stage = staging.Stage(folder, info) if staged else None
+        if stage:
+            if stage.is_ready(info_file):
+                stage.mark_next()
+                return url, 'skipped'
+            destination = dict(task['destination'], folder=stage.begin())
+        else:
+            if info and no_need_to_reload(folder, info):
+                return url, 'skipped'
+            destination = task['destination']
 
-            return url, 'success'
+        # the destination folder holds the previous version both for in place and for staged extraction
+        previous = folder if incremental and os.path.isdir(folder) else None
 
-        except Exception as exception:
-            return url, exception
-    else:
-        return url, 'skipped'
+        key = cache.checksum_of(info)
+        blob_path = store.get(key) if store and key else None
+        if blob_path:
+            with limits.extraction:
+                put_blob(blob_path, url, previous=previous, extractor=extractor, **destination)
+            result = 'cached'
+        else:
+            download(
+                url, destination, auth=auth, store=store, key=key, session=session,
+                size=int(info.get('size') or 0) if info else None, previous=previous, limits=limits,
+                extractor=extractor, **download_options
+            )
+            result = 'success'
+
+        if info:
+            dump_info(info, destination.get('folder', folder))
+        if stage:
+            stage.commit()
+            stage.mark_next()
+        logger.info("Finish task %s with %s" % (url, result))
 
+        return url, result
 
-def execute_download_tasks(tasks_list, auth=None):
-    pool = multiprocessing.dummy.Pool()
-    results = pool.map(lambda task: execute_download_task(task, auth=auth), tasks_list)
+    except Exception as exception:
+        return url, exception
 
-    return results
+
+def iter_download_tasks(tasks_list, auth=None, store=None, metadata=None, session=None, pool_size=None,
+                        order=scheduler.ORDER_CRITICAL, limits=None, stats=None, **task_options):
+    """Runs tasks in a thread pool, yields results of `execute_download_task` as soon as every task completes
+
+    :param tasks_list:
+    :param auth:
+    :param store:
+    :param metadata:
+    :param session:
+    :param pool_size: number of threads
+    :param order: see artifactory.scheduler.order_tasks
+    :param limits: artifactory.scheduler.Limits, network and extraction concurrency
+    :param stats: artifactory.stats.DownloadStats, records duration and outcome of every task
+    :param task_options: passed to `execute_download_task`
+    """
+    pool_size = pool_size or DEFAULT_POOL_SIZE
+    session = session or Transport(pool_size=pool_size)
+    limits = limits or scheduler.Limits(extraction=scheduler.DEFAULT_EXTRACTION_CONCURRENCY)
+    if metadata is None:
+        metadata = MetadataCache(auth, session=session)
+        metadata.prefetch(tasks_list)
+
+    def _execute(task):
+        started = time.time()
+        url, result = execute_download_task(
+            task, auth=auth, store=store, metadata=metadata, session=session, limits=limits, **task_options
+        )
+        if stats is not None:
+            stats.record(url, result, time.time() - started, size=scheduler.task_size(task, metadata))
+        return url, result
+
+    pool = multiprocessing.dummy.Pool(pool_size)
+    completed = False
+    try:
+        results = pool.imap_unordered(_execute, scheduler.order_tasks(tasks_list, metadata, order))
+        for result in results:
+            yield result
+        completed = True
+    finally:
+        # abandoned early (consumer raised or stopped iterating): don't start the remaining tasks
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+def execute_download_tasks(tasks_list, auth=None, **kwargs):
+    return list(iter_download_tasks(tasks_list, auth=auth, **kwargs))
+
+
+def activate_staged(tasks_list, retention=staging.DEFAULT_RETENTION):
+    """Switches destinations of the tasks to their staged versions and removes old versions
+
+    :return: list of activated folders
+    """
+    folders = sorted({os.path.abspath(task['destination'].get('folder', '.')) for task in tasks_list})
+    activated = [folder for folder in folders if staging.activate(folder)]
+    for folder in folders:
+        staging.collect_garbage(folder, retention=retention)
+
+    return activated
+
+
+def rollback_activated(tasks_list):
+    """Switches destinations of the tasks back to the versions replaced by the last `activate_staged`
+
+    :return: list of rolled back folders
+    """
+    folders = sorted({os.path.abspath(task['destination'].get('folder', '.')) for task in tasks_list})
+    return [folder for folder in folders if staging.rollback(folder)]
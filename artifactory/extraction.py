@@ -0,0 +1,268 @@
+import contextlib
+import copy
+import errno
+import multiprocessing
+import operator
+import os
+import subprocess
+import tarfile
+import threading
+from distutils.spawn import find_executable
+
+from artifactory import cache
+from artifactory.logger import make_logger
+
+CHUNK_SIZE = 1024 * 1024
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+DEFAULT_WRITERS = min(8, multiprocessing.cpu_count())
+# members up to this size are read into memory and written by the pool, larger ones are streamed to the disk
+BUFFERED_MEMBER_SIZE = 16 * 1024 ** 2
+# read but not yet written member bytes of a single archive
+MAX_PENDING_BYTES = 128 * 1024 ** 2
+
+DECODER_AUTO = 'auto'
+# external gzip decoders, the first one found in PATH is used
+GZIP_DECODERS = (
+    ('pigz', '-d', '-c'),
+)
+
+
+def find_decoder():
+    for command in GZIP_DECODERS:
+        if find_executable(command[0]):
+            return command
+
+
+class Extractor(object):
+    """How archives are unpacked: gzip is decoded by an external process (pigz) when there is one,
+    so that inflate runs on another core than the tar parsing, and regular files are written by `writers` threads.
+
+    writers=1 and decoder=None is the plain tarfile extraction.
+    """
+
+    def __init__(self, writers=DEFAULT_WRITERS, decoder=DECODER_AUTO):
+        """
+        :param writers: threads writing members of a single archive
+        :param decoder: command decoding gzip from stdin to stdout, 'auto' - see GZIP_DECODERS, None - python gzip
+        """
+        self.writers = writers
+        self.decoder = find_decoder() if decoder == DECODER_AUTO else decoder
+
+    @contextlib.contextmanager
+    def open(self, fileobj=None, path=None):
+        """tar.gz from `fileobj` or from the file at `path` as a tarfile in stream mode"""
+        decoder = None
+        if self.decoder:
+            try:
+                decoder = ExternalDecoder(self.decoder, fileobj=fileobj, path=path)
+            except OSError as e:
+                make_logger('artifactory-cli-downloader').warning(
+                    'Can not start %s: %s, fall back to python gzip' % (self.decoder[0], e)
+                )
+
+        if decoder is None:
+            tar = tarfile.open(name=path, fileobj=fileobj, mode='r|gz', bufsize=CHUNK_SIZE)
+            yield tar
+            tar.close()
+            return
+
+        try:
+            tar = tarfile.open(fileobj=decoder.stdout, mode='r|', bufsize=CHUNK_SIZE)
+            yield tar
+            tar.close()
+        except Exception:
+            decoder.abort()
+            raise
+        decoder.finish()
+
+
+class ExternalDecoder(object):
+    """gzip decoding subprocess. Input that is not a file on disk (a socket stream) is fed by a thread."""
+
+    def __init__(self, command, fileobj=None, path=None):
+        self.command = command
+        self.error = None
+        self._feeder = None
+        self._aborted = False
+
+        if path is not None:
+            with open(path, 'rb') as f:
+                self.proc = subprocess.Popen(command, stdin=f, stdout=subprocess.PIPE, bufsize=CHUNK_SIZE)
+        else:
+            self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=CHUNK_SIZE)
+            self._feeder = threading.Thread(target=self._feed, args=(fileobj,), name='gzip-feeder')
+            self._feeder.daemon = True
+            self._feeder.start()
+
+        self.stdout = self.proc.stdout
+
+    def _feed(self, fileobj):
+        # reads to the end of the payload, so a TeeReader sink gets the whole blob
+        try:
+            for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                self.proc.stdin.write(chunk)
+        except IOError as e:
+            if not (self._aborted and e.errno == errno.EPIPE):
+                self.error = e
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+
+    def _join(self):
+        if self._feeder:
+            self._feeder.join()
+        if self.error is not None:
+            # network errors are reported as is, not as a broken archive
+            raise self.error
+
+    def finish(self):
+        # tar end-of-archive padding is not read by tarfile
+        while self.stdout.read(CHUNK_SIZE):
+            pass
+        return_code = self.proc.wait()
+        self._join()
+        if return_code:
+            raise tarfile.ReadError('%s exited with code %d' % (self.command[0], return_code))
+
+    def abort(self):
+        self._aborted = True
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+        self.proc.wait()
+        self._join()
+
+
+def write_member(tar, member, path, data):
+    """Writes a regular file member, `data` is either its content or a file object to copy it from"""
+    # destination may hold a hardlink to another version of the file, it must not be overwritten in place
+    cache.remove_if_exists(path)
+    with open(path, 'wb', WRITE_BUFFER_SIZE) as f:
+        if isinstance(data, bytes):
+            f.write(data)
+        else:
+            for chunk in iter(lambda: data.read(CHUNK_SIZE), b''):
+                f.write(chunk)
+
+    tar.chown(member, path)
+    tar.chmod(member, path)
+    tar.utime(member, path)
+
+
+class MemberWriters(object):
+    """Pool of threads writing members read by the main thread, at most `max_pending_bytes` are held in memory"""
+
+    def __init__(self, tar, writers, max_pending_bytes=MAX_PENDING_BYTES):
+        self.tar = tar
+        self.max_pending_bytes = max_pending_bytes
+        self.errors = []
+
+        self._pending = []
+        self._pending_bytes = 0
+        self._in_progress = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._threads = [threading.Thread(target=self._work, name='tar-writer') for _ in range(writers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, member, path, data):
+        with self._condition:
+            while self._pending_bytes and self._pending_bytes + len(data) > self.max_pending_bytes:
+                self._condition.wait()
+            self._check()
+            self._pending.append((member, path, data))
+            self._pending_bytes += len(data)
+            self._condition.notify_all()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                member, path, data = self._pending.pop(0)
+                self._in_progress += 1
+
+            try:
+                if not self.errors:
+                    write_member(self.tar, member, path, data)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                with self._condition:
+                    self._in_progress -= 1
+                    self._pending_bytes -= len(data)
+                    self._condition.notify_all()
+
+    def _check(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def wait(self):
+        """Blocks until everything submitted is written"""
+        with self._condition:
+            while self._pending or self._in_progress:
+                self._condition.wait()
+        self._check()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+def extract_parallel(tar, folder, writers=DEFAULT_WRITERS):
+    """Same as tar.extractall(folder), but regular files are written by a pool of threads.
+
+    The archive is still read sequentially by the calling thread: small members are read into memory and handed
+    over to the pool, large ones are streamed to the disk right away. Links may point to files of the archive,
+    so the pool is drained before any other member type is extracted.
+    """
+    pool = MemberWriters(tar, writers)
+    directories = []
+    try:
+        for member in tar:
+            path = os.path.join(folder, member.name)
+            if member.isreg():
+                cache.makedirs(os.path.dirname(path))
+                src = tar.extractfile(member)
+                if member.size <= BUFFERED_MEMBER_SIZE:
+                    pool.submit(member, path, src.read())
+                else:
+                    write_member(tar, member, path, src)
+                continue
+
+            if member.isdir():
+                # like extractall: directories are writable until their own mode is set at the end
+                directories.append(member)
+                member = copy.copy(member)
+                member.mode = 0o700
+            else:
+                pool.wait()
+            tar.extract(member, folder)
+
+        pool.wait()
+    finally:
+        pool.close()
+
+    directories.sort(key=operator.attrgetter('name'), reverse=True)
+    for member in directories:
+        path = os.path.join(folder, member.name)
+        try:
+            tar.chown(member, path)
+            tar.utime(member, path)
+            tar.chmod(member, path)
+        except tarfile.ExtractError:
+            if tar.errorlevel > 1:
+                raise
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+
+from artifactory import cache
+
+manifest_file = 'artifactory_manifest.json'
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def load(folder):
+    try:
+        with open(os.path.join(folder, manifest_file)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def dump(manifest, folder):
+    path = os.path.join(folder, manifest_file)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(path + '.tmp', path)
+
+
+def member_name(member):
+    return os.path.normpath(member.name)
+
+
+def is_unchanged(entry, member, path):
+    """rsync-like quick check: size and mtime from the tar header against the manifest and the file on disk"""
+    if not entry or entry['size'] != member.size or entry['mtime'] != member.mtime:
+        return False
+
+    try:
+        return os.path.getsize(path) == member.size
+    except OSError:
+        return False
+
+
+def write_member(tar, member, path):
+    """Extracts regular file member via a temporary file, so files are replaced atomically and never in place"""
+    cache.makedirs(os.path.dirname(path))
+
+    tmp_path = path + '.artifactory-tmp'
+    digest = hashlib.sha1()
+    src = tar.extractfile(member)
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            f.write(chunk)
+
+    tar.chmod(member, tmp_path)
+    tar.utime(member, tmp_path)
+    os.rename(tmp_path, path)
+
+    return {'size': member.size, 'mtime': member.mtime, 'sha1': digest.hexdigest()}
+
+
+def remove_missing(folder, old_manifest, new_manifest):
+    """Deletes files of `old_manifest` that are not in `new_manifest`, returns their number"""
+    names = set(old_manifest) - set(new_manifest)
+    for name in names:
+        cache.remove_if_exists(os.path.join(folder, name))
+
+    return len(names)
+
+
+def sync(tar, folder, previous):
+    """Incremental extraction of `tar` into `folder`.
+
+    `previous` is the folder with the previous extraction of the same artifact (`folder` itself
+    for in place update). Its manifest (path -> size, mtime, sha1) is compared against the member list:
+    unchanged files are not written at all (hardlinked from `previous` if it is another folder),
+    changed and new ones are extracted, files removed from the archive are deleted.
+    Disk writes are proportional to the change, not to the size of the archive.
+
+    :return: tuple (written, kept, removed) counters
+    """
+    old_manifest = load(previous)
+    new_manifest = {}
+    written = kept = 0
+
+    for member in tar:
+        name = member_name(member)
+        path = os.path.join(folder, name)
+
+        if not member.isreg():
+            tar.extract(member, folder)
+            continue
+
+        previous_path = os.path.join(previous, name)
+        if is_unchanged(old_manifest.get(name), member, previous_path):
+            if previous_path != path:
+                cache.link_or_copy(previous_path, path)
+            new_manifest[name] = old_manifest[name]
+            kept += 1
+        else:
+            new_manifest[name] = write_member(tar, member, path)
+            written += 1
+
+    removed = 0
+    if os.path.abspath(previous) == os.path.abspath(folder):
+        removed = remove_missing(folder, old_manifest, new_manifest)
+
+    cache.makedirs(folder)
+    dump(new_manifest, folder)
+
+    return written, kept, removed
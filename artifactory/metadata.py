@@ -0,0 +1,144 @@
+import calendar
+import collections
+import json
+import re
+import threading
+
+import requests
+
+from artifactory.logger import make_logger
+
+# max number of artifacts in a single aql query
+AQL_BATCH_SIZE = 100
+
+_timestamp_re = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$'
+)
+
+
+def parse_timestamp(value):
+    """ISO 8601 timestamp as returned by artifactory (both storage api and aql flavors) -> unix time"""
+    match = _timestamp_re.match(value)
+    if not match:
+        raise ValueError('Unknown timestamp format: %r' % value)
+
+    year, month, day, hour, minute, second, fraction, tz = match.groups()
+    result = calendar.timegm(tuple(int(x) for x in (year, month, day, hour, minute, second)))
+    result += float('0.%s' % fraction) if fraction else 0
+
+    if tz and tz != 'Z':
+        sign = -1 if tz[0] == '-' else 1
+        tz = tz[1:].replace(':', '')
+        result -= sign * (int(tz[:2]) * 3600 + int(tz[2:]) * 60)
+
+    return result
+
+
+def is_not_newer(info, old_info):
+    try:
+        return parse_timestamp(info['lastUpdated']) <= parse_timestamp(old_info['lastUpdated'])
+    except ValueError:
+        return info['lastUpdated'] <= old_info['lastUpdated']
+
+
+def split_info_url(info_url):
+    """http://host/api/storage/repo/path/to/name -> ('http://host', 'repo', 'path/to', 'name')"""
+    base, _, rest = info_url.partition('/api/storage/')
+    if not rest:
+        return None
+
+    repo, _, path = rest.partition('/')
+    folder, _, name = path.rpartition('/')
+
+    return base, repo, folder or '.', name
+
+
+def info_from_aql_item(item, info_url):
+    """aql item -> dict shaped like the storage api response, the fields used by downloader only"""
+    return {
+        'repo': item['repo'],
+        'path': '/%s/%s' % (item['path'], item['name']) if item['path'] != '.' else '/%s' % item['name'],
+        'uri': info_url,
+        'size': item.get('size'),
+        'lastUpdated': item['updated'],
+        'checksums': {
+            'sha1': item.get('actual_sha1'),
+            'sha256': item.get('sha256'),
+        },
+    }
+
+
+class MetadataCache(object):
+    """Artifactory storage info memoized for the whole run.
+
+    `prefetch` resolves all tasks at once with a few aql queries, anything not resolved that way
+    is fetched from `info_url` on demand, once per url.
+    """
+
+    def __init__(self, auth=None, session=requests):
+        self.auth = auth
+        self.session = session
+        self._infos = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, tasks):
+        logger = make_logger()
+
+        groups = collections.defaultdict(dict)
+        for task in tasks:
+            info_url = task.get('info_url')
+            parts = split_info_url(info_url) if info_url else None
+            if parts is None or info_url in self._infos:
+                continue
+            base, repo, folder, name = parts
+            groups[base, repo][folder, name] = info_url
+
+        for (base, repo), location_to_url in groups.items():
+            locations = sorted(location_to_url)
+            for i in range(0, len(locations), AQL_BATCH_SIZE):
+                batch = locations[i:i + AQL_BATCH_SIZE]
+                try:
+                    items = self._search(base, repo, batch)
+                except Exception as e:
+                    logger.warning('Metadata prefetch from %s failed, fall back to storage api: %s' % (base, e))
+                    continue
+
+                for item in items:
+                    info_url = location_to_url.get((item['path'], item['name']))
+                    if info_url:
+                        self._infos[info_url] = info_from_aql_item(item, info_url)
+
+    def _search(self, base, repo, locations):
+        criteria = {
+            'repo': repo,
+            '$or': [{'$and': [{'path': folder}, {'name': name}]} for folder, name in locations],
+        }
+        query = 'items.find(%s).include("repo", "path", "name", "updated", "size", "actual_sha1", "sha256")' % (
+            json.dumps(criteria)
+        )
+        resp = self.session.post(
+            '%s/api/search/aql' % base,
+            data=query,
+            auth=self.auth,
+            headers={'Content-Type': 'text/plain'},
+        )
+        resp.raise_for_status()
+
+        return resp.json()['results']
+
+    def peek(self, info_url):
+        """Already known info or None, never goes to artifactory"""
+        with self._lock:
+            return self._infos.get(info_url)
+
+    def get(self, info_url):
+        with self._lock:
+            info = self._infos.get(info_url)
+        if info is None:
+            resp = self.session.get(info_url, auth=self.auth)
+            resp.raise_for_status()
+            info = resp.json()
+            with self._lock:
+                self._infos[info_url] = info
+
+        return info
@@ -0,0 +1,172 @@
+import collections
+import json
+import os
+import re
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from artifactory import cache, downloader
+from artifactory.logger import make_logger
+from artifactory.transport import Transport
+
+DEFAULT_PORT = 8765
+
+_range_re = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class MirrorServer(ThreadingMixIn, HTTPServer):
+    """Read-only artifactory stand-in, used to relay artifacts from host to host.
+
+    Storage api and aql requests are proxied to `upstream` (another mirror or artifactory itself),
+    GET responses of the api are memoized. Payload requests are served from the local artifact store,
+    a missing blob is fetched from `upstream` once and then served to every requester.
+    The client's Authorization header is forwarded upstream as is. Memoized responses are kept per
+    Authorization header and a payload is served only after upstream has answered the storage api request
+    of the artifact with the client's own credentials, so the mirror never grants more than upstream does.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, upstream, store, session=None):
+        HTTPServer.__init__(self, address, MirrorHandler)
+        self.upstream = upstream.rstrip('/')
+        self.store = store
+        self.session = session or Transport()
+
+        self.infos = {}
+        self.key_locks = collections.defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        make_logger('artifactory-mirror').info('%s %s' % (self.client_address[0], fmt % args))
+
+    def do_GET(self):
+        try:
+            if self.path == '/api/system/ping':
+                self._send_body(200, 'OK', 'text/plain')
+            elif self.path.startswith('/api/'):
+                self._proxy()
+            else:
+                self._serve_artifact()
+        except Exception as e:
+            self.log_error('%s', e)
+            self._send_body(502, str(e), 'text/plain')
+
+    def do_POST(self):
+        try:
+            self._proxy()
+        except Exception as e:
+            self.log_error('%s', e)
+            self._send_body(502, str(e), 'text/plain')
+
+    def _upstream_headers(self):
+        return {'Authorization': self.headers['Authorization']} if 'Authorization' in self.headers else {}
+
+    def _proxy(self):
+        if self.command == 'GET':
+            return self._send_body(*self._memoized_get(self.path))
+
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        headers = dict(self._upstream_headers(), **{'Content-Type': self.headers.get('Content-Type', 'text/plain')})
+        resp = self.server.session.post(self.server.upstream + self.path, data=body, headers=headers)
+        self._send_body(resp.status_code, resp.content, resp.headers.get('Content-Type', 'application/json'))
+
+    def _memoized_get(self, path):
+        memo_key = (self.headers.get('Authorization'), path)
+        with self.server.lock:
+            cached = self.server.infos.get(memo_key)
+
+        if cached is None:
+            resp = self.server.session.get(self.server.upstream + path, headers=self._upstream_headers())
+            cached = (resp.status_code, resp.content, resp.headers.get('Content-Type', 'application/json'))
+            if resp.ok:
+                with self.server.lock:
+                    self.server.infos[memo_key] = cached
+
+        return cached
+
+    def _serve_artifact(self):
+        status, content, content_type = self._memoized_get('/api/storage' + self.path)
+        if status != 200:
+            # upstream does not give the artifact to the client's credentials (or there is no such artifact)
+            return self._send_body(status, content, content_type)
+
+        key = cache.checksum_of(json.loads(content))
+        if key is None:
+            raise IOError('No checksum for %s' % self.path)
+
+        store = self.server.store
+        with self.server.lock:
+            key_lock = self.server.key_locks[key]
+        with key_lock:
+            blob_path = store.get(key) or downloader.fetch_blob(
+                self.server.upstream + self.path, key, store,
+                session=self.server.session, headers=self._upstream_headers()
+            )
+
+        self._send_file(blob_path)
+
+    def _send_file(self, path):
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+
+        match = _range_re.match(self.headers.get('Range', ''))
+        if match and any(match.groups()):
+            first, last = match.groups()
+            if first:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+            if start >= size or end < start:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                chunk = f.read(min(downloader.CHUNK_SIZE, left))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                left -= len(chunk)
+
+    def _send_body(self, status, content, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve(upstream, store_path, address, port=DEFAULT_PORT, store_size_cap=cache.DEFAULT_SIZE_CAP):
+    """
+    :param upstream:
+    :param store_path:
+    :param address: address of the interface to listen on, the one other hosts reach this host by
+    :param port:
+    :param store_size_cap:
+    """
+    logger = make_logger()
+    server = MirrorServer((address, port), upstream, cache.ArtifactStore(store_path, size_cap=store_size_cap))
+
+    logger.info('Serving artifacts on %s:%d, upstream %s' % (address, port, upstream))
+    server.serve_forever()
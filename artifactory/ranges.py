@@ -0,0 +1,174 @@
+import json
+import multiprocessing.dummy
+import os
+import random
+import threading
+import time
+from contextlib import closing
+
+import requests
+
+DEFAULT_THRESHOLD = 64 * 1024 ** 2
+DEFAULT_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 16 * 1024 ** 2
+# progress is persisted at least every PROGRESS_STEP bytes of a segment
+PROGRESS_STEP = 8 * 1024 ** 2
+SEGMENT_RETRIES = 5
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class ContentChanged(RangeNotSupported):
+    """The artifact changed since the partial file was started, it can not be resumed"""
+
+
+def segment_bounds(size, segments):
+    """Inclusive byte ranges of `segments` (at most) consecutive parts of `size` bytes"""
+    segments = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+    step = -(-size // segments)
+
+    return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+
+class RangedDownload(object):
+    """Downloads `url` of known `size` into `path` with one or several concurrent Range requests.
+
+    Every segment is written in place at its offset. Progress of every segment is kept in `path`.progress,
+    so an interrupted download (in this run or in the previous `fab load_artifacts`) continues from
+    where it stopped instead of starting from byte zero. ETag of the artifact is kept there as well and sent
+    as If-Range, so a partial file of an artifact that has changed since is not completed with the new content.
+    """
+
+    def __init__(self, session, url, path, size, auth=None, segments=DEFAULT_SEGMENTS):
+        self.session = session
+        self.url = url
+        self.path = path
+        self.size = size
+        self.auth = auth
+        self.bounds = segment_bounds(size, segments)
+
+        self.progress_path = path + '.progress'
+        self.etag = None
+        self._done = [0] * len(self.bounds)
+        self._saved = [0] * len(self.bounds)
+        self._lock = threading.Lock()
+
+    def run(self):
+        self._prepare()
+
+        pool = multiprocessing.dummy.Pool(len(self.bounds))
+        try:
+            errors = [e for e in pool.map(self._fetch_segment_safe, range(len(self.bounds))) if e is not None]
+        finally:
+            pool.close()
+        # segment files are closed, everything downloaded is on the disk
+        self._save_progress()
+
+        if errors:
+            raise errors[0]
+
+        os.remove(self.progress_path)
+
+    def discard(self):
+        for path in (self.path, self.progress_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _prepare(self):
+        try:
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+        except (IOError, OSError, ValueError):
+            progress = None
+
+        resumable = (
+            progress is not None and
+            progress.get('size') == self.size and
+            [tuple(b) for b in progress.get('bounds', [])] == self.bounds and
+            os.path.exists(self.path) and
+            os.path.getsize(self.path) == self.size
+        )
+        if resumable:
+            self._done = list(progress['done'])
+            self._saved = list(self._done)
+            self.etag = progress.get('etag')
+            return
+
+        with open(self.path, 'wb') as f:
+            f.truncate(self.size)
+        self._save_progress()
+
+    def _save_progress(self, index=None):
+        """Persists progress of the segment `index`, None - of all segments.
+
+        Only the segment whose file is flushed may be recorded as done, other segments keep their saved progress.
+        """
+        with self._lock:
+            if index is None:
+                self._saved = list(self._done)
+            else:
+                self._saved[index] = self._done[index]
+            progress = {'size': self.size, 'bounds': self.bounds, 'done': self._saved, 'etag': self.etag}
+            tmp_path = self.progress_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(progress, f)
+            os.rename(tmp_path, self.progress_path)
+
+    def _fetch_segment_safe(self, index):
+        try:
+            self._fetch_segment(index)
+        except Exception as e:
+            return e
+
+    def _fetch_segment(self, index):
+        start, end = self.bounds[index]
+        attempt = 0
+
+        while start + self._done[index] <= end:
+            try:
+                self._fetch_range(index, start + self._done[index], end)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, IOError):
+                attempt += 1
+                if attempt > SEGMENT_RETRIES:
+                    raise
+                time.sleep(random.uniform(0, 2 ** attempt))
+
+    def _fetch_range(self, index, offset, end):
+        headers = {'Range': 'bytes=%d-%d' % (offset, end), 'Accept-Encoding': 'identity'}
+        etag = self.etag
+        if etag:
+            # the server answers with the whole new content instead of the range if the artifact has changed
+            headers['If-Range'] = etag
+        with closing(self.session.get(self.url, auth=self.auth, headers=headers, stream=True)) as resp:
+            resp.raise_for_status()
+            if resp.status_code != requests.codes.partial_content:
+                if etag:
+                    raise ContentChanged('%s changed since its partial download was started' % self.url)
+                raise RangeNotSupported('%s answered %s to a range request' % (self.url, resp.status_code))
+            with self._lock:
+                new_etag = resp.headers.get('ETag')
+                if new_etag and self.etag and new_etag != self.etag:
+                    raise ContentChanged('%s changed since its partial download was started' % self.url)
+                self.etag = self.etag or new_etag
+
+            with open(self.path, 'r+b') as f:
+                f.seek(offset)
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    chunk = chunk[:end + 1 - offset]
+                    f.write(chunk)
+                    offset += len(chunk)
+                    self._advance(index, len(chunk), f)
+
+        if offset <= end:
+            raise IOError('%s: connection closed at byte %d of range ending at %d' % (self.url, offset, end))
+
+    def _advance(self, index, length, f):
+        self._done[index] += length
+        if self._done[index] - self._saved[index] >= PROGRESS_STEP:
+            # data must reach the file before progress says it is there
+            f.flush()
+            self._save_progress(index)
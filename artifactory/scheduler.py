@@ -0,0 +1,55 @@
+import multiprocessing
+import threading
+
+DEFAULT_EXTRACTION_CONCURRENCY = multiprocessing.cpu_count()
+
+ORDER_CRITICAL = 'critical'
+ORDER_LARGEST = 'largest'
+ORDER_AS_IS = 'as_is'
+
+
+class Unbounded(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def semaphore(value):
+    return threading.BoundedSemaphore(value) if value else Unbounded()
+
+
+class Limits(object):
+    """Separate concurrency limits for network transfers and for extraction to the disk.
+
+    Streamed archives are downloaded and extracted at once, so they hold both slots,
+    always taken in the same order: network first, then extraction.
+    """
+
+    def __init__(self, network=None, extraction=None):
+        self.network = semaphore(network)
+        self.extraction = semaphore(extraction)
+
+
+def task_size(task, metadata):
+    info = metadata.peek(task['info_url']) if task.get('info_url') else None
+    return int((info or {}).get('size') or 0)
+
+
+def order_tasks(tasks, metadata, order=ORDER_CRITICAL):
+    """
+    critical - tasks with higher `priority` key first, largest first among equal priority
+    largest - largest first, so that the longest downloads do not end up in the tail
+    as_is - keep the order of the task list
+
+    sizes are taken from the prefetched metadata only
+    """
+    if order == ORDER_AS_IS:
+        return list(tasks)
+    if order == ORDER_LARGEST:
+        return sorted(tasks, key=lambda task: -task_size(task, metadata))
+    if order == ORDER_CRITICAL:
+        return sorted(tasks, key=lambda task: (-task.get('priority', 0), -task_size(task, metadata)))
+
+    raise ValueError('Unknown order %r' % order)
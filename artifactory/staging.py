@@ -0,0 +1,140 @@
+import os
+import shutil
+import time
+
+from artifactory import cache
+
+DEFAULT_RETENTION = 3
+
+versions_suffix = '.versions'
+next_suffix = '.next'
+prev_suffix = '.prev'
+tmp_suffix = '.tmp'
+
+
+def version_name(info):
+    key = cache.checksum_of(info)
+    if key:
+        return '%s-%s' % (key[0], key[1][:16])
+
+    return 'unversioned-%d' % (time.time() * 1000)
+
+
+def replace_symlink(target, link):
+    """Atomically points `link` to `target`"""
+    tmp_link = link + tmp_suffix
+    cache.remove_if_exists(tmp_link)
+    os.symlink(target, tmp_link)
+    os.rename(tmp_link, link)
+
+
+class Stage(object):
+    """Versioned staging of a destination folder.
+
+    `folder` is a symlink to `folder.versions/<version>`. A new version is extracted into
+    `folder.versions/<version>.tmp`, renamed to `folder.versions/<version>` when complete and marked
+    by `folder.next` symlink. The running service keeps using the old version until `activate` flips
+    `folder` to the next version with a single rename. The version it replaced stays marked by `folder.prev`
+    symlink until the next `activate`, so `rollback` can flip it back.
+    """
+
+    def __init__(self, folder, info):
+        self.folder = os.path.abspath(folder)
+        self.versions_dir = self.folder + versions_suffix
+        self.version = version_name(info)
+        self.path = os.path.join(self.versions_dir, self.version)
+        self.work_path = self.path + tmp_suffix
+
+    def is_ready(self, info_file):
+        return os.path.exists(os.path.join(self.path, info_file))
+
+    def begin(self):
+        if os.path.exists(self.work_path):
+            shutil.rmtree(self.work_path)
+        cache.makedirs(self.work_path)
+
+        return self.work_path
+
+    def commit(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.work_path, self.path)
+
+    def mark_next(self):
+        replace_symlink(os.path.join(os.path.basename(self.versions_dir), self.version), self.folder + next_suffix)
+
+
+def activate(folder):
+    """Switches `folder` to the staged version, returns False if nothing was staged"""
+    folder = os.path.abspath(folder)
+    versions_dir = folder + versions_suffix
+    next_link = folder + next_suffix
+    prev_link = folder + prev_suffix
+
+    if not os.path.islink(next_link):
+        # the previous version is from an older activation, rolling back to it would revert this folder
+        cache.remove_if_exists(prev_link)
+        return False
+
+    if os.path.isdir(folder) and not os.path.islink(folder):
+        # first staged deploy to the folder, plain directory becomes one of the versions
+        legacy = 'legacy-%d' % time.time()
+        cache.makedirs(versions_dir)
+        os.rename(folder, os.path.join(versions_dir, legacy))
+        replace_symlink(os.path.join(os.path.basename(versions_dir), legacy), prev_link)
+    elif os.path.islink(folder):
+        replace_symlink(os.readlink(folder), prev_link)
+    else:
+        cache.remove_if_exists(prev_link)
+    os.utime(os.path.join(os.path.dirname(folder), os.readlink(next_link)), None)
+    os.rename(next_link, folder)
+
+    return True
+
+
+def rollback(folder):
+    """Switches `folder` back to the version replaced by the last `activate`, which becomes staged again.
+    Returns False if there is nothing to roll back to
+    """
+    folder = os.path.abspath(folder)
+    prev_link = folder + prev_suffix
+
+    if not os.path.islink(prev_link):
+        return False
+
+    if os.path.islink(folder):
+        replace_symlink(os.readlink(folder), folder + next_suffix)
+    os.rename(prev_link, folder)
+
+    return True
+
+
+def collect_garbage(folder, retention=DEFAULT_RETENTION):
+    """Removes old versions, keeps active, staged, previous and `retention` most recently activated ones"""
+    folder = os.path.abspath(folder)
+    versions_dir = folder + versions_suffix
+    if not os.path.isdir(versions_dir):
+        return []
+
+    protected = set()
+    for link in (folder, folder + next_suffix, folder + prev_suffix):
+        if os.path.islink(link):
+            protected.add(os.path.basename(os.readlink(link)))
+
+    versions = []
+    for name in os.listdir(versions_dir):
+        if name in protected or name.startswith('.'):
+            # hidden ones are partial downloads, they are kept for resuming
+            continue
+        path = os.path.join(versions_dir, name)
+        versions.append((os.path.getmtime(path), path))
+
+    retained = max(0, retention - len(protected))
+    removed = [path for _, path in sorted(versions, reverse=True)[retained:]]
+    for path in removed:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            cache.remove_if_exists(path)
+
+    return removed
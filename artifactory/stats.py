@@ -0,0 +1,58 @@
+import json
+import threading
+import time
+
+# prefix of the machine readable summary line printed by execute_tasks, parsed by the deploy host
+STATS_MARKER = 'ARTIFACTORY_STATS '
+SLOWEST_TASKS = 5
+
+
+class DownloadStats(object):
+    """Per task durations and outcomes of a single execute_tasks run, thread safe"""
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._tasks = []
+
+    def record(self, url, result, seconds, size=0):
+        status = 'failed' if isinstance(result, Exception) else result
+        with self._lock:
+            self._tasks.append((url, status, seconds, size if status == 'success' else 0))
+
+    def summary(self):
+        with self._lock:
+            tasks = list(self._tasks)
+
+        counts = dict((status, 0) for status in ('success', 'cached', 'skipped', 'failed'))
+        for _, status, _, _ in tasks:
+            counts[status] += 1
+
+        return {
+            'seconds': time.time() - self.started,
+            'downloaded': counts['success'],
+            'cached': counts['cached'],
+            'skipped': counts['skipped'],
+            'failed': counts['failed'],
+            'bytes': sum(size for _, _, _, size in tasks),
+            'slowest': [
+                [url, round(seconds, 3)]
+                for url, _, seconds, _ in sorted(tasks, key=lambda task: -task[2])[:SLOWEST_TASKS]
+            ],
+        }
+
+    def dump(self):
+        return STATS_MARKER + json.dumps(self.summary())
+
+
+def parse(output):
+    """summary dict from the output of `fab load_artifacts`, None if there is no stats line"""
+    for line in reversed(output.splitlines()):
+        _, marker, payload = line.partition(STATS_MARKER)
+        if marker:
+            try:
+                return json.loads(payload)
+            except ValueError:
+                return None
+
+    return None
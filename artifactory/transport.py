@@ -0,0 +1,114 @@
+import multiprocessing
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_SIZE = multiprocessing.cpu_count()
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5
+# (connect, read) seconds, read timeout is the max silence on the socket, not the whole download time
+DEFAULT_TIMEOUT = (10, 120)
+
+RETRY_STATUSES = (500, 502, 503, 504)
+# aql search is POST, but it is read only
+RETRY_METHODS = frozenset(['HEAD', 'GET', 'POST'])
+
+
+class JitteredRetry(Retry):
+    """Exponential backoff with full jitter, so that pool threads do not retry in lockstep"""
+
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return random.uniform(0, backoff)
+
+
+class TokenBucket(object):
+    """Shared bandwidth limit, `rate` bytes per second with bursts up to `burst` bytes"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+class ThrottledRaw(object):
+    """urllib3 response wrapper, every chunk read from the socket is paid for in the token bucket"""
+
+    def __init__(self, raw, bucket):
+        self.__dict__.update(_raw=raw, _bucket=bucket)
+
+    def read(self, *args, **kwargs):
+        data = self._raw.read(*args, **kwargs)
+        self._bucket.consume(len(data))
+        return data
+
+    def stream(self, *args, **kwargs):
+        for chunk in self._raw.stream(*args, **kwargs):
+            self._bucket.consume(len(chunk))
+            yield chunk
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+
+class Transport(requests.Session):
+    """Session shared by all downloader threads.
+
+    Connections are kept alive and reused, the pool is bounded by `pool_size` (threads block waiting
+    for a free connection instead of opening new ones). Requests to artifactory are retried on
+    connection errors and 5xx, every request gets a default timeout.
+    If `bandwidth` (bytes per second) is given, all streamed downloads of the session share it.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, timeout=DEFAULT_TIMEOUT, bandwidth=None):
+        super(Transport, self).__init__()
+        self.timeout = timeout
+        self.throttle = TokenBucket(bandwidth) if bandwidth else None
+
+        max_retries = JitteredRetry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            method_whitelist=RETRY_METHODS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=max_retries,
+        )
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        resp = super(Transport, self).request(method, url, **kwargs)
+        if self.throttle and kwargs.get('stream'):
+            resp.raw = ThrottledRaw(resp.raw, self.throttle)
+
+        return resp
@@ -0,0 +1,238 @@
+"""Local artifactory stand-in for benchmarks: storage api, aql search and payloads of a synthetic catalog.
+
+Payloads are tar.gz archives with a single file of random bytes, generated on first request and kept on disk.
+Latency, per connection bandwidth and failures (503 responses, connections dropped mid-body) are configurable.
+"""
+import collections
+import json
+import os
+import random
+import re
+import tarfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from artifactory import cache
+
+REPO = 'service-local'
+CHUNK_SIZE = 64 * 1024
+LAST_UPDATED = '2020-01-01T00:00:00.000Z'
+
+_range_re = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def make_payload(path, size):
+    """tar.gz with `size` random bytes inside, the archive is about the same size as random data does not compress"""
+    cache.makedirs(os.path.dirname(path))
+    data_path = path + '.data'
+    with open(data_path, 'wb') as f:
+        left = size
+        while left > 0:
+            chunk = os.urandom(min(CHUNK_SIZE * 16, left))
+            f.write(chunk)
+            left -= len(chunk)
+
+    with tarfile.open(path, 'w:gz', compresslevel=1) as tar:
+        tar.add(data_path, arcname='payload.bin')
+    os.remove(data_path)
+
+
+class FakeArtifactory(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, catalog, folder, latency=0.0, bandwidth=None, failure_rate=0.0, abort_rate=0.0,
+                 seed=0):
+        """
+        :param address: (host, port), port 0 - any free port
+        :param catalog: path inside the repo -> uncompressed payload size in bytes
+        :param folder: where generated payloads are kept
+        :param latency: seconds added to every response
+        :param bandwidth: bytes per second per connection, None - unlimited
+        :param failure_rate: share of requests answered with 503
+        :param abort_rate: share of payload responses dropped in the middle of the body
+        :param seed: seed of the failure injection
+        """
+        HTTPServer.__init__(self, address, FakeArtifactoryHandler)
+        self.catalog = dict(catalog)
+        self.folder = folder
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.abort_rate = abort_rate
+
+        self.random = random.Random(seed)
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.infos = {}
+        self.path_locks = collections.defaultdict(threading.Lock)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def roll(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def payload(self, path):
+        """(file path, storage info) of an artifact, generated on first use"""
+        with self.lock:
+            path_lock = self.path_locks[path]
+        with path_lock:
+            if path not in self.infos:
+                file_path = os.path.join(self.folder, path)
+                if not os.path.exists(file_path):
+                    make_payload(file_path, self.catalog[path])
+                self.infos[path] = (file_path, {
+                    'repo': REPO,
+                    'path': '/' + path,
+                    'size': str(os.path.getsize(file_path)),
+                    'lastUpdated': LAST_UPDATED,
+                    'checksums': {
+                        'sha1': cache.file_digest(file_path, 'sha1'),
+                        'sha256': cache.file_digest(file_path, 'sha256'),
+                    },
+                })
+
+            return self.infos[path]
+
+    def prepare(self):
+        """Generates all payloads upfront, so that generation does not end up in measurements"""
+        for path in self.catalog:
+            self.payload(path)
+
+
+class FakeArtifactoryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _delay_or_fail(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.roll(self.server.failure_rate):
+            self.server.count('503')
+            self._send_body(503, 'injected failure', 'text/plain')
+            return True
+
+        return False
+
+    def do_GET(self):
+        self.server.count('requests')
+        if self._delay_or_fail():
+            return
+
+        prefix = '/api/storage/%s/' % REPO
+        if self.path.startswith(prefix):
+            self.server.count('storage')
+            path = self.path[len(prefix):]
+            if path not in self.server.catalog:
+                return self._send_body(404, 'not found', 'text/plain')
+            _, info = self.server.payload(path)
+            return self._send_body(200, json.dumps(dict(info, uri=self.server.url + self.path)), 'application/json')
+
+        prefix = '/%s/' % REPO
+        path = self.path[len(prefix):]
+        if not self.path.startswith(prefix) or path not in self.server.catalog:
+            return self._send_body(404, 'not found', 'text/plain')
+
+        self.server.count('payload')
+        file_path, _ = self.server.payload(path)
+        self._send_file(file_path)
+
+    def do_POST(self):
+        self.server.count('requests')
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self._delay_or_fail():
+            return
+        if self.path != '/api/search/aql':
+            return self._send_body(404, 'not found', 'text/plain')
+
+        self.server.count('aql')
+        # items.find({...}).include(...)
+        criteria = json.loads(body[len('items.find('):body.index(').include(')])
+        results = []
+        for location in criteria.get('$or', []):
+            folder, name = location['$and'][0]['path'], location['$and'][1]['name']
+            path = '%s/%s' % (folder, name) if folder != '.' else name
+            if path in self.server.catalog:
+                _, info = self.server.payload(path)
+                results.append({
+                    'repo': REPO,
+                    'path': folder,
+                    'name': name,
+                    'updated': info['lastUpdated'],
+                    'size': int(info['size']),
+                    'actual_sha1': info['checksums']['sha1'],
+                    'sha256': info['checksums']['sha256'],
+                })
+
+        self._send_body(200, json.dumps({'results': results}), 'application/json')
+
+    def _send_file(self, path):
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+
+        match = _range_re.match(self.headers.get('Range', ''))
+        if match and any(match.groups()):
+            self.server.count('ranged')
+            first, last = match.groups()
+            if first:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        abort_at = (end - start + 1) // 2 if self.server.roll(self.server.abort_rate) else None
+        sent = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                chunk = f.read(min(CHUNK_SIZE, left))
+                if not chunk:
+                    break
+                if abort_at is not None and sent >= abort_at:
+                    self.server.count('aborted')
+                    self.close_connection = 1
+                    return
+                started = time.time()
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                left -= len(chunk)
+                self.server.count('bytes', len(chunk))
+                if self.server.bandwidth:
+                    time.sleep(max(0.0, float(len(chunk)) / self.server.bandwidth - (time.time() - started)))
+
+    def _send_body(self, status, content, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def start(catalog, folder, **options):
+    """Starts the server on a free localhost port in a background thread"""
+    server = FakeArtifactory(('127.0.0.1', 0), catalog, folder, **options)
+    thread = threading.Thread(target=server.serve_forever, name='fake-artifactory')
+    thread.daemon = True
+    thread.start()
+
+    return server
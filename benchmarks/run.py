@@ -0,0 +1,208 @@
+"""Offline benchmarks of the artifact pipeline and of deploy orchestration, runnable on a plain linux box.
+
+A fake artifactory (benchmarks.fake_artifactory) serves a synthetic catalog on localhost, tasks are built by
+fabric_utils.delivery_tasks from a generated artifactory_model_tags.yml. Every scenario runs in a separate
+process, so that its peak RSS is its own.
+
+    $ python -m benchmarks.run --sizes 1M,16M,128M --counts 4,32
+    $ python -m benchmarks.run --sizes 16M --counts 16 --latency 0.01 --bandwidth 50M --failure-rate 0.05
+    $ python -m benchmarks.run --deploy --sizes 16M --counts 8 --command-latency 0.05 --json bench.json
+
+Scenarios:
+    execute_tasks - artifactory.api.execute_tasks from scratch (empty destination and artifact store)
+    execute_tasks (warm) - the same tasks again, everything is up to date
+    deploy_service - fabric_utils.deploy.deploy_service on a mock target (benchmarks.targets), with --deploy
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+
+_units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(value):
+    value = value.strip().upper()
+    if value and value[-1] in _units:
+        return int(float(value[:-1]) * _units[value[-1]])
+    return int(value)
+
+
+def in_child(func, *args):
+    """func(*args) in a forked process, result dict is extended with the peak RSS of that process"""
+    queue = multiprocessing.Queue()
+
+    def _target():
+        try:
+            result = func(*args)
+        except BaseException as e:
+            result = {'error': repr(e)}
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        queue.put(result)
+
+    process = multiprocessing.Process(target=_target)
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def make_tasks(workdir, server_url, count):
+    """tasks of `count` models + the common artifacts of delivery_tasks, catalog path -> task"""
+    from benchmarks.tags import write_tags_table
+    from fabric_utils import delivery_tasks
+    from fabric_utils.paths import ARTIFACTORY_MODEL_TAGS_TABLE_PATH
+
+    write_tags_table(ARTIFACTORY_MODEL_TAGS_TABLE_PATH, workers=1, models_per_worker=count)
+    tasks = delivery_tasks.collect_tasks('worker', artifactory_url=server_url)
+    prefix = '%s/%s/' % (server_url, delivery_tasks.ARTIFACTORY_REPO)
+
+    return [task['url'][len(prefix):] for task in tasks], tasks
+
+
+def execute_tasks(tasks, store_path, options):
+    import artifactory.api
+    import artifactory.stats
+
+    stdout, sys.stdout = sys.stdout, StringIO()
+    started = time.time()
+    try:
+        artifactory.api.execute_tasks(
+            tasks, store_path=store_path, pool_size=options.pool_size, incremental=options.incremental,
+        )
+        failed = False
+    except SystemExit:
+        failed = True
+    finally:
+        output, sys.stdout = sys.stdout.getvalue(), stdout
+
+    result = artifactory.stats.parse(output) or {}
+    result.update({'wall': time.time() - started, 'failed_run': failed})
+    return result
+
+
+def deploy_service(tasks, store_path, options):
+    import fabric.api
+    import fabric_utils.deploy
+    import fabric_utils.planner
+    from benchmarks.targets import MockTarget
+
+    target = MockTarget(tasks, store_path=store_path, command_latency=options.command_latency,
+                        pool_size=options.pool_size)
+    # what fabric_utils.deploy.prepare_prewarm resolves from the target commit, the workdir is not a git checkout
+    fabric.api.env.prewarm_folders = sorted(set(fabric_utils.planner.artifact_folder(task) for task in tasks))
+    started = time.time()
+    with target.installed():
+        fabric_utils.deploy.deploy_service('service.py')
+
+    return {'wall': time.time() - started, 'commands': sum(target.commands.values())}
+
+
+def reset(workdir):
+    from fabric_utils.paths import DATA_PATH
+
+    for path in (DATA_PATH, os.path.join(workdir, 'store')):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+
+def run_scenario(name, server, func, tasks, workdir, options, size, payload_bytes):
+    server.counters.clear()
+    result = in_child(func, tasks, os.path.join(workdir, 'store'), options)
+    counters = dict(server.counters)
+
+    wall = result.get('wall') or 0
+    return dict(result, **{
+        'scenario': name,
+        'tasks': len(tasks),
+        'size': size,
+        'throughput_mb_s': counters.get('bytes', 0) / 1024.0 ** 2 / wall if wall else 0,
+        'payload_mb': payload_bytes / 1024.0 ** 2,
+        'requests': counters,
+    })
+
+
+def render(results):
+    lines = ['%-22s %6s %8s %8s %9s %9s %8s %8s %7s %5s %6s' % (
+        'scenario', 'tasks', 'size MB', 'wall s', 'MB/s', 'RSS MB', 'storage', 'payload', 'aql', '503', 'abort',
+    )]
+    for r in results:
+        requests = r['requests']
+        lines.append('%-22s %6d %8.1f %8.2f %9.1f %9.1f %8d %8d %7d %5d %6d%s' % (
+            r['scenario'], r['tasks'], r['size'] / 1024.0 ** 2, r.get('wall') or 0, r['throughput_mb_s'],
+            r['peak_rss_mb'], requests.get('storage', 0), requests.get('payload', 0), requests.get('aql', 0),
+            requests.get('503', 0), requests.get('aborted', 0), '  ' + r['error'] if r.get('error') else '',
+        ))
+
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1M,16M', help='payload sizes, comma separated, e.g. 1M,64M')
+    parser.add_argument('--counts', default='4,16', help='model counts, comma separated')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--bandwidth', type=parse_size, default=None, help='per connection, e.g. 50M')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--abort-rate', type=float, default=0.0, help='share of payloads dropped mid-body')
+    parser.add_argument('--pool-size', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--incremental', action='store_true', help='execute_tasks(incremental=True)')
+    parser.add_argument('--deploy', action='store_true', help='also benchmark deploy_service on a mock target')
+    parser.add_argument('--command-latency', type=float, default=0.02, help='seconds per mock remote command')
+    parser.add_argument('--workdir', default=None, help='keeps generated payloads between runs')
+    parser.add_argument('--json', default=None, help='write results to this file')
+    options = parser.parse_args(argv)
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='artifactory-bench-')
+    # fabric_utils.paths reads GIT_ROOT on import: tags table and data folder go to the workdir
+    os.environ['GIT_ROOT'] = os.path.abspath(workdir)
+
+    from benchmarks import fake_artifactory
+
+    results = []
+    try:
+        for size in [parse_size(s) for s in options.sizes.split(',')]:
+            for count in [int(c) for c in options.counts.split(',')]:
+                server = fake_artifactory.start({}, os.path.join(workdir, 'payloads', str(size)),
+                                                latency=options.latency, bandwidth=options.bandwidth,
+                                                failure_rate=options.failure_rate, abort_rate=options.abort_rate)
+                try:
+                    paths, tasks = make_tasks(workdir, server.url, count)
+                    server.catalog = dict((path, size) for path in paths)
+                    server.prepare()
+                    payload_bytes = sum(int(server.payload(path)[1]['size']) for path in paths)
+
+                    scenarios = [('execute_tasks', execute_tasks), ('execute_tasks (warm)', execute_tasks)]
+                    if options.deploy:
+                        scenarios.append(('deploy_service', deploy_service))
+
+                    reset(workdir)
+                    for name, func in scenarios:
+                        if name == 'deploy_service':
+                            reset(workdir)
+                        results.append(run_scenario(name, server, func, tasks, workdir, options, size, payload_bytes))
+                        print(render(results[-1:]).splitlines()[-1], file=sys.stderr)
+                finally:
+                    server.shutdown()
+                    server.server_close()
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(render(results))
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
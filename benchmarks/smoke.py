@@ -0,0 +1,78 @@
+"""Offline smoke checks of deploy orchestration, runnable on a plain linux box without ssh.
+
+    $ python -m benchmarks.smoke
+
+Checks:
+    fleet_hide - a fabric.api helper wrapped in `hide`/`show` runs through fabric_utils.remote.Fleet.execute
+"""
+from __future__ import print_function
+
+import sys
+import traceback
+from StringIO import StringIO
+
+from fabric_utils.connections import RunResult
+
+
+class FakePool(object):
+    """fabric_utils.connections.SshPool that answers every command in process, commands are recorded per host"""
+
+    def __init__(self):
+        self.commands = []
+
+    def connect(self, host):
+        pass
+
+    def run(self, host, command, sudo_user=None, cwd=None, timeout=None):
+        self.commands.append((host, command))
+        return RunResult(command, '', 0)
+
+
+def fleet_hide():
+    from fabric import api
+    from fabric_utils.remote import Fleet
+
+    def helper():
+        with api.hide('running'):
+            first = api.run('echo first')
+        with api.show('output'):
+            second = api.sudo('echo second')
+        return [first, second]
+
+    hosts = ['host-%d' % i for i in range(4)]
+    pool = FakePool()
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        results = dict(Fleet(hosts, pool=pool, concurrency=len(hosts)).execute(helper))
+    finally:
+        output, sys.stdout = sys.stdout.getvalue(), stdout
+
+    failed = dict((host, result) for host, result in results.items() if isinstance(result, BaseException))
+    assert not failed, failed
+    assert all(results[host] == ['echo first', 'echo second'] for host in hosts), results
+    assert len(pool.commands) == 2 * len(hosts), pool.commands
+    for host in hosts:
+        assert '[%s] run: echo first' % host not in output, output
+        assert '[%s] run: echo second' % host in output, output
+    assert api.output.running, 'hide in a Fleet thread changed the shared fabric.state.output'
+
+
+CHECKS = [fleet_hide]
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+            print('ok     %s' % check.__name__)
+        except Exception:
+            failed += 1
+            print('FAILED %s' % check.__name__)
+            traceback.print_exc()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""Synthetic artifactory_model_tags.yml: worker -> model name -> {src, tag}, the format read by
+fabric_utils.delivery_tasks
+"""
+import yaml
+
+
+def make_tags_table(workers, models_per_worker, tag='bench'):
+    return dict(
+        ('worker%02d' % w, dict(
+            ('model%03d' % m, {'src': 'src%03d' % m, 'tag': tag})
+            for m in range(models_per_worker)
+        ))
+        for w in range(workers)
+    )
+
+
+def write_tags_table(path, workers, models_per_worker, tag='bench'):
+    with open(path, 'w') as f:
+        yaml.safe_dump(make_tags_table(workers, models_per_worker, tag=tag), f, default_flow_style=False)
@@ -0,0 +1,64 @@
+"""Mock deploy target: fabric.api run/sudo/put are answered in process instead of going over ssh.
+
+`fab load_artifacts` and `fab activate_artifacts` run the real artifactory pipeline against the fake
+artifactory, every other command only costs `command_latency` seconds, like a round trip to a remote host.
+"""
+import collections
+import contextlib
+import sys
+import time
+from StringIO import StringIO
+
+import fabric.api
+
+import artifactory.api
+from fabric_utils.connections import RunResult
+
+
+class MockTarget(object):
+    def __init__(self, tasks, store_path=None, command_latency=0.0, **execute_options):
+        """
+        :param tasks: artifactory tasks executed by `fab load_artifacts`
+        :param store_path: artifact store of the target
+        :param command_latency: seconds every command takes
+        :param execute_options: passed to artifactory.api.execute_tasks
+        """
+        self.tasks = tasks
+        self.store_path = store_path
+        self.command_latency = command_latency
+        self.execute_options = execute_options
+        self.commands = collections.Counter()
+
+    def execute(self, command, *args, **kwargs):
+        time.sleep(self.command_latency)
+        self.commands[command.split()[0]] += 1
+
+        if command.startswith('fab load_artifacts'):
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                artifactory.api.execute_tasks(
+                    self.tasks, store_path=self.store_path, staged='staged=1' in command, **self.execute_options
+                )
+                return RunResult(sys.stdout.getvalue(), '', 0)
+            finally:
+                sys.stdout = stdout
+        if command.startswith('fab activate_artifacts'):
+            artifactory.api.activate_tasks(self.tasks)
+
+        return RunResult('', '', 0)
+
+    def put(self, local_path=None, remote_path=None, *args, **kwargs):
+        time.sleep(self.command_latency)
+        self.commands['put'] += 1
+        return [remote_path]
+
+    @contextlib.contextmanager
+    def installed(self):
+        originals = fabric.api.run, fabric.api.sudo, fabric.api.put
+        fabric.api.run = fabric.api.sudo = self.execute
+        fabric.api.put = self.put
+        try:
+            with fabric.api.settings(host_string='mock'):
+                yield self
+        finally:
+            fabric.api.run, fabric.api.sudo, fabric.api.put = originals
@@ -1,30 +1,47 @@
 # coding: utf-8
 from __future__ import print_function
 
+import atexit
 import importlib
+import json
+import os
 import sys
-import time
-from itertools import izip_longest
 
 from fabric import api
-from fabric.decorators import task, parallel, serial
+from fabric.decorators import task, serial
 
 import artifactory.api
+import artifactory.mirror
+import fabric_utils.connections
 import fabric_utils.deploy
+import fabric_utils.fanout
+import fabric_utils.log_stream
+import fabric_utils.planner
+import fabric_utils.remote
+import fabric_utils.strategy
 import fabric_utils.tasks
+import fabric_utils.tracing
 import fabric_utils.utils
+from fabric_utils.connections import CONTROL_PERSIST
 from fabric_utils.context_managers import with_cd_to_git_root
 from fabric_utils.decorators import task_with_shortened_hosts, get_hosts_from_shorts
-from fabric_utils.delivery_tasks import collect_tasks
+from fabric_utils.delivery_tasks import collect_tasks, ARTIFACTORY_URL
 from fabric_utils.notifications import slack
-from fabric_utils.paths import GIT_ROOT, DATA_PATH
+from fabric_utils.paths import GIT_ROOT, DATA_PATH, ARTIFACTS_STORE_PATH
 from fabric_utils.patterns import kill_service_regex
 from fabric_utils.rabbit import create_queues as create_queues_routine
-from fabric_utils.utils import GitRef
+from fabric_utils.utils import GitRef, DeployOptions, to_bool
+from lazy_provider import CachingProvider
 
 api.env.use_ssh_config = True
 api.env.sudo_user = 'user'
 
+# с cache_credentials=1 credentials артифактори переживают запуски fab на хосте, чтобы каждый load_artifacts
+# не ходил за ними заново. Файл доступен только владельцу, но пароль в нем открытым текстом, поэтому это опция,
+# а cache_credentials=0 его удаляет
+ARTIFACTORY_CREDENTIALS_CACHE = os.path.join(DATA_PATH, '.artifactory_credentials.json')
+ARTIFACTORY_CREDENTIALS_TTL = 3600
+
 
 @task
 def set_git_ref(**kwargs):
@@ -32,6 +49,130 @@ def set_git_ref(**kwargs):
     api.env.git_ref = GitRef(**kwargs)
 
 
+@task
+def set_deploy_options(**kwargs):
+    """Устанавливает переменную окружения deploy_options, которая затем используется в deploy тасках
+
+        staged=1 - код и артефакты подтягиваются при работающем сервисе, артефакты распаковываются в новую
+            версию рядом с текущей, сервис останавливается только на время переключения версий и рестарта
+        retention=3 - сколько версий артефактов хранить в staged режиме
+        readiness_timeout=600 - сколько секунд rolling_deploy ждет готовности хостов очередной волны
+        canary=1, growth=2 - rolling_deploy начинает с canary хостов, каждая следующая волна в growth раз больше
+        max_wave=0 - максимальный размер волны, число или процент (max_wave=50%), 0 - без ограничения
+        min_healthy=1 - сколько хостов каждой роли (autoload/regular) всегда остается в работе
+        max_errors=-1 - волна считается неудачной, если на хосте после рестарта больше ошибок в логах, -1 - не проверять
+        fanout=3 - при подготовке (prestage) артефакты качаются из артифактори один раз и раздаются хостами
+            друг другу деревом с таким ветвлением, 0 - каждый хост качает сам
+        git_sync=full - как обновляется код: full - полный fetch на каждом хосте, shallow - fetch только нужной
+            ветки или коммита глубиной git_depth=1, bundle - fetch делает только деплой-хост и раздает хостам
+            git bundle с недостающими коммитами
+        prewarm_mb=0 - перед запуском сервиса файлы артефактов целевого коммита читаются в page cache, не больше
+            prewarm_mb мегабайт и половины свободной памяти хоста, 0 - половина свободной памяти (со staged=1 -
+            1024 мегабайта, так как старый экземпляр в это время еще работает), -1 - не прогревать
+        handover=1 - только со staged=1: сервис перезапускается без простоя, новый экземпляр запускается рядом
+            со старым на том же порту (SO_REUSEPORT, сервис должен открывать его только после готовности),
+            старый получает SIGTERM только после готовности нового и через drain_timeout=60 секунд - SIGKILL;
+            если новый не стал готов, артефакты возвращаются на прежние версии, старый продолжает работать,
+            а деплой прерывается, см. fabric_utils/handover.py
+
+        Usage:
+            $ fab set_deploy_options:staged=1 deploy:all
+    """
+    api.env.deploy_options = DeployOptions(**kwargs)
+
+
+@task
+@serial
+def plan(*selectors, **kwargs):
+    """Сравнивает целевое состояние хостов с текущим и печатает план деплоя по хостам
+
+    Целевое состояние - код git_ref (см. set_git_ref) и артефакты по таблице тегов из него. Состояние всех
+    хостов собирается одним параллельным запросом. План - нужно ли обновлять код и какие артефакты качать.
+    Следующие deploy, prestage и rolling_deploy выполняют только план: хосты без изменений не трогаются,
+    на остальных качаются только устаревшие артефакты, хосты с неработающим сервисом хотя бы перезапускаются.
+    Без следующих тасок - dry run.
+
+        cred_str= - credentials для артифактори в формате login:password
+        cache_credentials= - см. load_artifacts
+        json=1 - вывести план в json
+
+        Usage:
+            $ fab set_git_ref:branch=release plan:all
+            $ fab plan:all rolling_deploy:all
+    """
+    hosts = get_hosts_from_shorts(selectors)
+    deploy_plan = fabric_utils.planner.make_plan(
+        hosts,
+        fabric_utils.deploy.collect_hosts_status,
+        cred_str=artifactory_cred_str(kwargs.get('cred_str'), cache=kwargs.get('cache_credentials')),
+    )
+    api.env.deploy_plan = deploy_plan
+
+    if to_bool(kwargs.get('json', False)):
+        print(fabric_utils.planner.plan_to_json(deploy_plan))
+    else:
+        print(fabric_utils.planner.render_plan(deploy_plan))
+
+
+@task
+def trace(folder='deploy_trace', slack=False):
+    """Замеряет время фаз деплоя на каждом хосте (остановка, код, артефакты, запуск, ожидание готовности)
+
+    В конце запуска печатает сводную таблицу и пишет в folder report.json и trace.json для chrome://tracing.
+    slack=1 - добавить таблицу в уведомление rolling_deploy.
+
+        Usage:
+            $ fab trace:slack=1 set_deploy_options:staged=1 rolling_deploy:all
+    """
+    tracer = fabric_utils.tracing.Tracer(folder)
+    api.env.tracer = tracer
+    api.env.trace_slack = to_bool(slack)
+
+    def _report():
+        print('\n%s\n\ntrace is written to %s' % (tracer.finish(), os.path.abspath(folder)))
+
+    atexit.register(_report)
+
+
+@task
+def multiplex(*selectors, **kwargs):
+    """Включает мультиплексированные ssh соединения (OpenSSH ControlMaster) для следующих тасок
+
+    Соединения с хостами открываются один раз, параллельно, и переиспользуются status, error и ожиданием
+    готовности в rolling_deploy, а благодаря ControlPersist - и следующими запусками fab.
+
+        persist=600 - сколько секунд соединение живет без команд
+
+        Usage:
+            $ fab multiplex:all status:all error:all
+    """
+    hosts = get_hosts_from_shorts(selectors) if selectors else []
+    _, failed = fabric_utils.connections.enable(hosts, persist=int(kwargs.get('persist', CONTROL_PERSIST)))
+    for host, e in sorted(failed.items()):
+        print('%s: failed to open master connection: %s' % (host, e))
+
+
+@task
+def ssh_backend(*selectors, **kwargs):
+    """Выполняет следующие таски потоками через мультиплексированные ssh соединения вместо процессов fabric
+
+    Таски с сокращениями хостов (deploy:all, ...), status, error и ожидание готовности выполняются на всех хостах
+    одновременно, результаты собираются по мере готовности, см. fabric_utils.remote. sudo выполняется
+    без пароля (sudo -n).
+
+        concurrency=64 - сколько хостов обрабатывается одновременно
+        timeout=0 - сколько секунд дается каждому хосту на одну таску, 0 - без ограничения
+
+        Usage:
+            $ fab ssh_backend:all,concurrency=32 status:all
+    """
+    multiplex(*selectors)
+    api.env.remote_backend = {
+        'concurrency': int(kwargs.get('concurrency', fabric_utils.remote.DEFAULT_CONCURRENCY)),
+        'timeout': int(kwargs.get('timeout', 0)) or None,
+    }
+
+
 @task_with_shortened_hosts
 def clone_repo():
     """git clone или git reset --hard && git pull"""
@@ -52,22 +193,91 @@ def run():
     fabric_utils.deploy.run_service_script(script='service.py')
 
 
-@task_with_shortened_hosts
-def deploy():
+def deploy_on_hosts(selectors, executable_script):
+    """deploy_service на хостах, fetch для обновления кода делается один раз до запуска на хостах"""
+    hosts = get_hosts_from_shorts(selectors)
+    fabric_utils.deploy.prepare_code_sync()
+    fabric_utils.deploy.prepare_prewarm()
+
+    return fabric_utils.remote.execute(fabric_utils.deploy.deploy_service, hosts, executable_script=executable_script)
+
+
+@task
+def deploy(*selectors):
     """Останавливет сервис, подтягивает обновления кода и моделей, запускает service.py"""
-    fabric_utils.deploy.deploy_service(executable_script='service.py')
+    return deploy_on_hosts(selectors, 'service.py')
 
 
-@task_with_shortened_hosts
-def deploy_autoload():
+@task
+def deploy_autoload(*selectors):
     """То же, что и deploy, но для service-autoload.py"""
-    fabric_utils.deploy.deploy_service(executable_script='service-autoload.py')
+    return deploy_on_hosts(selectors, 'service-autoload.py')
 
 
-@task_with_shortened_hosts
-def deploy_autoload_check():
+@task
+def deploy_autoload_check(*selectors):
     """То же, что и deploy, но для service-autoload-check.py"""
-    fabric_utils.deploy.deploy_service(executable_script='service-autoload-check.py')
+    return deploy_on_hosts(selectors, 'service-autoload-check.py')
+
+
+@task
+@serial
+def prestage(*selectors):
+    """Параллельно на всех хостах подтягивает код и распаковывает новые версии артефактов, сервис не трогается
+
+        Переключение на подготовленные версии - deploy с set_deploy_options:staged=1 или rolling_deploy
+
+        Usage:
+            $ fab prestage:all
+    """
+    options = api.env.get('deploy_options', DeployOptions())
+    hosts = fabric_utils.planner.hosts_to_deploy(get_hosts_from_shorts(selectors))
+    fabric_utils.tasks.prestage_task(hosts, fanout=options.fanout)
+
+
+@task
+@serial
+def distribute(*selectors):
+    """Загружает артефакты на хосты, скачивая их из артифактори один раз и раздавая деревом с хоста на хост
+
+        Ветвление дерева - set_deploy_options:fanout=N, по умолчанию 3. Код на хостах должен быть уже обновлен.
+
+        Usage:
+            $ fab set_deploy_options:fanout=2 distribute:all
+    """
+    options = api.env.get('deploy_options', DeployOptions())
+    fabric_utils.fanout.fan_out(
+        get_hosts_from_shorts(selectors),
+        fanout=options.fanout or fabric_utils.fanout.DEFAULT_FANOUT,
+        staged=options.staged,
+    )
+
+
+@task
+@serial
+def prewarm(*selectors, **kwargs):
+    """Читает файлы артефактов в page cache на хостах, см. fabric_utils/prewarm.py
+
+        budget_mb=0 - не больше стольких мегабайт и половины свободной памяти хоста, 0 - половина свободной памяти
+        staged=0 - греть подготовленные staged версии артефактов (см. prestage), где они есть
+
+        Usage:
+            $ fab prewarm:all,budget_mb=8192,staged=1
+    """
+    host_to_report = fabric_utils.tasks.prewarm_task(
+        get_hosts_from_shorts(selectors), budget_mb=float(kwargs.get('budget_mb', 0)),
+        staged=to_bool(kwargs.get('staged', False)),
+    )
+    for host, report in sorted(host_to_report.items()):
+        if not report:
+            print('On {} prewarm failed'.format(host))
+            continue
+        print('On {}: {:.1f} MB in {} files warmed in {:.1f} s, {:.1f} MB in {} files over budget{}{}'.format(
+            host, report['bytes'] / 1024.0 ** 2, report['files'], report['seconds'],
+            report['skipped_bytes'] / 1024.0 ** 2, report['skipped_files'],
+            ', {} errors'.format(len(report['errors'])) if report['errors'] else '',
+            ', missing: {}'.format(', '.join(report['missing'])) if report.get('missing') else '',
+        ))
 
 
 @task_with_shortened_hosts
@@ -81,19 +291,23 @@ force_stop.__doc__ %= kill_service_regex
 
 @serial
 @task
-def error(*selectors):
-    """Считает количество ошибок на хостах"""
+def error(*selectors, **kwargs):
+    """Считает количество ошибок на хостах
 
-    @task
-    @parallel
-    @with_cd_to_git_root
-    def count():
-        return api.run('grep ERROR logs.txt | wc -l')
+        incremental=1 - читать только строки, дописанные в лог с прошлого запуска: количество строк каждого
+            уровня, частота в минуту с прошлого запуска и top самых частых ошибок
+        top=5 - сколько самых частых ошибок показывать в incremental режиме
 
+        Usage:
+            $ fab error:all,incremental=1,top=3
+    """
     hosts = get_hosts_from_shorts(selectors)
-    with api.hide('everything'):
-        host_to_counter_mapping = api.execute(count, hosts=hosts)
-    
+    if to_bool(kwargs.get('incremental', False)):
+        print(render_error_stats(fabric_utils.tasks.error_stats_task(hosts, top=int(kwargs.get('top', 5)))))
+        return
+
+    host_to_counter_mapping = fabric_utils.tasks.error_count_task(hosts)
+
     lines = []
     for host, counter in sorted(host_to_counter_mapping.items(), key=lambda (h, c): h):
         lines.append('On {} counted {} errors'.format(host, counter))
@@ -101,28 +315,139 @@ def error(*selectors):
     print('\n'.join(lines))
 
 
+def render_error_stats(host_to_stats):
+    lines = []
+    for host, stats in sorted(host_to_stats.items()):
+        if not stats:
+            lines.append('On {} log stats are unavailable'.format(host))
+            continue
+
+        levels = ', '.join('{} {}'.format(level, stats['levels'][level]) for level in ('ERROR', 'CRITICAL', 'WARNING'))
+        rate = ' ({:.1f} errors/min)'.format(stats['rates']['ERROR']) if stats['rates'] else ''
+        reset = ' [log {}]'.format(stats['reset']) if stats['reset'] else ''
+        lines.append('On {}: {}{}, {} since restart{}'.format(host, levels, rate, stats['totals']['ERROR'], reset))
+        for signature, count in stats['signatures']:
+            lines.append('\t{:>6}  {}'.format(count, signature.encode('utf-8')))
+
+    return '\n'.join(lines)
+
+
+def artifactory_cred_str(cred_str=None, cache=None):
+    """credentials для артифактори, по умолчанию - из global_settings
+
+    :param cred_str:
+    :param cache: аргумент cache_credentials таски: истина - сохранять credentials в ARTIFACTORY_CREDENTIALS_CACHE
+        на ARTIFACTORY_CREDENTIALS_TTL, ложь - удалить файл, оставшийся от прошлых запусков, None - файл не трогать
+        (им может пользоваться параллельный запуск)
+    """
+    if cache is not None:
+        cache = to_bool(cache)
+        if not cache and os.path.exists(ARTIFACTORY_CREDENTIALS_CACHE):
+            os.remove(ARTIFACTORY_CREDENTIALS_CACHE)
+    if cred_str:
+        return cred_str
+
+    sys.path.append(GIT_ROOT)
+    import global_settings
+
+    provider = global_settings.artifactory_credentials_provider
+    if cache:
+        provider = CachingProvider(
+            provider.provide_content,
+            ttl=ARTIFACTORY_CREDENTIALS_TTL,
+            persist_path=ARTIFACTORY_CREDENTIALS_CACHE,
+        )
+
+    cred_dict = provider.provide_content()
+    # из кеша строки приходят в unicode, str.format на не-ascii символах упал бы
+    return ':'.join(
+        value.encode('utf-8') if isinstance(value, unicode) else value
+        for value in (cred_dict['username'], cred_dict['password'])
+    )
+
+
 @task
 @with_cd_to_git_root
-def load_artifacts(cred_str=None, worker_name_mask='worker'):
+def load_artifacts(cred_str=None, worker_name_mask='worker', store_size_gb=0, staged=False, source=None,
+                   incremental=False, bandwidth_mb=None, order='critical', only=None, cache_credentials=None):
     """Загружает файлы из артифактори соогласно таблице тегов
     :param cred_str: credentials для артифактори в формате login:password
     :param worker_name_mask: маска для поиска папки с воркером, по умолчанию '*'
+    :param store_size_gb: размер локального хранилища скачанных артефактов в гигабайтах, 0 - не использовать.
+        Хранилище занимает до store_size_gb гигабайт сверх распакованных артефактов: каждый скачанный архив
+        лежит на диске дважды, в хранилище и распакованным
+    :param staged: только подготовить новые версии артефактов, переключение - через activate_artifacts
+    :param source: адрес зеркала артифактори (см. serve_artifacts), по умолчанию качается из самой артифактори
+    :param incremental: из архивов записывать на диск только изменившиеся файлы
+    :param bandwidth_mb: ограничение суммарной скорости загрузки в мегабайтах в секунду
+    :param order: порядок загрузки: critical (сначала общие библиотеки), largest (сначала большие) или as_is
+    :param only: загрузить только эти артефакты - папки относительно data через `;`, см. таску plan
+    :param cache_credentials: 1 - сохранить credentials из global_settings на диске на час, чтобы следующие запуски
+        не запрашивали их заново (пароль в файле хранится открытым текстом), 0 - удалить сохраненные
+    """
+    tasks = collect_tasks(worker_name_mask=worker_name_mask, artifactory_url=source)
+    if only is not None:
+        folders = set(only.split(';'))
+        tasks = [task for task in tasks if fabric_utils.planner.artifact_folder(task) in folders]
+
+    cred_str = artifactory_cred_str(cred_str, cache=cache_credentials)
+
+    store_size_cap = int(float(store_size_gb) * 1024 ** 3)
+    artifactory.api.execute_tasks(
+        tasks,
+        cred_str,
+        store_path=ARTIFACTS_STORE_PATH if store_size_cap else None,
+        store_size_cap=store_size_cap,
+        staged=to_bool(staged),
+        incremental=to_bool(incremental),
+        bandwidth=int(float(bandwidth_mb) * 1024 ** 2) if bandwidth_mb else None,
+        order=order,
+    )
+
+
+@task
+@with_cd_to_git_root
+def activate_artifacts(worker_name_mask='worker', retention=3):
+    """Переключает артефакты на версии, подготовленные load_artifacts:staged=1, и удаляет старые версии
+    :param worker_name_mask: маска для поиска папки с воркером, по умолчанию '*'
+    :param retention: сколько последних версий каждого артефакта хранить
     """
     tasks = collect_tasks(worker_name_mask=worker_name_mask)
+    artifactory.api.activate_tasks(tasks, retention=int(retention))
+
 
-    if not cred_str:
-        sys.path.append(GIT_ROOT)
-        import global_settings
+@task
+@with_cd_to_git_root
+def rollback_artifacts(worker_name_mask='worker'):
+    """Возвращает артефакты на версии, которые были активны до последнего activate_artifacts
+    :param worker_name_mask: маска для поиска папки с воркером, по умолчанию '*'
+    """
+    tasks = collect_tasks(worker_name_mask=worker_name_mask)
+    artifactory.api.rollback_tasks(tasks)
 
-        cred_dict = global_settings.artifactory_credentials_provider.provide_content()
-        cred_str = '{0[username]}:{0[password]}'.format(cred_dict)
 
-    artifactory.api.execute_tasks(tasks, cred_str)
+@task
+@with_cd_to_git_root
+def serve_artifacts(address, upstream=ARTIFACTORY_URL, port=artifactory.mirror.DEFAULT_PORT, store_size_gb=50):
+    """Поднимает зеркало артифактори, раздающее артефакты из локального хранилища (см. distribute)
+    :param address: адрес, на котором слушает зеркало - тот, по которому хост доступен остальным хостам деплоя
+    :param upstream: откуда брать недостающие артефакты: артифактори или зеркало на другом хосте
+    :param port:
+    :param store_size_gb: размер локального хранилища скачанных артефактов в гигабайтах, занимается сверх
+        распакованных артефактов хоста
+    """
+    artifactory.mirror.serve(
+        upstream,
+        ARTIFACTS_STORE_PATH,
+        address,
+        port=int(port),
+        store_size_cap=int(float(store_size_gb) * 1024 ** 3),
+    )
 
 
 @task_with_shortened_hosts
 def invalidate_artifactory_cache():
-    """Очищает кеш загрузок из артифактори"""
+    """Очищает кеш загрузок из артифактори (хранилище артефактов по чексуммам не трогается)"""
     api.run('find %s -name "%s" -type f -delete' % (DATA_PATH, artifactory.api.info_file))
 
 
@@ -135,35 +460,36 @@ def grep(grep_str=''):
 
 @task
 @serial
-def tail(*selectors):
-    """multitail -f со всех хостов. может использоваться в связке с таской `grep`
+def tail(*selectors, **kwargs):
+    """multitail -f со всех хостов в один поток, упорядоченный по времени. может использоваться в связке с таской `grep`
+
+    Строки фильтруются на хостах, при обрыве соединения хост переподключается и дочитывает лог.
+
+        regex= - оставлять строки, в которых есть python regex, invert=1 - строки, в которых его нет
+        levels= - оставлять строки этих уровней, например levels=ERROR;CRITICAL
+        sample=1 - оставлять каждую sample-ю строку
+        rate=0 - не больше rate строк в секунду с хоста, 0 - без ограничения
+        output= - дополнительно писать общий поток в локальный файл
 
         Usage:
             $ fab grep:'-v "INFO\|WARNING"' tail:all,x01,x07
-
+            $ fab tail:all,levels=ERROR;CRITICAL,rate=20,output=errors.log
     """
-
-    @task
-    @parallel
-    def _tail(filename):
-        cmd = 'tail -f %s' % filename
-
-        try:
-            grep_str = api.env.grep_str
-            cmd = "%s | grep %s" % (cmd, grep_str)
-        except AttributeError:
-            pass
-
-        try:
-            api.run(cmd)
-        except (KeyboardInterrupt, IOError):
-            pass
-
     hosts = get_hosts_from_shorts(selectors)
     log_file_path = '/var/local/service/logs.txt'
 
-    with api.settings(linewise=True):
-        api.execute(_tail, log_file_path, hosts=hosts)
+    log_filter = fabric_utils.log_stream.LogFilter(
+        regex=kwargs.get('regex', ''),
+        invert=to_bool(kwargs.get('invert', False)),
+        # запятая в аргументах fab разделяет аргументы
+        levels=kwargs.get('levels', '').replace(';', ','),
+        sample=kwargs.get('sample', 1),
+        rate=kwargs.get('rate', 0),
+        grep_str=api.env.get('grep_str'),
+    )
+    fabric_utils.log_stream.LogStream(
+        hosts, log_file_path, log_filter=log_filter, output_file=kwargs.get('output'),
+    ).run()
 
 
 @task
@@ -181,9 +507,21 @@ def create_queues(rabbitmq_connection_string, path_to_job_settings):
 
 @task
 @serial
-def status(*selectors):
-    """Собирает информацию о версии кода на хостах + readiness status"""
-    output = fabric_utils.deploy.status(*selectors)
+def status(*selectors, **kwargs):
+    """Собирает информацию о версии кода на хостах + readiness status
+
+        Все собирается одним запросом на хост. git fetch делается не чаще раза в минуту, fetch_ttl=0 - всегда,
+        fetch_ttl=-1 - никогда. json=1 - вывести полный статус хостов (включая версии артефактов) в json.
+
+        Usage:
+            $ fab status:all,fetch_ttl=-1
+    """
+    fetch_ttl = int(kwargs.get('fetch_ttl', fabric_utils.deploy.STATUS_FETCH_TTL))
+    if to_bool(kwargs.get('json', False)):
+        host_to_status = fabric_utils.deploy.collect_status(selectors, fetch_ttl=fetch_ttl)
+        output = json.dumps(host_to_status, indent=2, sort_keys=True)
+    else:
+        output = fabric_utils.deploy.status(*selectors, fetch_ttl=fetch_ttl)
     print(output)
 
 
@@ -196,10 +534,15 @@ def rolling_deploy(*selectors):
         $ GIT_ROOT=/var/local/service fab deploy_autoload_check:05 deploy_autoload:06,07
 
 
-    Хосты обрабатываются группами по 3. После деплоя на очередную группу хостов в цикле раз в 10 секунд
-    проверяются readiness probe на каждом хосте. Деплой на группу хостов считается успешным, если все
-    хосты успешно прошли readiness probe. Следующая группа хостов берется в работу только если предыдущая
-    была успешно завершена.
+    Хосты обрабатываются волнами: сначала canary, затем волны растут в growth раз (см. set_deploy_options),
+    хосты одной волны деплоятся параллельно, в работе всегда остается min_healthy хостов каждой роли.
+    После деплоя на очередную волну на каждом хосте ждем, пока он не пройдет readiness probe. Деплой на волну
+    считается успешным, если все хосты прошли readiness probe за readiness_timeout секунд и, если задан
+    max_errors, насчитали не больше max_errors ошибок в логах. Следующая волна берется в работу только
+    если предыдущая была успешно завершена, иначе деплой прерывается.
+
+    С set_deploy_options:staged=1 код и артефакты сначала параллельно готовятся на всех хостах (см. prestage),
+    а волны хостов только переключаются на подготовленные версии и перезапускаются.
 
     """
     hosts_to_skip = [
@@ -211,40 +554,33 @@ def rolling_deploy(*selectors):
         lambda host: all(to_skip_pattern not in host for to_skip_pattern in hosts_to_skip),
         hosts_to_run
     )
+    # с планом (см. таску plan) хосты без изменений не деплоятся
+    hosts_to_run = fabric_utils.planner.hosts_to_deploy(hosts_to_run)
+    if not hosts_to_run:
+        print('\nAll hosts are up to date, nothing to deploy')
+        return
 
-    waves_str = '~~~~~~~~~~~~~~~~~~~~'
-
-    def grouper(n, iterable, fillvalue=None):
-        "grouper(3, 'ABCDEFG', 'x') --> ABC DEF Gxx"
-        args = [iter(iterable)] * n
-        return izip_longest(fillvalue=fillvalue, *args)
-
-    @task
-    @serial
-    def _deploy_task():
-        fabric_utils.deploy.deploy_service(executable_script='service.py')
-
-    for current_hosts_to_run in grouper(1, hosts_to_run):
-        current_hosts_to_run = filter(None, current_hosts_to_run)
-        if not current_hosts_to_run:
-            break
-
-        print('\n\n\n%s\n\tdeploy to %s\n%s' % (waves_str, ', '.join(current_hosts_to_run), waves_str))
-        api.execute(_deploy_task, hosts=current_hosts_to_run)
+    waves_str = fabric_utils.strategy.waves_str
+    options = api.env.get('deploy_options', DeployOptions())
 
-        print('\n\t waiting for readiness probing.', end='')
+    def _deploy():
+        if options.staged:
+            fabric_utils.deploy.switch_to_prestaged(executable_script='service.py', retention=options.retention)
+        else:
+            fabric_utils.deploy.deploy_service(executable_script='service.py')
 
-        while True:
-            time.sleep(10)
-            print('.', end='')
+    if options.staged:
+        print('\n\n\n%s\n\tprestage on %s\n%s' % (waves_str, ', '.join(hosts_to_run), waves_str))
+        fabric_utils.tasks.prestage_task(hosts_to_run, fanout=options.fanout)
 
-            alive = fabric_utils.tasks.readiness_probe_task(current_hosts_to_run)
-            if all(x is True for x in alive.values()):
-                break
+    fabric_utils.strategy.rollout(hosts_to_run, _deploy, options)
 
     try:
         output = fabric_utils.deploy.status('all')
         msg = 'service was deployed!\n```%s```' % output
+        tracer = fabric_utils.tracing.get_tracer()
+        if tracer and api.env.get('trace_slack'):
+            msg += '\n```%s```' % fabric_utils.tracing.render_summary(tracer.spans())
         slack('#service-deploy', msg)
     except Exception as e:
         print("Can't send notification, skip this step.", file=sys.stderr)
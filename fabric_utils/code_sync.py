@@ -0,0 +1,137 @@
+# coding: utf-8
+"""Раздача кода хостам через git bundle вместо git fetch с сервера на каждом хосте
+
+Деплой-хост один раз за запуск делает fetch целевой ветки или коммита (resolve_target), для каждого хоста
+собирает bundle только с теми коммитами, которых на хосте еще нет, и закачивает его на хост. Bundle для
+одинаковой пары (целевой коммит, коммит на хосте) собирается один раз и кешируется в BUNDLES_PATH,
+поэтому при обычном деплое, когда все хосты стоят на одном коммите, он один на всех.
+"""
+import fcntl
+import os
+import pipes
+import tempfile
+import threading
+
+from fabric import api
+
+import fabric_utils.tracing
+from fabric_utils.paths import GIT_ROOT
+from fabric_utils.svc import GitTreeHandler as git, BUNDLE_REF
+
+BUNDLES_PATH = os.path.join(tempfile.gettempdir(), 'fab-bundles')
+
+# сборка bundle идет через общий BUNDLE_REF, поэтому одновременно собирается только один: lock - между потоками
+# Fleet, flock - между процессами @parallel тасок
+_bundle_lock = threading.Lock()
+
+
+def local_git(*args, **kwargs):
+    cmd = 'git -C %s %s' % (pipes.quote(GIT_ROOT), ' '.join(pipes.quote(arg) for arg in args))
+    with api.settings(warn_only=kwargs.get('warn_only', False)), api.hide('everything'):
+        return api.local(cmd, capture=True)
+
+
+def has_commit(sha):
+    return local_git('cat-file', '-e', '%s^{commit}' % sha, warn_only=True).succeeded
+
+
+def is_ancestor(ancestor, descendant):
+    return local_git('merge-base', '--is-ancestor', ancestor, descendant, warn_only=True).succeeded
+
+
+def resolve_target(git_ref):
+    """sha целевого коммита, fetch с git сервера - один раз за запуск fab"""
+    resolved = api.env.setdefault('git_sync_targets', {})
+    key = (git_ref.branch, git_ref.commit)
+    if key in resolved:
+        return resolved[key]
+
+    with fabric_utils.tracing.phase('git.resolve_target'):
+        if git_ref.branch:
+            local_git('fetch', 'origin', '+refs/heads/%s:refs/remotes/origin/%s' % (git_ref.branch, git_ref.branch))
+            resolved[key] = local_git('rev-parse', 'origin/%s^{commit}' % git_ref.branch).strip()
+        else:
+            if not has_commit(git_ref.commit):
+                local_git('fetch', 'origin')
+            resolved[key] = local_git('rev-parse', '%s^{commit}' % git_ref.commit).strip()
+
+    return resolved[key]
+
+
+def build_bundle(target, basis=None):
+    """Путь к bundle с коммитом target без истории, достижимой из basis. basis=None - bundle со всей историей"""
+    name = '%s-%s.bundle' % (target[:12], basis[:12] if basis else 'full')
+    path = os.path.join(BUNDLES_PATH, name)
+    if os.path.exists(path):
+        return path
+
+    if not os.path.isdir(BUNDLES_PATH):
+        try:
+            os.makedirs(BUNDLES_PATH)
+        except OSError:
+            # создана другим хостом
+            if not os.path.isdir(BUNDLES_PATH):
+                raise
+
+    with _bundle_lock, open(os.path.join(BUNDLES_PATH, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            # собран другим хостом, пока этот ждал
+            return path
+
+        fd, tmp_path = tempfile.mkstemp(dir=BUNDLES_PATH, prefix=name, suffix='.tmp')
+        os.close(fd)
+        try:
+            with fabric_utils.tracing.phase('git.bundle_build') as span:
+                local_git('update-ref', BUNDLE_REF, target)
+                local_git('bundle', 'create', tmp_path, BUNDLE_REF, *(['^%s' % basis] if basis else []))
+                os.rename(tmp_path, path)
+                span['bytes'] = os.path.getsize(path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return path
+
+
+def sync_from_bundle(path, git_ref, depth=0):
+    """Обновляет код на текущем хосте до git_ref через bundle, собранный на деплой-хосте
+
+    Если репозитория на хосте нет, он клонируется с git сервера (shallow, если depth).
+    Есть ли на хосте целевой коммит, проверяется на самом хосте: в shallow репозитории предков HEAD может не быть.
+    """
+    target = resolve_target(git_ref)
+    head = git.head(path)
+    if head is None:
+        git.clone(path, git_ref, depth=depth)
+        return
+
+    if head == target or git.has_commit(path, target):
+        # целевой коммит на хосте уже есть (например, откат на недавний коммит), достаточно передвинуть ветку
+        git.pull_bundle(path, git_ref, None, target)
+        return
+
+    bundle = build_bundle(target, bundle_basis(path, head, target))
+    remote_bundle = '/tmp/%s' % os.path.basename(bundle)
+    with api.hide('everything'), fabric_utils.tracing.phase('git.bundle_upload', bytes=os.path.getsize(bundle)):
+        api.put(bundle, remote_bundle)
+    git.pull_bundle(path, git_ref, remote_bundle, target)
+
+
+def bundle_basis(path, head, target):
+    """Коммит, история до которого в bundle не нужна, None - bundle со всей историей
+
+    В shallow репозитории на хосте есть только head без предков, поэтому история до head отрезается, только если
+    target - потомок head, иначе bundle ссылался бы на коммиты, которых на хосте нет.
+    """
+    if not has_commit(head):
+        return None
+    if is_ancestor(head, target) or not git.is_shallow(path):
+        return head
+
+    return None
+
+
+def prepare(git_ref):
+    """Вызывается до @parallel тасок, чтобы fetch на деплой-хосте сделал родительский процесс, а не каждый хост"""
+    resolve_target(git_ref)
@@ -0,0 +1,174 @@
+# coding: utf-8
+import multiprocessing.dummy
+import os
+import pipes
+import signal
+import subprocess
+import threading
+
+from fabric import api
+
+CONTROL_DIR = os.path.expanduser('~/.ssh/fab-mux')
+# сколько секунд мастер-соединение живет без сессий, в том числе между запусками fab
+CONTROL_PERSIST = 600
+CONNECT_TIMEOUT = 10
+# как у coreutils timeout
+TIMEOUT_RETURN_CODE = 124
+
+
+class RunResult(str):
+    """stdout команды с атрибутами, как у результата fabric.api.run"""
+
+    def __new__(cls, stdout, stderr, return_code):
+        result = super(RunResult, cls).__new__(cls, stdout.rstrip('\r\n'))
+        result.stderr = stderr
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        return result
+
+
+def communicate(proc, timeout=None):
+    """Результат процесса как RunResult, процесс убивается, если не завершился за timeout секунд"""
+    timer = threading.Timer(timeout, proc.kill) if timeout else None
+    if timer:
+        timer.start()
+    try:
+        stdout, stderr = proc.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+
+    if timer and proc.returncode == -signal.SIGKILL:
+        return RunResult(stdout, stderr + 'timed out after %s seconds' % timeout, TIMEOUT_RETURN_CODE)
+
+    return RunResult(stdout, stderr or '', proc.returncode)
+
+
+class SshPool(object):
+    """Пул мультиплексированных ssh соединений, по одному OpenSSH ControlMaster на хост.
+
+    Мастер-соединение открывается один раз (см. warm), каждая следующая команда на хосте - это только
+    открытие канала в уже установленном соединении, без tcp и ssh хендшейка. Сокеты мастеров лежат в control_dir
+    и живут persist секунд после последней команды, так что ими пользуются и следующие запуски fab.
+    Настройки хостов берутся из ~/.ssh/config, как и у fabric с use_ssh_config.
+    """
+
+    def __init__(self, control_dir=CONTROL_DIR, persist=CONTROL_PERSIST, connect_timeout=CONNECT_TIMEOUT):
+        self.control_dir = control_dir
+        self.persist = persist
+        self.connect_timeout = connect_timeout
+
+        if not os.path.isdir(control_dir):
+            os.makedirs(control_dir, 0o700)
+
+    def control_path(self, host):
+        return os.path.join(self.control_dir, '%s.sock' % host)
+
+    def _ssh(self, host, *options):
+        return [
+            'ssh',
+            '-o', 'ControlPath=%s' % self.control_path(host),
+            '-o', 'BatchMode=yes',
+            '-o', 'ConnectTimeout=%d' % self.connect_timeout,
+        ] + list(options)
+
+    def is_connected(self, host):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(self._ssh(host, '-O', 'check', host), stdout=devnull, stderr=devnull) == 0
+
+    def connect(self, host):
+        if self.is_connected(host):
+            return
+
+        subprocess.check_call(self._ssh(
+            host,
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPersist=%d' % self.persist,
+            '-N', '-f',
+            host,
+        ))
+
+    def warm(self, hosts):
+        """Параллельно открывает мастер-соединения, возвращает host -> исключение для неудачных хостов"""
+
+        def _connect(host):
+            try:
+                self.connect(host)
+            except Exception as e:
+                return host, e
+
+            return host, None
+
+        pool = multiprocessing.dummy.Pool(max(1, len(hosts)))
+        try:
+            return dict((host, e) for host, e in pool.map(_connect, hosts) if e is not None)
+        finally:
+            pool.close()
+
+    def run(self, host, command, sudo_user=None, cwd=None, timeout=None):
+        """Выполняет команду на хосте через мастер-соединение
+
+        :param sudo_user: выполнить от имени пользователя через sudo -n (без запроса пароля)
+        :param cwd: папка, в которой выполняется команда
+        :param timeout: через сколько секунд прервать команду, return_code будет TIMEOUT_RETURN_CODE
+        :return: RunResult, если хост недоступен - с return_code 255, как у ssh
+        """
+        try:
+            proc = self.popen(host, command, sudo_user=sudo_user, cwd=cwd, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as e:
+            return RunResult('', str(e), 255)
+
+        return communicate(proc, timeout)
+
+    def copy(self, host, source, destination, upload=True, timeout=None):
+        """scp через мастер-соединение: upload - source локальный, destination на хосте, иначе наоборот"""
+        try:
+            self.connect(host)
+        except (OSError, subprocess.CalledProcessError) as e:
+            return RunResult('', str(e), 255)
+
+        remote = '%s:%s' % (host, destination if upload else source)
+        args = [source, remote] if upload else [remote, destination]
+        proc = subprocess.Popen(
+            ['scp', '-q'] + self._ssh(host)[1:] + args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        return communicate(proc, timeout)
+
+    def popen(self, host, command, sudo_user=None, cwd=None, stderr=None, stdin=None):
+        """Запускает команду на хосте и возвращает subprocess.Popen с stdout в pipe, для потокового чтения"""
+        self.connect(host)
+
+        if cwd:
+            command = 'cd %s && %s' % (pipes.quote(cwd), command)
+        command = '/bin/bash -l -c %s' % pipes.quote(command)
+        if sudo_user:
+            command = 'sudo -n -u %s %s' % (pipes.quote(sudo_user), command)
+
+        return subprocess.Popen(
+            self._ssh(host, '-o', 'ControlMaster=no', host, command),
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        )
+
+    def close(self, hosts):
+        with open(os.devnull, 'w') as devnull:
+            for host in hosts:
+                subprocess.call(self._ssh(host, '-O', 'exit', host), stdout=devnull, stderr=devnull)
+
+
+def get_pool():
+    """Пул, включенный таской multiplex, или None"""
+    return api.env.get('ssh_pool')
+
+
+def enable(hosts=(), persist=CONTROL_PERSIST):
+    pool = SshPool(persist=persist)
+    api.env.ssh_pool = pool
+    failed = pool.warm(list(hosts)) if hosts else {}
+
+    return pool, failed
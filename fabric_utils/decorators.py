@@ -5,6 +5,7 @@ from functools import wraps
 from fabric import api
 from fabric.decorators import task
 
+import fabric_utils.remote
 from fabric_utils.hosts import all_hosts_container
 
 
@@ -60,7 +61,7 @@ def task_with_shortened_hosts(task_):
     @wraps(task_)
     def enhanced_with_hosts_task(*selectors):
         hosts = get_hosts_from_shorts(selectors)
-        results = api.execute(task_, hosts=hosts)
+        results = fabric_utils.remote.execute(task_, hosts)
 
         return results
 
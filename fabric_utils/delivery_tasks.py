@@ -8,13 +8,20 @@ import yaml
 
 from fabric_utils.paths import DATA_PATH, ARTIFACTORY_MODEL_TAGS_TABLE_PATH
 
-ARTIFACTORY_URL_PREFIX = 'http://artifactory/service-local'
-ARTIFACTORY_INFO_PREFIX = 'http://artifactory/api/storage/service-local'
+ARTIFACTORY_URL = 'http://artifactory'
+ARTIFACTORY_REPO = 'service-local'
+ARTIFACTORY_URL_PREFIX = '%s/%s' % (ARTIFACTORY_URL, ARTIFACTORY_REPO)
+ARTIFACTORY_INFO_PREFIX = '%s/api/storage/%s' % (ARTIFACTORY_URL, ARTIFACTORY_REPO)
 
 
-def _collect_tasks_for_models_loading(worker_name_mask):
-    with open(ARTIFACTORY_MODEL_TAGS_TABLE_PATH) as f:
-        tags_table = yaml.load(f.read())
+def load_tags_table(path=ARTIFACTORY_MODEL_TAGS_TABLE_PATH):
+    with open(path) as f:
+        return yaml.load(f.read())
+
+
+def _collect_tasks_for_models_loading(worker_name_mask, tags_table=None):
+    if tags_table is None:
+        tags_table = load_tags_table()
 
     tasks = []
     for worker, model_name_to_src_tag_mapping in tags_table.items():
@@ -34,38 +41,56 @@ def _collect_tasks_for_models_loading(worker_name_mask):
     return tasks
 
 
-def collect_tasks(worker_name_mask):
+def collect_tasks(worker_name_mask, artifactory_url=None, tags_table=None):
+    """
+    :param worker_name_mask:
+    :param artifactory_url: адрес артифактори или совместимого с ним зеркала (см. artifactory.mirror),
+        по умолчанию ARTIFACTORY_URL
+    :param tags_table: таблица тегов, по умолчанию читается из ARTIFACTORY_MODEL_TAGS_TABLE_PATH
+    :return:
+    """
+    if artifactory_url:
+        url_prefix = '%s/%s' % (artifactory_url.rstrip('/'), ARTIFACTORY_REPO)
+        info_prefix = '%s/api/storage/%s' % (artifactory_url.rstrip('/'), ARTIFACTORY_REPO)
+    else:
+        url_prefix, info_prefix = ARTIFACTORY_URL_PREFIX, ARTIFACTORY_INFO_PREFIX
+
+    # priority: общие библиотеки и данные нужны всем воркерам, они качаются раньше моделей
     tasks = [
         # vertica
         {
             '__uri': 'libs/vertica/libverticaodbc-latest.tar.gz',
+            'priority': 1,
             'destination': {'folder': os.path.abspath(os.path.join(DATA_PATH, 'vertica'))},
         },
         # wordforms
         {
             '__uri': 'common/wordforms-latest.tar.gz',
+            'priority': 1,
             'destination': {'folder': os.path.abspath(os.path.join(DATA_PATH, 'common', 'wordforms'))},
         },
         # features
         {
             '__uri': 'features/Data-latest.tar.gz',
+            'priority': 1,
             'destination': {'folder': os.path.abspath(os.path.join(DATA_PATH, 'Data'))},
         },
         {
             '__uri': 'common/vin_parsing-20180502.tar.gz',
+            'priority': 1,
             'destination': {'folder': os.path.abspath(os.path.join(DATA_PATH, 'common', 'vin_parsing'))},
         },
     ]
 
     # models
-    models_tasks = _collect_tasks_for_models_loading(worker_name_mask)
+    models_tasks = _collect_tasks_for_models_loading(worker_name_mask, tags_table=tags_table)
     tasks += models_tasks
 
     for task in tasks:
         uri = task.pop('__uri')
         task.update({
-            'url': '%s/%s' % (ARTIFACTORY_URL_PREFIX, uri),
-            'info_url': '%s/%s' % (ARTIFACTORY_INFO_PREFIX, uri)
+            'url': '%s/%s' % (url_prefix, uri),
+            'info_url': '%s/%s' % (info_prefix, uri)
         })
 
     return tasks
@@ -2,51 +2,260 @@
 from __future__ import print_function
 
 import collections
+import json
 
 from fabric import api
 from fabric.decorators import task, parallel
 from fabric.exceptions import NetworkError
 
+import artifactory.stats
+import fabric_utils.code_sync
+import fabric_utils.handover
+import fabric_utils.planner
+import fabric_utils.prewarm
+import fabric_utils.remote
+import fabric_utils.status_probe
+import fabric_utils.tracing
 import fabric_utils.utils
 from fabric_utils.context_managers import with_cd_to_git_root
 from fabric_utils.decorators import get_hosts_from_shorts
-from fabric_utils.paths import GIT_ROOT
+from fabric_utils.paths import GIT_ROOT, DATA_PATH
 from fabric_utils.patterns import kill_service_regex
 from fabric_utils.svc import GitTreeHandler as git
-from fabric_utils.utils import GitRef
+from fabric_utils.utils import GitRef, DeployOptions
 
 api.env.use_ssh_config = True
 api.env.sudo_user = 'user'
 
+# git fetch в status делается не чаще, чем раз в столько секунд
+STATUS_FETCH_TTL = 60
+# сколько потоков читают файлы артефактов при прогреве page cache
+PREWARM_THREADS = 8
+# бюджет прогрева в мегабайтах при переключении staged версий, если prewarm_mb=0: прогрев идет, пока старый
+# экземпляр еще работает, и половина свободной памяти вытеснила бы из page cache его собственные файлы
+STAGED_PREWARM_MB = 1024
 
+
+@fabric_utils.tracing.traced('start')
 @with_cd_to_git_root
 def run_service_script(script):
-    _cmd = 'OMP_NUM_THREADS=1 nohup python %s &> logs.txt &' % script
+    # SO_REUSEPORT, чтобы следующий деплой мог запустить новый экземпляр рядом с этим, см. fabric_utils/handover.py;
+    # там же контракт: с SERVICE_HEALTH_PORT сервис открывает основной порт только после готовности
+    _cmd = 'OMP_NUM_THREADS=1 SERVICE_REUSE_PORT=1 nohup python %s &> logs.txt &' % script
     cmd = "bash -c '%s'" % _cmd
     api.sudo(cmd, pty=False)
 
 
+def handover_cmd(script, ready_timeout, drain_timeout):
+    args = [
+        GIT_ROOT, script, 'logs.txt', kill_service_regex, fabric_utils.utils.HANDOVER_HEALTH_PORT,
+        ready_timeout, drain_timeout,
+    ]
+    return fabric_utils.utils.inline_script_cmd(fabric_utils.handover, args)
+
+
+def handover_service_script(script, ready_timeout=fabric_utils.utils.READINESS_TIMEOUT,
+                            drain_timeout=fabric_utils.utils.DRAIN_TIMEOUT):
+    """Перезапуск без простоя: новый экземпляр запускается рядом со старым, старый останавливается только
+    после готовности нового, см. fabric_utils/handover.py
+
+    Без простоя - только если сервис соблюдает контракт из fabric_utils/handover.py: новый экземпляр открывает
+    основной порт (SO_REUSEPORT) лишь после того, как готов, иначе часть запросов уйдет к неготовому экземпляру.
+
+    Если новый сразу завершился из-за занятого порта (старый запущен без SO_REUSEPORT), сервис перезапускается
+    как обычно.
+    :return: сводка handover, result - handover или exited, если новый экземпляр работает; иначе (not_ready,
+        no_health_port) он не запущен, и работает старый
+    """
+    with fabric_utils.tracing.phase('handover') as span:
+        output = api.sudo(handover_cmd(script, ready_timeout, drain_timeout), pty=False)
+        report = json.loads(output.splitlines()[-1])
+        span.update(report)
+
+    if report['result'] == 'exited':
+        print('New instance exited, port is in use, restarting %s with downtime, see logs.txt' % script)
+        force_stop_service_process()
+        run_service_script(script)
+
+    return report
+
+
+@fabric_utils.tracing.traced('stop')
 def force_stop_service_process():
     with api.settings(warn_only=True):
         api.sudo('pkill --signal 9 -f "%s"' % kill_service_regex)
 
 
-def deploy_service(executable_script='service.py'):
+def deploy_service(executable_script='service.py', options=None):
+    """Если задан план (см. fabric_utils.planner), выполняется только он: хост без изменений не трогается"""
+    options = options or api.env.get('deploy_options', DeployOptions())
+    host_plan = fabric_utils.planner.current_plan()
+    if host_plan and fabric_utils.planner.is_noop(host_plan):
+        print('%s is up to date, skip' % host_plan.host)
+        return
+
+    if options.staged:
+        return deploy_service_staged(executable_script, retention=options.retention, host_plan=host_plan)
+
     force_stop_service_process()
+    if not host_plan or fabric_utils.planner.needs_code_update(host_plan):
+        clone_or_pull_service_repo()
+
+    with api.cd(GIT_ROOT):
+        delete_pyc()
+        if not host_plan or host_plan.fetch:
+            load_artifacts(fabric_utils.planner.load_artifacts_cmd(host_plan))
+        prewarm(options.prewarm_mb, host_plan=host_plan)
+        run_service_script(executable_script)
+
+
+@fabric_utils.tracing.traced('clean_pyc')
+def delete_pyc():
+    api.sudo('find . -name \*.pyc -delete')
+
+
+def load_artifacts(cmd):
+    """Запускает загрузку артефактов на хосте, в trace попадает ее сводка, см. artifactory.stats"""
+    with fabric_utils.tracing.phase('load_artifacts') as span:
+        output = api.sudo(cmd)
+        span.update(artifactory.stats.parse(output) or {})
+
+
+def prewarm_cmd(folders, budget_mb=0, threads=PREWARM_THREADS, staged=False):
+    args = [DATA_PATH, budget_mb, threads, int(staged)] + list(folders)
+    return fabric_utils.utils.inline_script_cmd(fabric_utils.prewarm, args)
+
+
+def prepare_prewarm(budget_mb=None):
+    """Папки для прогрева по таблице тегов целевого коммита, вычисляются до запуска @parallel тасок
+
+    :param budget_mb: см. prewarm, по умолчанию из api.env.deploy_options
+    """
+    if budget_mb is None:
+        budget_mb = api.env.get('deploy_options', DeployOptions()).prewarm_mb
+    if budget_mb >= 0 and not api.env.get('deploy_plan'):
+        prewarm_folders()
+
+
+def prewarm_folders(host_plan=None):
+    """Папки артефактов, с которыми сервис запустится после деплоя
+
+    Из плана хоста, если он есть, иначе из таблицы тегов целевого коммита (api.env.git_ref): таблица в checkout
+    деплой-хоста может быть от другой ветки.
+    """
+    host_plan = host_plan or fabric_utils.planner.current_plan()
+    if host_plan:
+        return sorted(host_plan.fetch + host_plan.skip)
+
+    if api.env.get('prewarm_folders') is None:
+        git_ref = api.env.get('git_ref', GitRef('master'))
+        api.env.prewarm_folders = fabric_utils.planner.target_folders(git_ref)
+
+    return api.env.prewarm_folders
+
+
+def prewarm(budget_mb=0, folders=None, host_plan=None, staged=False):
+    """Читает файлы артефактов в page cache, чтобы запущенный сервис не ждал диска, см. fabric_utils/prewarm.py
+
+    :param budget_mb: сколько мегабайт прогревать (не больше половины свободной памяти), 0 - половину свободной
+        памяти, < 0 - не прогревать
+    :param folders: папки артефактов относительно DATA_PATH, по умолчанию - см. prewarm_folders
+    :param host_plan: план хоста, по умолчанию из api.env.deploy_plan
+    :param staged: греть подготовленные staged версии (folder.next), если они есть
+    :return: dict со сводкой (files, bytes, seconds, skipped_files, skipped_bytes, missing), None - если прогрева
+        не было
+    """
+    if budget_mb < 0:
+        return None
+
+    if folders is None:
+        folders = prewarm_folders(host_plan)
+
+    with fabric_utils.tracing.phase('prewarm') as span, api.settings(warn_only=True):
+        output = api.sudo(prewarm_cmd(folders, budget_mb, staged=staged))
+        try:
+            report = json.loads(output.splitlines()[-1])
+        except (ValueError, IndexError):
+            return None
+        span.update(report)
+
+    if report.get('missing'):
+        print('Artifact folders to prewarm are missing: %s' % ', '.join(report['missing']))
+    if report.get('memory_unknown'):
+        print('MemAvailable is unknown, prewarm budget is %d MB' % (report['budget'] // 1024 ** 2))
+
+    return report
+
+
+def deploy_service_staged(executable_script='service.py', retention=3, host_plan=None):
+    """Код и артефакты готовятся при работающем сервисе, остановлен он только на время переключения и рестарта"""
+    prestage_service(host_plan)
+    switch_to_prestaged(executable_script, retention=retention)
+
+
+def prestage_service(host_plan=None):
+    """Подтягивает код и распаковывает новые версии артефактов рядом с текущими, сервис не трогается
+
+    :param host_plan: план хоста, по умолчанию из api.env.deploy_plan, см. fabric_utils.planner.current_plan
+    """
+    host_plan = host_plan or fabric_utils.planner.current_plan()
+    pull_service_code(host_plan)
+
+    if host_plan and not host_plan.fetch:
+        return
+    with api.cd(GIT_ROOT):
+        load_artifacts(fabric_utils.planner.load_artifacts_cmd(host_plan, staged=True))
+
+
+def pull_service_code(host_plan=None):
+    host_plan = host_plan or fabric_utils.planner.current_plan()
+    if host_plan and not fabric_utils.planner.needs_code_update(host_plan):
+        return
+
     clone_or_pull_service_repo()
 
     with api.cd(GIT_ROOT):
-        api.sudo('find . -name \*.pyc -delete')
-        api.sudo('fab load_artifacts')
+        delete_pyc()
+
+
+def switch_to_prestaged(executable_script='service.py', retention=3):
+    """Останавливает сервис, переключает артефакты на подготовленные версии и запускает сервис
+
+    Подготовленные версии прогреваются в page cache до остановки, пока сервис еще работает, поэтому при
+    prewarm_mb=0 бюджет прогрева ограничен STAGED_PREWARM_MB.
+    С handover сервис не останавливается: новый экземпляр запускается рядом со старым, см. handover_service_script.
+    Если новый экземпляр не запустился, артефакты возвращаются на прежние версии, и деплой прерывается
+    """
+    options = api.env.get('deploy_options', DeployOptions())
+    prewarm(options.prewarm_mb or STAGED_PREWARM_MB, staged=True)
+    if not options.handover:
+        force_stop_service_process()
+
+    with api.cd(GIT_ROOT), fabric_utils.tracing.phase('activate_artifacts'):
+        api.sudo('fab activate_artifacts:retention=%d' % retention)
+    if options.handover:
+        report = handover_service_script(
+            executable_script, ready_timeout=options.readiness_timeout, drain_timeout=options.drain_timeout,
+        )
+        if report['result'] not in ('handover', 'exited'):
+            # старый экземпляр продолжает работать и должен читать те версии артефактов, с которыми запущен
+            with api.cd(GIT_ROOT), fabric_utils.tracing.phase('rollback_artifacts'):
+                api.sudo('fab rollback_artifacts')
+            api.abort('New instance of %s did not start (%s%s), the old one keeps running with previous artifacts' % (
+                executable_script, report['result'], ', see logs.txt.failed' if report.get('new_pid') else '',
+            ))
+        return
+    with api.cd(GIT_ROOT):
         run_service_script(executable_script)
 
 
-def render_git_info(host_to_git_info_str, host_to_dirty_index_flag, host_to_readiness_flag):
+def render_git_info(host_to_git_info_str, host_to_dirty_index_flag, host_to_readiness_flag, host_to_uptime=None):
     """git + readiness status + deploy time
 
     :param host_to_git_info_str:
     :param host_to_dirty_index_flag:
     :param host_to_readiness_flag:
+    :param host_to_uptime: время работы сервиса в секундах
     :return:
     """
     info = collections.defaultdict(list)
@@ -55,7 +264,9 @@ def render_git_info(host_to_git_info_str, host_to_dirty_index_flag, host_to_read
 
     dirty_postfix = lambda x: '(changes not staged for commit presented)' if host_to_dirty_index_flag[x] else ''
     readiness_status = lambda x: '(NOT READY)' if not host_to_readiness_flag[x] else ''
-    render_line = lambda host: ' '.join([host, dirty_postfix(host), readiness_status(host)])
+    host_to_uptime = host_to_uptime or {}
+    uptime_postfix = lambda x: '(up %s)' % format_duration(host_to_uptime[x]) if host_to_uptime.get(x) else ''
+    render_line = lambda host: ' '.join([host, dirty_postfix(host), readiness_status(host), uptime_postfix(host)])
 
     output = []
 
@@ -78,49 +289,109 @@ def render_git_info(host_to_git_info_str, host_to_dirty_index_flag, host_to_read
     return '\n'.join(output)
 
 
-def clone_or_pull_service_repo(path=GIT_ROOT, git_ref=None):
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+
+    if days:
+        return '%dd%02dh' % (days, hours)
+    if hours:
+        return '%dh%02dm' % (hours, minutes)
+    return '%dm%02ds' % (minutes, seconds)
+
+
+@fabric_utils.tracing.traced('code_sync')
+def clone_or_pull_service_repo(path=GIT_ROOT, git_ref=None, options=None):
+    """Обновляет код на хосте до git_ref способом из options.git_sync:
+
+        full - полный clone / fetch --all с git сервера
+        shallow - clone / fetch только нужной ветки или коммита глубиной options.git_depth
+        bundle - fetch с git сервера делает только деплой-хост, хостам закачивается bundle с недостающими коммитами
+    """
     git_ref = git_ref or api.env.get('git_ref', GitRef('master'))
+    options = options or api.env.get('deploy_options', DeployOptions())
 
     with api.hide('output'):
+        if options.git_sync == fabric_utils.utils.GIT_SYNC_BUNDLE:
+            fabric_utils.code_sync.sync_from_bundle(path, git_ref, depth=options.git_depth)
+            return
+
+        depth = options.git_depth if options.git_sync == fabric_utils.utils.GIT_SYNC_SHALLOW else 0
         with api.settings(warn_only=True):
             path_exists = not api.run('test -d %s' % path).return_code
         if not path_exists:
-            git.clone(path, git_ref)
+            git.clone(path, git_ref, depth=depth)
         else:
-            git.force_pull(path, git_ref)
+            git.force_pull(path, git_ref, depth=depth)
+
+
+def prepare_code_sync():
+    """Общая для всех хостов подготовка обновления кода, вызывается до запуска @parallel тасок"""
+    options = api.env.get('deploy_options', DeployOptions())
+    if options.git_sync == fabric_utils.utils.GIT_SYNC_BUNDLE:
+        fabric_utils.code_sync.prepare(api.env.get('git_ref', GitRef('master')))
+
+
+def collect_host_status(fetch_ttl=STATUS_FETCH_TTL):
+    """Статус текущего хоста за один ssh запрос, см. fabric_utils/status_probe.py
+
+    :param fetch_ttl: git fetch, если последний был раньше fetch_ttl секунд назад, < 0 - без fetch
+    :return: dict с ключами info, index, probe, head, upstream, uptime, artifacts
+    """
+    with api.settings(warn_only=True):
+        output = api.sudo(host_status_cmd(fetch_ttl))
+
+    return parse_host_status(output)
 
 
-def status(*selectors):
-    """Собирает информацию о версии кода на хостах + readiness status"""
-    hosts_to_run = get_hosts_from_shorts(selectors)
+def host_status_cmd(fetch_ttl=STATUS_FETCH_TTL):
+    args = [GIT_ROOT, DATA_PATH, int(fetch_ttl), kill_service_regex, fabric_utils.utils.HEALTH_URL]
+    return fabric_utils.utils.inline_script_cmd(fabric_utils.status_probe, args)
 
+
+def parse_host_status(output):
+    return json.loads(output.splitlines()[-1])
+
+
+def collect_status(selectors, fetch_ttl=STATUS_FETCH_TTL):
+    """host -> dict статуса, см. collect_host_status. Для недоступных хостов - пустой dict"""
+    return collect_hosts_status(get_hosts_from_shorts(selectors), fetch_ttl=fetch_ttl)
+
+
+def collect_hosts_status(hosts_to_run, fetch_ttl=STATUS_FETCH_TTL):
     @task
     @parallel
-    def collect_status():
+    def _collect_status():
         try:
-            status_dict = {
-                'info': git.info(disable_color=True),
-                'index': not git.is_index_empty(),
-                'probe': fabric_utils.utils.readiness_probe()
-            }
-        except NetworkError:
-            status_dict = {'info': '', 'index': '', 'probe': ''}
-
-        return status_dict
+            return collect_host_status(fetch_ttl=fetch_ttl)
+        except (NetworkError, ValueError, IndexError):
+            return {}
 
     with api.hide('everything'):
-        host_to_status_mapping = api.execute(collect_status, hosts=hosts_to_run)
+        return fabric_utils.remote.execute_parallel(_collect_status, hosts_to_run)
+
+
+def status(*selectors, **kwargs):
+    """Собирает информацию о версии кода на хостах + readiness status
+
+    :param fetch_ttl: см. collect_host_status
+    """
+    host_to_status_mapping = collect_status(selectors, fetch_ttl=kwargs.get('fetch_ttl', STATUS_FETCH_TTL))
 
-    host_to_git_info_str, host_to_dirty_index_flag, host_to_readiness_flags = {}, {}, {}
+    host_to_git_info_str, host_to_dirty_index_flag, host_to_readiness_flags, host_to_uptime = {}, {}, {}, {}
     for host, d in host_to_status_mapping.items():
+        d = d or {}
         host_to_git_info_str[host] = d.get('info', '')
         host_to_dirty_index_flag[host] = d.get('index', '')
         host_to_readiness_flags[host] = d.get('probe', '')
+        host_to_uptime[host] = d.get('uptime')
 
     output = render_git_info(
         host_to_git_info_str,
         host_to_dirty_index_flag,
         host_to_readiness_flags,
+        host_to_uptime,
     )
 
     return output
@@ -0,0 +1,115 @@
+# coding: utf-8
+from __future__ import print_function
+
+import socket
+
+from fabric import api
+from fabric.decorators import task, parallel
+
+import fabric_utils.planner
+from artifactory.mirror import DEFAULT_PORT
+from fabric_utils.delivery_tasks import ARTIFACTORY_URL
+from fabric_utils.paths import GIT_ROOT
+
+DEFAULT_FANOUT = 3
+# хранилище, из которого зеркало хоста раздает артефакты детям, в гигабайтах; у листьев дерева его нет
+SEEDER_STORE_SIZE_GB = 50
+
+
+def build_tree(hosts, fanout=DEFAULT_FANOUT):
+    """Дерево раздачи артефактов: первый хост качает из артифактори, остальные - с родителя
+
+    :return: (levels, host_to_parent), levels - списки хостов по глубине, у корня родитель None
+    """
+    host_to_parent, depths, levels = {}, [], []
+    for i, host in enumerate(hosts):
+        parent_index = (i - 1) // fanout if i else None
+        host_to_parent[host] = hosts[parent_index] if parent_index is not None else None
+        depths.append(depths[parent_index] + 1 if parent_index is not None else 0)
+
+        if depths[i] == len(levels):
+            levels.append([])
+        levels[depths[i]].append(host)
+
+    return levels, host_to_parent
+
+
+def mirror_url(host, port=DEFAULT_PORT):
+    return 'http://%s:%d' % (host, port)
+
+
+def mirror_address(host):
+    """Адрес, на котором слушает зеркало хоста: тот, по которому хост доступен с деплой-хоста и соседей"""
+    return socket.gethostbyname(host)
+
+
+def start_mirror(upstream, port=DEFAULT_PORT, wait=30, store_size_gb=SEEDER_STORE_SIZE_GB):
+    """Запускает в фоне зеркало артифактори на текущем хосте и ждет, пока оно начнет отвечать"""
+    address = mirror_address(api.env.host)
+    with api.cd(GIT_ROOT):
+        _cmd = 'nohup fab serve_artifacts:address=%s,upstream=%s,port=%d,store_size_gb=%d &> mirror_logs.txt &' % (
+            address, upstream, port, store_size_gb
+        )
+        api.sudo("bash -c '%s'" % _cmd, pty=False)
+
+    api.run(
+        'for i in $(seq %d); do curl -sf http://%s:%d/api/system/ping && exit 0; sleep 1; done; exit 1' % (
+            wait, address, port
+        )
+    )
+
+
+def stop_mirror():
+    with api.settings(warn_only=True):
+        api.sudo('pkill -f "fab serve_artifacts"')
+
+
+def fan_out(hosts, fanout=DEFAULT_FANOUT, port=DEFAULT_PORT, staged=False):
+    """Загружает артефакты на хосты так, что из артифактори они скачиваются один раз
+
+    Хосты выстраиваются в дерево (см. build_tree) и обрабатываются по уровням, хосты одного уровня - параллельно.
+    Каждый хост качает с зеркала родителя (artifactory.mirror), а если у него есть дети, сам поднимает зеркало,
+    раздающее артефакты из его хранилища. После раздачи все зеркала останавливаются.
+    Если задан план (см. fabric_utils.planner), хосты без устаревших артефактов в дерево не попадают, а остальные
+    качают только устаревшие; чего нет у родителя, его зеркало докачивает со своего upstream.
+
+    :param hosts:
+    :param fanout: сколько детей у каждого хоста в дереве
+    :param port: порт зеркал
+    :param staged: load_artifacts:staged=1, см. fabric_utils.deploy.prestage_service
+    :return:
+    """
+    levels, host_to_parent = build_tree(fabric_utils.planner.hosts_to_fetch(hosts), fanout)
+    seeders = set(parent for parent in host_to_parent.values() if parent)
+
+    @task
+    @parallel
+    def _load():
+        host = api.env.host
+        parent = host_to_parent[host]
+        source = mirror_url(parent, port) if parent else ARTIFACTORY_URL
+
+        # зеркало раздает из хранилища то, что хост уже скачал, а не качает заново
+        cmd = fabric_utils.planner.load_artifacts_cmd(
+            fabric_utils.planner.current_plan(), staged=staged, source=source,
+            store_size_gb=SEEDER_STORE_SIZE_GB if host in seeders else 0,
+        )
+        with api.cd(GIT_ROOT):
+            api.sudo(cmd)
+
+        if host in seeders:
+            start_mirror(upstream=source, port=port)
+
+    @task
+    @parallel
+    def _stop():
+        stop_mirror()
+
+    try:
+        for depth, level in enumerate(levels):
+            print('\n\tfan out level %d: %s' % (depth, ', '.join(level)))
+            api.execute(_load, hosts=level)
+    finally:
+        if seeders:
+            with api.hide('everything'):
+                api.execute(_stop, hosts=sorted(seeders))
@@ -0,0 +1,186 @@
+# coding: utf-8
+"""Перезапуск сервиса без простоя. Выполняется на хосте, см. fabric_utils.deploy.handover_service_script
+
+Только stdlib python 2, аргументы: git_root script log_file service_regex health_port ready_timeout drain_timeout
+
+Сервис, запущенный с SERVICE_REUSE_PORT=1, слушает свой порт с SO_REUSEPORT, поэтому новый экземпляр может
+слушать тот же порт, пока старый еще работает, а ядро раздает соединения им обоим. Свой health check новый
+экземпляр дополнительно отдает на SERVICE_HEALTH_PORT, чтобы его готовность проверялась отдельно от старого.
+Старый экземпляр, запущенный предыдущим handover, может еще занимать health_port, тогда берется health_port + 1.
+
+Контракт сервиса: с SERVICE_HEALTH_PORT он открывает основной порт только тогда, когда готов обрабатывать запросы
+(модели загружены и т.п.), и только после этого отвечает 200 на SERVICE_HEALTH_PORT. Ядро раздает соединения
+всем, кто слушает порт с SO_REUSEPORT, поэтому экземпляр, открывший основной порт раньше готовности, получал бы
+запросы, которые не может обработать.
+
+    1. запускается новый экземпляр (SERVICE_REUSE_PORT=1, SERVICE_HEALTH_PORT=свободный из двух портов)
+    2. ждем, пока этот порт не ответит 200, но не дольше ready_timeout секунд
+    3. старые процессы получают SIGTERM: они перестают принимать соединения (весь трафик уходит новому)
+       и дообрабатывают начатые запросы; кто не завершился за drain_timeout секунд, получает SIGKILL
+
+Перед запуском нового экземпляра лог переименовывается в log_file.1: старые дописывают в него через уже
+открытый файл, а новый пишет в свежий log_file, так что ошибки с рестарта (fabric_utils/log_stats.py видит
+ротацию) - только ошибки нового экземпляра.
+
+Если новый экземпляр не стал готов или завершился до готовности, он убивается, а старые продолжают работать
+(result=not_ready). Только если он завершился в первые EXIT_GRACE секунд, и в его выводе в лог есть
+"Address already in use" (старый запущен без SO_REUSEPORT и порт занят), result=exited: handover тут
+невозможен, и сервис можно перезапустить как обычно. В обоих случаях лог нового экземпляра остается
+в log_file.failed, а лог старых возвращается на место. Печатает json одной строкой.
+"""
+import errno
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib2
+
+POLL_INTERVAL = 0.5
+# завершение нового экземпляра позже этого числа секунд - не занятый порт, а падение при запуске
+EXIT_GRACE = 10
+ADDRESS_IN_USE = ('Address already in use', 'EADDRINUSE')
+ROTATED_SUFFIX = '.1'
+FAILED_SUFFIX = '.failed'
+
+
+def service_pids(service_regex):
+    proc = subprocess.Popen(['pgrep', '-f', service_regex], stdout=subprocess.PIPE)
+    out, _ = proc.communicate()
+    return sorted(int(pid) for pid in out.split() if int(pid) != os.getpid())
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def is_listening(port):
+    sock = socket.socket()
+    try:
+        sock.connect(('localhost', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def is_ready(health_port):
+    try:
+        return urllib2.urlopen('http://localhost:%d/health' % health_port, timeout=2).getcode() == 200
+    except Exception:
+        return False
+
+
+def rotate_log(path):
+    """Переименовывает лог старых экземпляров, возвращает False, если лога нет"""
+    if not os.path.exists(path):
+        return False
+    os.rename(path, path + ROTATED_SUFFIX)
+    return True
+
+
+def restore_log(path):
+    """Лог неудавшегося нового экземпляра - в path.failed, лог старых - обратно на место"""
+    if os.path.exists(path):
+        os.rename(path, path + FAILED_SUFFIX)
+    os.rename(path + ROTATED_SUFFIX, path)
+
+
+def port_in_use(path):
+    """Есть ли в логе ошибка занятого порта"""
+    try:
+        with open(path, 'rb') as f:
+            text = f.read()
+    except IOError:
+        return False
+
+    return any(marker in text for marker in ADDRESS_IN_USE)
+
+
+def start(git_root, script, log_file, health_port):
+    env = dict(os.environ, OMP_NUM_THREADS='1', SERVICE_REUSE_PORT='1', SERVICE_HEALTH_PORT=str(health_port))
+    with open(os.devnull) as stdin, open(os.path.join(git_root, log_file), 'w') as log:
+        return subprocess.Popen(
+            ['python', script], cwd=git_root, env=env, stdin=stdin, stdout=log, stderr=subprocess.STDOUT,
+            close_fds=True, preexec_fn=os.setsid,
+        )
+
+
+def wait_ready(proc, health_port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            return False
+        if is_ready(health_port):
+            return True
+        time.sleep(POLL_INTERVAL)
+
+    return False
+
+
+def drain(pids, timeout):
+    """SIGTERM, через timeout секунд SIGKILL оставшимся. Возвращает (завершившиеся сами, убитые)"""
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    deadline = time.time() + timeout
+    alive = [pid for pid in pids if is_alive(pid)]
+    while alive and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        alive = [pid for pid in alive if is_alive(pid)]
+
+    for pid in alive:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    return [pid for pid in pids if pid not in alive], alive
+
+
+def main(git_root, script, log_file, service_regex, health_port, ready_timeout, drain_timeout):
+    started = time.time()
+    health_port = next((port for port in (int(health_port), int(health_port) + 1) if not is_listening(port)), None)
+    old_pids = service_pids(service_regex)
+    if health_port is None:
+        print(json.dumps({'old_pids': old_pids, 'result': 'no_health_port', 'ready_seconds': None}))
+        return
+    log_path = os.path.join(git_root, log_file)
+    rotated = rotate_log(log_path)
+    proc, launched = start(git_root, script, log_file, health_port), time.time()
+
+    report = {'old_pids': old_pids, 'new_pid': proc.pid, 'health_port': health_port, 'drained': [], 'killed': []}
+    if not wait_ready(proc, health_port, float(ready_timeout)):
+        exited_early = proc.poll() is not None and time.time() - launched < EXIT_GRACE
+        report['exit_code'] = proc.poll()
+        try:
+            # дочерние процессы нового экземпляра могут пережить его самого
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        report['result'] = 'exited' if exited_early and port_in_use(log_path) else 'not_ready'
+        if rotated:
+            restore_log(log_path)
+        report['ready_seconds'] = None
+        print(json.dumps(report))
+        return
+
+    report['ready_seconds'] = time.time() - started
+    report['drained'], report['killed'] = drain(old_pids, float(drain_timeout))
+    report['result'] = 'handover'
+    report['seconds'] = time.time() - started
+    print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
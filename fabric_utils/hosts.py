@@ -1,5 +1,6 @@
 class all_hosts_container(object):
     _ids = '05 06 07 s04 s05 s06 s07 s08 s09 s10'
+    _autoload_ids = '05 06 07'
 
     @classmethod
     def get_host(cls, id_):
@@ -25,3 +26,8 @@ class all_hosts_container(object):
 
         result = sorted(list(set(hosts) - set(exclude_host_list)))
         return result
+
+    @classmethod
+    def get_role(cls, host):
+        autoload_hosts = map(cls.get_host, cls._autoload_ids.split(' '))
+        return 'autoload' if host in autoload_hosts else 'regular'
@@ -0,0 +1,120 @@
+# coding: utf-8
+"""tail -F с фильтрацией на стороне хоста. Выполняется на удаленном хосте, см. fabric_utils.log_stream
+
+Только stdlib python 2, аргументы: log_file offset regex invert levels sample rate
+    offset - с какого байта читать, -1 - с конца файла
+    regex - python regex, пустая строка - без фильтра, invert=1 - оставлять строки, которые не подходят
+    levels - уровни через запятую (ERROR,CRITICAL), пустая строка - все строки
+    sample - оставлять каждую sample-ю подошедшую строку
+    rate - не больше rate строк в секунду, остальные только считаются, 0 - без ограничения
+Печатает строки вида "время<TAB>смещение после строки<TAB>строка", смещение нужно для продолжения после переподключения.
+Если лог пересоздан или обрезан, чтение продолжается с его начала.
+Скрипт завершается, когда закрывается его stdin: без tty ssh не присылает SIGHUP при обрыве, а при редких
+строках запись в закрытый канал может не случиться никогда.
+"""
+import os
+import re
+import sys
+import threading
+import time
+
+POLL_INTERVAL = 0.2
+_level_re = re.compile(r'\b(DEBUG|INFO|WARNING|WARN|ERROR|CRITICAL|FATAL)\b')
+_aliases = {'WARN': 'WARNING', 'FATAL': 'CRITICAL'}
+
+
+def level_of(line):
+    match = _level_re.search(line)
+    return _aliases.get(match.group(1), match.group(1)) if match else None
+
+
+def emit(offset, line):
+    sys.stdout.write('%.3f\t%d\t%s\n' % (time.time(), offset, line))
+
+
+def open_log(log_file, offset):
+    f = open(log_file, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    f.seek(size if offset < 0 or offset > size else offset)
+    return f
+
+
+def follow(log_file, offset):
+    """(смещение после строки, строка) по мере дописывания лога, (смещение, None) - новых строк пока нет"""
+    f, tail = None, ''
+    while True:
+        if f is None:
+            try:
+                f, tail = open_log(log_file, offset), ''
+            except IOError:
+                time.sleep(POLL_INTERVAL)
+                continue
+
+        chunk = f.readline()
+        if chunk:
+            tail += chunk
+            if tail.endswith('\n'):
+                offset = f.tell()
+                yield offset, tail[:-1]
+                tail = ''
+            continue
+
+        yield offset, None
+        sys.stdout.flush()
+        time.sleep(POLL_INTERVAL)
+        try:
+            st = os.stat(log_file)
+        except OSError:
+            continue
+        if st.st_ino != os.fstat(f.fileno()).st_ino or st.st_size < f.tell():
+            f.close()
+            f, offset = None, 0
+
+
+def exit_on_stdin_eof():
+    while os.read(sys.stdin.fileno(), 4096):
+        pass
+    os._exit(0)
+
+
+def main(log_file, offset, regex, invert, levels, sample, rate):
+    watcher = threading.Thread(target=exit_on_stdin_eof)
+    watcher.daemon = True
+    watcher.start()
+
+    pattern = re.compile(regex) if regex else None
+    invert = invert == '1'
+    levels = set(levels.split(',')) if levels else None
+    sample, rate = max(1, int(sample)), int(rate)
+
+    matched, second, emitted, dropped = 0, int(time.time()), 0, 0
+    for offset, line in follow(log_file, int(offset)):
+        now = int(time.time())
+        if now != second:
+            if dropped:
+                emit(offset, '... %d lines dropped by rate limit' % dropped)
+            second, emitted, dropped = now, 0, 0
+        if line is None:
+            continue
+
+        if pattern is not None and bool(pattern.search(line)) == invert:
+            continue
+        if levels is not None and level_of(line) not in levels:
+            continue
+        matched += 1
+        if matched % sample:
+            continue
+
+        if rate and emitted >= rate:
+            dropped += 1
+            continue
+
+        emitted += 1
+        emit(offset, line)
+
+
+if __name__ == '__main__':
+    try:
+        main(*sys.argv[1:])
+    except (KeyboardInterrupt, IOError):
+        pass
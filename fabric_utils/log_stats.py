@@ -0,0 +1,152 @@
+# coding: utf-8
+"""Инкрементальная статистика по логу сервиса. Выполняется на удаленном хосте, см. fabric_utils.tasks.error_stats_task
+
+Только stdlib python 2, аргументы: log_file state_file top_n
+Читает только байты, дописанные в лог после прошлого запуска: смещение и inode лога хранятся в state_file.
+Если лог переоткрыт с нуля (рестарт сервиса через &>, truncate) или заменен новым файлом (ротация),
+чтение начинается сначала, а остаток старого файла дочитывается, если его удается найти рядом под другим именем.
+Печатает json одной строкой.
+"""
+import collections
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+_level_re = re.compile(r'\b(DEBUG|INFO|WARNING|WARN|ERROR|CRITICAL|FATAL)\b')
+_volatile_re = re.compile(r"0x[0-9a-fA-F]+|\b[0-9a-fA-F]{8,}\b|\d+|'[^']*'|\"[^\"]*\"")
+_aliases = {'WARN': 'WARNING', 'FATAL': 'CRITICAL'}
+
+SIGNATURE_LENGTH = 120
+READ_SIZE = 1 << 20
+# начало лога, по которому узнается перезаписанный с нуля файл
+HEAD_SIZE = 64
+
+
+def signature(message):
+    """Сообщение без чисел, хешей и строк в кавычках, чтобы одинаковые ошибки считались вместе"""
+    message = _volatile_re.sub('#', message.decode('utf-8', 'replace'))
+    return ' '.join(message.split())[:SIGNATURE_LENGTH]
+
+
+def scan(f, offset, levels, signatures):
+    """Считает уровни и сигнатуры ошибок с offset до последней полной строки, возвращает новое смещение"""
+    f.seek(offset)
+    tail = ''
+    while True:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            break
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            match = _level_re.search(line)
+            if not match:
+                continue
+            level = _aliases.get(match.group(1), match.group(1))
+            levels[level] += 1
+            if level in ('ERROR', 'CRITICAL'):
+                signatures[signature(line[match.end():])] += 1
+        offset += sum(len(line) + 1 for line in lines)
+
+    return offset
+
+
+def fingerprint(head):
+    return hashlib.md5(head).hexdigest()
+
+
+def find_rotated(log_file, inode):
+    """Файл с прежним inode рядом с логом (logs.txt.1 и т.п.), None если такого нет"""
+    folder = os.path.dirname(os.path.abspath(log_file))
+    prefix = os.path.basename(log_file)
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name != prefix and name.startswith(prefix) and os.stat(path).st_ino == inode:
+            return path
+
+    return None
+
+
+def load_state(state_file):
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def dump_state(state_file, state):
+    tmp_path = '%s.tmp' % state_file
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, state_file)
+
+
+def main(log_file, state_file, top_n):
+    state = load_state(state_file)
+    now = time.time()
+    levels, signatures = collections.Counter(), collections.Counter()
+
+    try:
+        st = os.stat(log_file)
+    except OSError:
+        st = None
+
+    offset, reset, head = state.get('offset', 0), None, ''
+    if st is not None:
+        with open(log_file, 'rb') as f:
+            head = f.read(HEAD_SIZE)
+
+    if st is None:
+        offset, reset = 0, 'missing'
+    elif state and st.st_ino != state.get('inode'):
+        rotated = find_rotated(log_file, state.get('inode'))
+        if rotated:
+            with open(rotated, 'rb') as f:
+                scan(f, offset, levels, signatures)
+        offset, reset = 0, 'rotated'
+    elif st.st_size < offset or fingerprint(head[:state.get('head_size', 0)]) != state.get('head', fingerprint('')):
+        # перезапись через &> сохраняет inode, а лог успевает вырасти больше старого смещения
+        offset, reset = 0, 'truncated'
+
+    # итоги - с начала текущего файла лога, то есть с последнего рестарта сервиса
+    totals = collections.Counter() if reset else collections.Counter(state.get('totals', {}))
+
+    scanned_from = offset
+    if st is not None:
+        current = collections.Counter()
+        with open(log_file, 'rb') as f:
+            offset = scan(f, offset, current, signatures)
+        levels.update(current)
+        totals.update(current)
+
+    interval = now - state['time'] if 'time' in state else None
+    dump_state(state_file, {
+        'inode': st.st_ino if st is not None else None,
+        'offset': offset,
+        'time': now,
+        'head': fingerprint(head),
+        'head_size': len(head),
+        'totals': totals,
+    })
+
+    print(json.dumps({
+        'levels': dict((level, levels[level]) for level in LEVELS),
+        'totals': dict((level, totals[level]) for level in LEVELS),
+        'signatures': signatures.most_common(int(top_n)),
+        'interval': interval,
+        # событий в минуту с прошлого запуска
+        'rates': dict(
+            (level, levels[level] * 60.0 / interval) for level in LEVELS
+        ) if interval else None,
+        'bytes': offset - scanned_from,
+        'reset': reset,
+    }))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,203 @@
+# coding: utf-8
+"""Сбор логов со всех хостов в один поток, см. таску tail
+
+Фильтрация идет на хостах (fabric_utils/log_filter.py), по сети приходят только нужные строки. Каждый хост
+читается своим потоком через ssh, строки всех хостов складываются в общий ограниченный буфер и выводятся
+в порядке времени на хостах. При обрыве соединения хост переподключается и дочитывает лог с того места,
+на котором остановился.
+"""
+from __future__ import print_function
+
+import heapq
+import itertools
+import Queue
+import subprocess
+import sys
+import threading
+import time
+
+import fabric_utils.connections
+import fabric_utils.log_filter
+import fabric_utils.utils
+
+BUFFER_SIZE = 10000
+# сколько секунд строка ждет в буфере строк других хостов с более ранним временем
+REORDER_WINDOW = 0.5
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
+
+
+class LogFilter(object):
+    def __init__(self, regex='', invert=False, levels='', sample=1, rate=0, grep_str=None):
+        """
+        :param regex: python regex, который должен найтись в строке
+        :param invert: оставлять строки, в которых regex не найден
+        :param levels: уровни через запятую, например ERROR,CRITICAL
+        :param sample: оставлять каждую sample-ю строку
+        :param rate: не больше rate строк в секунду с хоста, 0 - без ограничения
+        :param grep_str: аргументы grep, как в таске grep
+        """
+        self.regex = regex
+        self.invert = invert
+        self.levels = levels
+        self.sample = int(sample)
+        self.rate = int(rate)
+        self.grep_str = grep_str
+
+    def command(self, log_file, offset=-1):
+        cmd = fabric_utils.utils.inline_script_cmd(fabric_utils.log_filter, [
+            log_file, offset, self.regex, int(self.invert), self.levels, self.sample, self.rate,
+        ])
+        if self.grep_str:
+            cmd = '%s | grep --line-buffered %s' % (cmd, self.grep_str)
+
+        return cmd
+
+
+class HostReader(threading.Thread):
+    """Читает отфильтрованный лог хоста и кладет (время, хост, строка) в общий буфер, переподключается при обрыве"""
+
+    def __init__(self, pool, host, log_file, log_filter, buffer, stopped):
+        super(HostReader, self).__init__(name=host)
+        self.daemon = True
+        self.pool = pool
+        self.host = host
+        self.log_file = log_file
+        self.log_filter = log_filter
+        self.buffer = buffer
+        self.stopped = stopped
+        self.offset = -1
+        self.dropped = 0
+        self.proc = None
+
+    def put(self, ts, line):
+        # буфер не блокирует чтение: при переполнении строки выбрасываются и считаются, а не копятся в ssh
+        try:
+            self.buffer.put_nowait((ts, self.host, line))
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        delay = RECONNECT_DELAY
+        while not self.stopped.is_set():
+            try:
+                # stdin остается открытым, пока жив ssh: по его закрытию log_filter на хосте завершается
+                self.proc = self.pool.popen(
+                    self.host, self.log_filter.command(self.log_file, self.offset), stdin=subprocess.PIPE,
+                )
+                for raw in iter(self.proc.stdout.readline, ''):
+                    parts = raw.rstrip('\n').split('\t', 2)
+                    if len(parts) < 3:
+                        # stderr скрипта или ssh, а не строка лога
+                        self.put(time.time(), '!!! %s' % raw.rstrip('\n'))
+                        continue
+                    ts, offset, line = parts
+                    self.offset = int(offset)
+                    self.put(float(ts), line)
+                    delay = RECONNECT_DELAY
+                self.proc.wait()
+            except Exception as e:
+                self.put(time.time(), '!!! %s' % e)
+
+            if self.stopped.is_set():
+                break
+            self.put(time.time(), '!!! connection lost, reconnecting in %d seconds' % delay)
+            self.stopped.wait(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+
+class LogStream(object):
+    def __init__(self, hosts, log_file, log_filter=None, pool=None, buffer_size=BUFFER_SIZE,
+                 window=REORDER_WINDOW, output=sys.stdout, output_file=None):
+        """
+        :param hosts:
+        :param log_file: путь к логу на хостах
+        :param log_filter: LogFilter, по умолчанию все строки
+        :param pool: fabric_utils.connections.SshPool, по умолчанию включенный таской multiplex или новый
+        :param buffer_size: сколько строк всех хостов может ждать вывода, лишние выбрасываются
+        :param window: сколько секунд строки ждут строк других хостов для упорядочивания по времени
+        :param output: куда выводить общий поток
+        :param output_file: путь к локальному файлу, в который дополнительно пишется общий поток
+        """
+        self.hosts = hosts
+        self.log_file = log_file
+        self.log_filter = log_filter or LogFilter()
+        self.pool = pool or fabric_utils.connections.get_pool() or fabric_utils.connections.SshPool()
+        self.buffer = Queue.Queue(buffer_size)
+        self.window = window
+        self.output = output
+        self.output_file = output_file
+        self.stopped = threading.Event()
+        self._counter = itertools.count()
+        self.host_width = max(len(self.short(host)) for host in hosts) if hosts else 0
+
+    @staticmethod
+    def short(host):
+        return host.split('.')[0]
+
+    def format(self, ts, host, line):
+        return '%s.%03d %s | %s' % (
+            time.strftime('%H:%M:%S', time.localtime(ts)), int(ts * 1000) % 1000,
+            self.short(host).ljust(self.host_width), line,
+        )
+
+    def run(self):
+        """Выводит общий поток до Ctrl+C"""
+        readers = [
+            HostReader(self.pool, host, self.log_file, self.log_filter, self.buffer, self.stopped)
+            for host in self.hosts
+        ]
+        for reader in readers:
+            reader.start()
+
+        sink = open(self.output_file, 'a') if self.output_file else None
+        pending = []
+        try:
+            while True:
+                try:
+                    ts, host, line = self.buffer.get(timeout=self.window / 2)
+                    self.push(pending, ts, host, line)
+                except Queue.Empty:
+                    pass
+                self.report_dropped(readers, pending)
+                self.flush(pending, sink)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            for reader in readers:
+                reader.stop()
+            for reader in readers:
+                reader.join(1)
+            while pending:
+                self.write(heapq.heappop(pending), sink)
+            if sink:
+                sink.close()
+
+    def push(self, pending, ts, host, line):
+        # (время на хосте, порядковый номер, время получения, хост, строка)
+        heapq.heappush(pending, (ts, next(self._counter), time.time(), host, line))
+
+    def flush(self, pending, sink):
+        """Выводит строки, которые ждали дольше window; часы хостов могут расходиться, поэтому ждем по своим"""
+        deadline = time.time() - self.window
+        while pending and (pending[0][2] <= deadline or len(pending) > self.buffer.maxsize):
+            self.write(heapq.heappop(pending), sink)
+
+    def report_dropped(self, readers, pending):
+        for reader in readers:
+            if reader.dropped:
+                dropped, reader.dropped = reader.dropped, 0
+                self.push(pending, time.time(), reader.host, '!!! %d lines dropped, output is too slow' % dropped)
+
+    def write(self, item, sink):
+        ts, _, _, host, line = item
+        text = self.format(ts, host, line)
+        print(text, file=self.output)
+        if sink:
+            sink.write(text + '\n')
+        self.output.flush()
@@ -0,0 +1,220 @@
+# coding: utf-8
+"""План деплоя: что нужно сделать на каждом хосте, чтобы привести его к целевому состоянию
+
+Целевое состояние - коммит git_ref и артефакты по таблице тегов из этого коммита с метаданными из артифактори.
+Состояние хостов (HEAD и artifactory_info.json всех артефактов) собирается одним параллельным запросом на хост,
+см. fabric_utils/status_probe.py. План хоста - нужно ли обновлять код и какие артефакты качать. Хост, на котором
+сервис не работает, без изменений не считается, даже если код и артефакты у него в целевой версии: его нужно
+хотя бы перезапустить.
+
+План кладется в api.env.deploy_plan, и deploy таски выполняют только его: хосты без изменений не трогаются,
+на остальных качаются только устаревшие артефакты. Хосты, состояние которых получить не удалось, деплоятся
+полностью, как без плана.
+"""
+from __future__ import print_function
+
+import json
+import os
+import pipes
+from collections import namedtuple
+
+import yaml
+from fabric import api
+from requests.auth import HTTPBasicAuth
+
+import artifactory.metadata
+import fabric_utils.code_sync
+import fabric_utils.remote
+from artifactory.transport import Transport
+from fabric_utils.delivery_tasks import collect_tasks
+from fabric_utils.paths import DATA_PATH
+from fabric_utils.utils import GitRef
+
+TAGS_TABLE_FILE = 'artifactory_model_tags.yml'
+
+_HostPlan = namedtuple('HostPlan', ['host', 'reachable', 'head', 'target', 'dirty', 'fetch', 'skip', 'running'])
+
+
+# noinspection PyPep8Naming
+def HostPlan(host, reachable=True, head=None, target=None, dirty=False, fetch=(), skip=(), running=True):
+    """
+    :param host:
+    :param reachable: удалось ли получить состояние хоста
+    :param head: коммит на хосте
+    :param target: целевой коммит
+    :param dirty: на хосте есть незакоммиченные изменения
+    :param fetch: папки артефактов относительно DATA_PATH, которые нужно загрузить
+    :param skip: папки артефактов, которые уже в целевой версии
+    :param running: сервис запущен и проходит readiness probe
+    """
+    return _HostPlan(host, reachable, head, target, dirty, tuple(sorted(fetch)), tuple(sorted(skip)), running)
+
+
+def needs_code_update(host_plan):
+    return host_plan.head != host_plan.target or host_plan.dirty
+
+
+def is_noop(host_plan):
+    return (
+        host_plan.reachable and host_plan.running and not needs_code_update(host_plan) and not host_plan.fetch
+    )
+
+
+def artifact_folder(task):
+    return os.path.relpath(task['destination'].get('folder', DATA_PATH), DATA_PATH)
+
+
+def target_tasks(git_ref, worker_name_mask='worker'):
+    """(целевой коммит, таски загрузки артефактов по таблице тегов из него, а не из checkout деплой-хоста)"""
+    target = fabric_utils.code_sync.resolve_target(git_ref)
+    tags_table = yaml.load(fabric_utils.code_sync.local_git('show', '%s:%s' % (target, TAGS_TABLE_FILE)))
+
+    return target, collect_tasks(worker_name_mask, tags_table=tags_table)
+
+
+def target_folders(git_ref, worker_name_mask='worker'):
+    """Папки артефактов целевого коммита относительно DATA_PATH"""
+    _, tasks = target_tasks(git_ref, worker_name_mask=worker_name_mask)
+    return sorted(set(artifact_folder(task) for task in tasks))
+
+
+def desired_state(git_ref, cred_str=None, worker_name_mask='worker'):
+    """(целевой коммит, папка артефакта -> info из артифактори, None - если его получить не удалось)"""
+    target, tasks = target_tasks(git_ref, worker_name_mask=worker_name_mask)
+
+    auth = HTTPBasicAuth(*cred_str.split(':')) if cred_str else None
+    metadata = artifactory.metadata.MetadataCache(auth, session=Transport())
+    metadata.prefetch(tasks)
+
+    folder_to_info = {}
+    for task in tasks:
+        try:
+            folder_to_info[artifact_folder(task)] = metadata.get(task['info_url'])
+        except Exception as e:
+            print('Can not get %s info, it is fetched on every host: %s' % (task['url'], e))
+            folder_to_info[artifact_folder(task)] = None
+
+    return target, folder_to_info
+
+
+def plan_host(host, status, target, folder_to_info):
+    """План одного хоста по его статусу (см. fabric_utils.deploy.collect_host_status)"""
+    if not status:
+        return HostPlan(host, reachable=False, target=target, fetch=folder_to_info)
+
+    fetch, skip = [], []
+    host_artifacts = status.get('artifacts') or {}
+    for folder, info in folder_to_info.items():
+        last_updated = host_artifacts.get(folder)
+        if info and last_updated and artifactory.metadata.is_not_newer(info, {'lastUpdated': last_updated}):
+            skip.append(folder)
+        else:
+            fetch.append(folder)
+
+    return HostPlan(
+        host, head=status.get('head'), target=target, dirty=bool(status.get('index')), fetch=fetch, skip=skip,
+        running=bool(status.get('probe')) and status.get('uptime') is not None,
+    )
+
+
+def make_plan(hosts, collect_hosts_status, git_ref=None, cred_str=None, worker_name_mask='worker'):
+    """host -> HostPlan
+
+    :param hosts:
+    :param collect_hosts_status: (hosts, fetch_ttl) -> host -> статус, см. fabric_utils.deploy.collect_hosts_status
+    :param git_ref: целевая версия кода, по умолчанию api.env.git_ref или master
+    :param cred_str: credentials для артифактори в формате login:password
+    :param worker_name_mask: см. fabric_utils.delivery_tasks.collect_tasks
+    """
+    git_ref = git_ref or api.env.get('git_ref', GitRef('master'))
+    target, folder_to_info = desired_state(git_ref, cred_str=cred_str, worker_name_mask=worker_name_mask)
+    # fetch на хостах не нужен, HEAD сравнивается с целевым коммитом деплой-хоста
+    host_to_status = collect_hosts_status(hosts, fetch_ttl=-1)
+
+    return dict(
+        (host, plan_host(host, host_to_status.get(host), target, folder_to_info))
+        for host in hosts
+    )
+
+
+def current_plan():
+    """План текущего хоста из api.env.deploy_plan, None - плана нет, деплой как обычно"""
+    plan = api.env.get('deploy_plan')
+    if not plan:
+        return None
+
+    host = fabric_utils.remote.current_host()
+    host_plan = plan.get(host.host if host else api.env.host_string)
+
+    return host_plan if host_plan and host_plan.reachable else None
+
+
+def hosts_to_deploy(hosts):
+    """Хосты, на которых по плану есть что делать. Без плана - все"""
+    plan = api.env.get('deploy_plan')
+    if not plan:
+        return list(hosts)
+
+    return [host for host in hosts if host not in plan or not is_noop(plan[host])]
+
+
+def hosts_to_fetch(hosts):
+    """Хосты, на которые по плану нужно загрузить артефакты. Без плана - все"""
+    plan = api.env.get('deploy_plan')
+    if not plan:
+        return list(hosts)
+
+    return [host for host in hosts if host not in plan or not plan[host].reachable or plan[host].fetch]
+
+
+def load_artifacts_cmd(host_plan=None, staged=False, source=None, store_size_gb=0):
+    """Команда загрузки артефактов на хосте: по плану - только устаревших
+
+    :param source: адрес зеркала артифактори, см. fabric_utils.fanout
+    :param store_size_gb: размер хранилища скачанных артефактов, 0 - без хранилища
+    """
+    args = ['staged=1'] if staged else []
+    if source:
+        args.append('source=%s' % source)
+    if store_size_gb:
+        args.append('store_size_gb=%d' % store_size_gb)
+    if host_plan is not None:
+        args.append('only=%s' % ';'.join(host_plan.fetch))
+
+    return 'fab %s' % pipes.quote('load_artifacts' + (':%s' % ','.join(args) if args else ''))
+
+
+def render_plan(plan):
+    lines = []
+    for host, host_plan in sorted(plan.items()):
+        if not host_plan.reachable:
+            lines.append('%s: state is unknown, full deploy' % host)
+            continue
+        if is_noop(host_plan):
+            lines.append('%s: up to date, %d artifacts' % (host, len(host_plan.skip)))
+            continue
+
+        actions = []
+        if needs_code_update(host_plan):
+            actions.append('code %s -> %s%s' % (
+                (host_plan.head or 'none')[:8], host_plan.target[:8], ' (dirty)' if host_plan.dirty else '',
+            ))
+        if host_plan.fetch:
+            actions.append('fetch %d artifacts, %d up to date' % (len(host_plan.fetch), len(host_plan.skip)))
+        if not host_plan.running:
+            actions.append('restart, service is down')
+        lines.append('%s: %s' % (host, ', '.join(actions)))
+        for folder in host_plan.fetch:
+            lines.append('\t%s' % folder)
+
+    noop = sum(1 for host_plan in plan.values() if is_noop(host_plan))
+    lines.append('%d hosts to deploy, %d up to date' % (len(plan) - noop, noop))
+
+    return '\n'.join(lines)
+
+
+def plan_to_json(plan):
+    return json.dumps(
+        dict((host, dict(host_plan._asdict(), noop=is_noop(host_plan))) for host, host_plan in plan.items()),
+        indent=2, sort_keys=True,
+    )
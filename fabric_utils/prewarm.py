@@ -0,0 +1,124 @@
+# coding: utf-8
+"""Прогрев page cache файлами артефактов перед запуском сервиса. Выполняется на хосте, см. fabric_utils.deploy.prewarm
+
+Только stdlib python 2, аргументы: data_path budget_mb threads staged folder [folder ...]
+folder - папка артефакта относительно data_path; при staged=1, если рядом есть подготовленная версия (folder.next),
+греется она, так как сервис после переключения будет читать именно ее.
+Файлы читаются целиком в несколько потоков (в python 2 нет madvise, а чтение гарантированно кладет страницы
+в page cache), в порядке папок, пока не исчерпан бюджет: budget_mb мегабайт, но не больше половины
+MemAvailable, budget_mb=0 - только половина MemAvailable. Если MemAvailable прочитать не удалось, бюджет -
+budget_mb, а при budget_mb=0 - DEFAULT_BUDGET_MB, в сводке тогда memory_unknown.
+Печатает json одной строкой, папки, которых нет на хосте, перечислены в missing.
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+READ_SIZE = 8 << 20
+DEFAULT_BUDGET_MB = 2048
+# служебные файлы артефактов сервису не нужны
+SKIP_FILES = ('artifactory_info.json', 'artifactory_manifest.json')
+
+
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+
+
+def resolve(data_path, folder, staged):
+    path = os.path.join(data_path, folder)
+    return path + '.next' if staged and os.path.isdir(path + '.next') else path
+
+
+def list_files(path):
+    files = []
+    for dir_path, dir_names, file_names in os.walk(path, followlinks=True):
+        dir_names.sort()
+        for name in sorted(file_names):
+            if name in SKIP_FILES:
+                continue
+            file_path = os.path.join(dir_path, name)
+            if os.path.isfile(file_path):
+                files.append((file_path, os.path.getsize(file_path)))
+
+    return files
+
+
+def warm(path):
+    with open(path, 'rb', 0) as f:
+        while f.read(READ_SIZE):
+            pass
+
+
+def main(data_path, budget_mb, threads, staged, *folders):
+    started = time.time()
+    budget = int(float(budget_mb) * 1024 ** 2)
+    available = available_memory()
+    if available:
+        budget = min(budget, available // 2) if budget else available // 2
+    elif not budget:
+        budget = DEFAULT_BUDGET_MB * 1024 ** 2
+
+    selected, skipped, skipped_bytes, total = [], 0, 0, 0
+    seen, missing = set(), []
+    for folder in folders:
+        folder_path = resolve(data_path, folder, staged == '1')
+        if not os.path.isdir(folder_path):
+            missing.append(folder)
+            continue
+        for path, size in list_files(folder_path):
+            if path in seen:
+                continue
+            seen.add(path)
+            if total + size > budget:
+                skipped += 1
+                skipped_bytes += size
+                continue
+            selected.append((path, size))
+            total += size
+
+    errors, failed_bytes = [], [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not selected:
+                    return
+                path, size = selected.pop(0)
+            try:
+                warm(path)
+            except (IOError, OSError) as e:
+                with lock:
+                    errors.append('%s: %s' % (path, e))
+                    failed_bytes[0] += size
+
+    count = len(selected)
+    workers = [threading.Thread(target=worker) for _ in range(max(1, int(threads)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    print(json.dumps({
+        'files': count - len(errors),
+        'bytes': total - failed_bytes[0],
+        'seconds': time.time() - started,
+        'budget': budget,
+        'memory_unknown': not available,
+        'skipped_files': skipped,
+        'skipped_bytes': skipped_bytes,
+        'errors': errors[:10],
+        'missing': missing,
+    }))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
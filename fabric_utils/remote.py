@@ -0,0 +1,321 @@
+# coding: utf-8
+"""Выполнение команд на многих хостах потоками поверх мультиплексированных ssh соединений, см. fabric_utils.connections
+
+Альтернатива @parallel из fabric: fabric форкает процесс на каждый хост и возвращает результаты через pickle,
+здесь на хост - поток и ssh канал в уже открытом соединении, результаты отдаются по мере готовности.
+
+    fleet = Fleet(hosts, concurrency=64, timeout=60)
+    for host, result in fleet.run('uptime'):
+        ...
+
+Существующие хелперы, написанные на fabric.api (run, sudo, put, get, cd, settings), выполняются через
+Fleet.execute без изменений: на время выполнения fabric.api перенаправляется в соединение хоста текущего потока,
+а cd и settings меняют не общий api.env, а настройки этого потока, hide и show - не общий fabric.state.output,
+а вывод этого потока. api.env.host_string при этом не выставляется.
+"""
+from __future__ import print_function
+
+import contextlib
+import multiprocessing.dummy
+import os
+import threading
+import time
+import uuid
+
+import fabric.api
+import fabric.context_managers
+import fabric.state
+from fabric.exceptions import NetworkError
+
+import fabric_utils.connections
+
+DEFAULT_CONCURRENCY = 64
+
+_local = threading.local()
+_fabric_originals = {}
+
+
+class CommandFailed(Exception):
+    def __init__(self, host, command, result):
+        super(CommandFailed, self).__init__('%s: `%s` failed with code %s: %s' % (
+            host, command, result.return_code, result.stderr.strip(),
+        ))
+        self.result = result
+
+
+class Host(object):
+    """Команды на одном хосте. timeout - на все команды хоста вместе, в секундах"""
+
+    def __init__(self, pool, host, timeout=None):
+        self.pool = pool
+        self.host = host
+        self.deadline = time.time() + timeout if timeout else None
+
+    def remaining(self):
+        return max(0.1, self.deadline - time.time()) if self.deadline else None
+
+    def _check(self, command, result, warn_only):
+        if not warn_only and result.failed:
+            raise CommandFailed(self.host, command, result)
+        return result
+
+    def _connect(self):
+        try:
+            self.pool.connect(self.host)
+        except Exception as e:
+            raise NetworkError('%s: %s' % (self.host, e), e)
+
+    def run(self, command, cwd=None, warn_only=True):
+        self._connect()
+        result = self.pool.run(self.host, command, cwd=cwd, timeout=self.remaining())
+        return self._check(command, result, warn_only)
+
+    def sudo(self, command, user='root', cwd=None, warn_only=True):
+        self._connect()
+        result = self.pool.run(self.host, command, sudo_user=user, cwd=cwd, timeout=self.remaining())
+        return self._check(command, result, warn_only)
+
+    def put(self, local_path, remote_path, use_sudo=False, warn_only=True):
+        self._connect()
+        if not use_sudo:
+            result = self.pool.copy(self.host, local_path, remote_path, timeout=self.remaining())
+            return self._check('put %s' % remote_path, result, warn_only)
+
+        tmp_path = '/tmp/%s' % uuid.uuid4().hex
+        result = self.pool.copy(self.host, local_path, tmp_path, timeout=self.remaining())
+        if result.succeeded:
+            result = self.pool.run(self.host, 'mv %s %s' % (tmp_path, remote_path), sudo_user='root',
+                                   timeout=self.remaining())
+        return self._check('put %s' % remote_path, result, warn_only)
+
+    def get(self, remote_path, local_path, warn_only=True):
+        """local_path может содержать %(host)s, как в fabric"""
+        self._connect()
+        local_path = local_path % {'host': self.host}
+        if not os.path.isdir(os.path.dirname(local_path) or '.'):
+            os.makedirs(os.path.dirname(local_path))
+        result = self.pool.copy(self.host, remote_path, local_path, upload=False, timeout=self.remaining())
+        return self._check('get %s' % remote_path, result, warn_only)
+
+
+class Fleet(object):
+    def __init__(self, hosts, pool=None, concurrency=DEFAULT_CONCURRENCY, timeout=None):
+        """
+        :param hosts:
+        :param pool: fabric_utils.connections.SshPool, по умолчанию включенный таской multiplex или новый
+        :param concurrency: сколько хостов обрабатывается одновременно
+        :param timeout: сколько секунд дается каждому хосту на все его команды
+        """
+        self.hosts = list(hosts)
+        self.pool = pool or fabric_utils.connections.get_pool() or fabric_utils.connections.SshPool()
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def map(self, func, *args, **kwargs):
+        """(host, func(Host, *args, **kwargs)) в порядке готовности, исключение хоста возвращается вместо результата"""
+
+        def _call(host):
+            try:
+                return host, func(Host(self.pool, host, self.timeout), *args, **kwargs)
+            except BaseException as e:
+                return host, e
+
+        workers = multiprocessing.dummy.Pool(max(1, min(self.concurrency, len(self.hosts))))
+        try:
+            for item in workers.imap_unordered(_call, self.hosts):
+                yield item
+        finally:
+            workers.terminate()
+
+    def run(self, command, **kwargs):
+        return self.map(lambda host: host.run(command, **kwargs))
+
+    def sudo(self, command, **kwargs):
+        return self.map(lambda host: host.sudo(command, **kwargs))
+
+    def put(self, local_path, remote_path, **kwargs):
+        return self.map(lambda host: host.put(local_path, remote_path, **kwargs))
+
+    def get(self, remote_path, local_path, **kwargs):
+        return self.map(lambda host: host.get(remote_path, local_path, **kwargs))
+
+    def execute(self, func, *args, **kwargs):
+        """Выполняет функцию, написанную на fabric.api, на всех хостах, (host, результат) в порядке готовности"""
+        install_fabric_adapter()
+
+        def _call(host, *args, **kwargs):
+            _local.host, _local.env, _local.output = host, {}, {}
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _local.host = _local.env = _local.output = None
+
+        return self.map(_call, *args, **kwargs)
+
+
+def current_host():
+    return getattr(_local, 'host', None)
+
+
+def _env_get(key, default=None):
+    env = getattr(_local, 'env', None) or {}
+    return env[key] if key in env else fabric.state.env.get(key, default)
+
+
+def _output_shown(group):
+    output = getattr(_local, 'output', None) or {}
+    return output[group] if group in output else fabric.state.output[group]
+
+
+def _print_output(host, command, result, quiet):
+    if quiet:
+        return
+    if _output_shown('running'):
+        print('[%s] run: %s' % (host.host, command))
+    if _output_shown('stdout'):
+        for line in result.splitlines():
+            print('[%s] out: %s' % (host.host, line))
+
+
+def _run(command, *args, **kwargs):
+    host = current_host()
+    if host is None:
+        return _fabric_originals['run'](command, *args, **kwargs)
+
+    result = host.run(command, cwd=_env_get('cwd'), warn_only=True)
+    _print_output(host, command, result, kwargs.get('quiet'))
+    return host._check(command, result, kwargs.get('warn_only') or _env_get('warn_only'))
+
+
+def _sudo(command, *args, **kwargs):
+    host = current_host()
+    if host is None:
+        return _fabric_originals['sudo'](command, *args, **kwargs)
+
+    user = kwargs.get('user') or _env_get('sudo_user') or 'root'
+    result = host.sudo(command, user=user, cwd=_env_get('cwd'), warn_only=True)
+    _print_output(host, command, result, kwargs.get('quiet'))
+    return host._check(command, result, kwargs.get('warn_only') or _env_get('warn_only'))
+
+
+def _put(local_path=None, remote_path=None, use_sudo=False, *args, **kwargs):
+    host = current_host()
+    if host is None:
+        return _fabric_originals['put'](local_path, remote_path, use_sudo, *args, **kwargs)
+
+    if not remote_path.startswith('/') and _env_get('cwd'):
+        remote_path = '%s/%s' % (_env_get('cwd'), remote_path)
+    host.put(local_path, remote_path, use_sudo=use_sudo, warn_only=_env_get('warn_only'))
+    return [remote_path]
+
+
+def _get(remote_path, local_path=None, *args, **kwargs):
+    host = current_host()
+    if host is None:
+        return _fabric_originals['get'](remote_path, local_path, *args, **kwargs)
+
+    local_path = local_path or '%(host)s/' + os.path.basename(remote_path)
+    host.get(remote_path, local_path, warn_only=_env_get('warn_only'))
+    return [local_path % {'host': host.host}]
+
+
+@contextlib.contextmanager
+def _setenv(variables):
+    if current_host() is None:
+        with _fabric_originals['_setenv'](variables):
+            yield
+        return
+
+    if callable(variables):
+        variables = variables()
+    variables = dict(variables)
+    variables.pop('clean_revert', None)
+    previous = dict(_local.env)
+    _local.env.update(variables)
+    try:
+        yield
+    finally:
+        _local.env = previous
+
+
+def _set_output(groups, which):
+    if current_host() is None:
+        return _fabric_originals['_set_output'](groups, which)
+
+    return _set_local_output(groups, which)
+
+
+def _set_local_output(groups, which):
+    # как fabric.context_managers._set_output, но без изменения общего для всех потоков fabric.state.output;
+    # как и там, это генератор без @contextmanager: hide и show сами оборачивают его результат в contextmanager
+    previous = dict(_local.output)
+    _local.output.update((group, which) for group in fabric.state.output.expand_aliases(groups))
+    try:
+        yield
+    finally:
+        _local.output = previous
+
+
+def _change_cwd(which, path):
+    if current_host() is None:
+        return _fabric_originals['_change_cwd'](which, path)
+
+    path = path.replace(' ', r'\ ')
+    cwd = _env_get(which)
+    if cwd and not path.startswith('/') and not path.startswith('~'):
+        path = cwd + '/' + path
+
+    return _setenv({which: path})
+
+
+def install_fabric_adapter():
+    """Перенаправляет fabric.api в Host текущего потока внутри Fleet.execute, в остальных потоках fabric как был"""
+    if _fabric_originals:
+        return
+
+    for module, name, replacement in [
+        (fabric.api, 'run', _run),
+        (fabric.api, 'sudo', _sudo),
+        (fabric.api, 'put', _put),
+        (fabric.api, 'get', _get),
+        (fabric.context_managers, '_setenv', _setenv),
+        (fabric.context_managers, '_change_cwd', _change_cwd),
+        (fabric.context_managers, '_set_output', _set_output),
+    ]:
+        _fabric_originals[name] = getattr(module, name)
+        setattr(module, name, replacement)
+
+
+def get_backend():
+    """Настройки Fleet (concurrency, timeout), включенные таской ssh_backend, или None"""
+    return fabric.state.env.get('remote_backend')
+
+
+def execute(func, hosts, *args, **kwargs):
+    """Как api.execute, но через Fleet, если он включен таской ssh_backend. host -> результат
+
+    Как и api.execute, прерывает выполнение, если на каком-нибудь хосте произошла ошибка.
+    """
+    backend = get_backend()
+    if backend is None:
+        return fabric.api.execute(func, *args, hosts=hosts, **kwargs)
+
+    return _execute_on_fleet(Fleet(hosts, **backend), func, *args, **kwargs)
+
+
+def execute_parallel(func, hosts, *args, **kwargs):
+    """То же для @parallel тасок: через Fleet и тогда, когда включены только мультиплексированные соединения"""
+    backend = get_backend()
+    if backend is None and fabric_utils.connections.get_pool() is None:
+        return fabric.api.execute(func, *args, hosts=hosts, **kwargs)
+
+    return _execute_on_fleet(Fleet(hosts, **(backend or {})), func, *args, **kwargs)
+
+
+def _execute_on_fleet(fleet, func, *args, **kwargs):
+    results = dict(fleet.execute(func, *args, **kwargs))
+    failed = dict((host, e) for host, e in results.items() if isinstance(e, BaseException))
+    if failed:
+        fabric.api.abort('\n'.join('%s: %s' % (host, failed[host]) for host in sorted(failed)))
+
+    return results
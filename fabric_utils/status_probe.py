@@ -0,0 +1,105 @@
+# coding: utf-8
+"""Скрипт, собирающий статус хоста за один запуск. Выполняется на удаленном хосте, см. fabric_utils.deploy.status
+
+Только stdlib python 2, аргументы: git_root data_path fetch_ttl service_regex health_url
+Печатает json одной строкой.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib2
+
+info_file = 'artifactory_info.json'
+
+
+def sh(cwd, *cmd):
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = proc.communicate()
+    return proc.returncode, out.strip()
+
+
+def fetch(git_root, fetch_ttl):
+    """fetch_ttl < 0 - не делать fetch, иначе fetch, если последний был раньше fetch_ttl секунд назад"""
+    if fetch_ttl < 0:
+        return False
+
+    try:
+        age = time.time() - os.path.getmtime(os.path.join(git_root, '.git', 'FETCH_HEAD'))
+    except OSError:
+        age = None
+
+    if age is None or age > fetch_ttl:
+        sh(git_root, 'git', 'fetch')
+        return True
+
+    return False
+
+
+def git_status(git_root, fetch_ttl):
+    fetched = fetch(git_root, fetch_ttl)
+    _, lines = sh(git_root, 'git', 'branch', '-vv', '--no-color')
+
+    return {
+        'fetched': fetched,
+        'head': sh(git_root, 'git', 'rev-parse', 'HEAD')[1],
+        'upstream': sh(git_root, 'git', 'rev-parse', '--abbrev-ref', '--symbolic-full-name', '@{u}')[1],
+        'info': next((line[len('* '):] for line in lines.split('\n') if line.startswith('* ')), ''),
+        'index': sh(git_root, 'git', 'diff-files', '--quiet')[0] != 0,
+    }
+
+
+def probe(health_url):
+    try:
+        return urllib2.urlopen(health_url, timeout=5).getcode() == 200
+    except Exception:
+        return False
+
+
+def uptime(service_regex):
+    """Время работы самого старого процесса сервиса в секундах, None если сервис не запущен"""
+    code, pids = sh('/', 'pgrep', '-f', service_regex)
+    if code or not pids:
+        return None
+
+    _, times = sh('/', 'ps', '-o', 'etimes=', '-p', ','.join(pids.split()))
+    times = [int(t) for t in times.split() if t.isdigit()]
+
+    return max(times) if times else None
+
+
+def artifacts(data_path):
+    """Версии загруженных артефактов: папка относительно data_path -> lastUpdated"""
+    result = {}
+    for dir_path, dir_names, file_names in os.walk(data_path, followlinks=True):
+        # подготовленные, старые и недокачанные версии staged режима и хранилище артефактов не интересны
+        dir_names[:] = [
+            name for name in dir_names
+            if not (name.startswith('.') or name.endswith(('.versions', '.next', '.prev', '.tmp')))
+        ]
+        if info_file in file_names:
+            try:
+                with open(os.path.join(dir_path, info_file)) as f:
+                    result[os.path.relpath(dir_path, data_path)] = json.load(f).get('lastUpdated')
+            except (IOError, ValueError):
+                pass
+            # артефакт не содержит вложенных артефактов
+            dir_names[:] = []
+
+    return result
+
+
+def main(git_root, data_path, fetch_ttl, service_regex, health_url):
+    status = git_status(git_root, int(fetch_ttl))
+    status.update({
+        'probe': probe(health_url),
+        'uptime': uptime(service_regex),
+        'artifacts': artifacts(data_path),
+    })
+
+    print(json.dumps(status))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,123 @@
+# coding: utf-8
+from __future__ import print_function
+
+import collections
+import math
+
+from fabric import api
+from fabric.decorators import task, parallel
+
+import fabric_utils.deploy
+import fabric_utils.tasks
+import fabric_utils.tracing
+from fabric_utils.hosts import all_hosts_container
+
+waves_str = '~~~~~~~~~~~~~~~~~~~~'
+
+
+def parse_wave_cap(max_wave, hosts_count):
+    """'50%' -> половина хостов, '3' -> 3, 0 или пусто - без ограничения"""
+    max_wave = str(max_wave or 0)
+    if max_wave.endswith('%'):
+        return max(1, int(hosts_count * float(max_wave[:-1]) / 100))
+
+    return int(max_wave) or hosts_count
+
+
+def plan_waves(hosts, canary=1, growth=2.0, max_wave=0, min_healthy=1, host_to_role=None):
+    """Разбивает хосты на волны деплоя: сначала canary хостов, дальше каждая волна в growth раз больше предыдущей
+
+    В каждой волне не больше max_wave хостов (число или процент) и не больше, чем можно вывести из работы,
+    оставив min_healthy работающих хостов каждой роли.
+
+    :param hosts:
+    :param canary: размер первой волны
+    :param growth: во сколько раз растет каждая следующая волна
+    :param max_wave: максимальный размер волны, например 3 или '50%'
+    :param min_healthy: сколько хостов каждой роли всегда должно оставаться в работе
+    :param host_to_role: функция host -> роль, по умолчанию all_hosts_container.get_role
+    :return: список волн
+    """
+    host_to_role = host_to_role or all_hosts_container.get_role
+    role_counts = collections.Counter(host_to_role(host) for host in hosts)
+    # даже если хостов роли мало, по одному хосту выводить из работы приходится
+    role_caps = dict((role, max(1, count - min_healthy)) for role, count in role_counts.items())
+    wave_cap = parse_wave_cap(max_wave, len(hosts))
+
+    waves, remaining, size = [], list(hosts), max(1, int(canary))
+    while remaining:
+        wave, wave_roles = [], collections.Counter()
+        for host in list(remaining):
+            if len(wave) >= min(size, wave_cap):
+                break
+            role = host_to_role(host)
+            if wave_roles[role] >= role_caps[role]:
+                continue
+            wave.append(host)
+            wave_roles[role] += 1
+            remaining.remove(host)
+
+        waves.append(wave)
+        size = int(math.ceil(size * growth))
+
+    return waves
+
+
+def rollout(hosts, deploy, options):
+    """Деплой волнами, см. plan_waves. Хосты одной волны деплоятся параллельно.
+
+    Следующая волна начинается, только если все хосты предыдущей прошли readiness probe за
+    options.readiness_timeout секунд и насчитали не больше options.max_errors ошибок в логах.
+    Иначе деплой прерывается.
+
+    :param hosts:
+    :param deploy: функция без аргументов, деплой на текущий хост
+    :param options: fabric_utils.utils.DeployOptions
+    """
+    waves = plan_waves(
+        hosts,
+        canary=options.canary,
+        growth=options.growth,
+        max_wave=options.max_wave,
+        min_healthy=options.min_healthy,
+    )
+
+    fabric_utils.deploy.prepare_code_sync()
+    fabric_utils.deploy.prepare_prewarm()
+
+    @task
+    @parallel
+    def _deploy_task():
+        deploy()
+
+    for i, wave in enumerate(waves):
+        title = 'canary' if i == 0 and len(waves) > 1 else 'wave %d/%d' % (i + 1, len(waves))
+        print('\n\n\n%s\n\t%s: deploy to %s\n%s' % (waves_str, title, ', '.join(wave), waves_str))
+
+        with api.settings(pool_size=len(wave)), fabric_utils.tracing.phase('rollout.deploy', wave=i + 1):
+            api.execute(_deploy_task, hosts=wave)
+
+        print('\n\t waiting for readiness probing...')
+        gate_wave(wave, options)
+
+
+def gate_wave(wave, options):
+    with fabric_utils.tracing.phase('rollout.readiness', hosts=len(wave)):
+        alive = fabric_utils.tasks.wait_for_readiness_task(wave, timeout=options.readiness_timeout)
+    not_ready = sorted(host for host, flag in alive.items() if flag is not True)
+    if not_ready:
+        api.abort('%s did not become ready in %d seconds, rollout stopped' % (
+            ', '.join(not_ready), options.readiness_timeout
+        ))
+
+    if options.max_errors >= 0:
+        # ошибки с последнего рестарта, лог каждый раз дочитывается с места прошлой проверки
+        host_to_errors = dict(
+            (host, stats.get('totals', {}).get('ERROR', 0))
+            for host, stats in fabric_utils.tasks.error_stats_task(wave).items()
+        )
+        erroneous = sorted(host for host, count in host_to_errors.items() if count > options.max_errors)
+        if erroneous:
+            api.abort('%s logged more than %d errors after restart, rollout stopped' % (
+                ', '.join('%s (%s)' % (host, host_to_errors[host]) for host in erroneous), options.max_errors
+            ))
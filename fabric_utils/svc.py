@@ -2,8 +2,13 @@
 
 from fabric import api
 
+import fabric_utils.tracing
+
 from fabric_utils.paths import GIT_ROOT
 
+# ref, под которым целевой коммит лежит в git bundle, см. fabric_utils.code_sync
+BUNDLE_REF = 'refs/deploy/target'
+
 
 class GitTreeHandler(object):
     repo_url = 'repo_url'
@@ -26,11 +31,21 @@ class GitTreeHandler(object):
         return not result.return_code
 
     @staticmethod
-    def clone(path, git_ref):
-        if git_ref.branch:
+    @fabric_utils.tracing.traced('git.clone')
+    def clone(path, git_ref, depth=0):
+        """depth - shallow clone только нужной ветки или коммита с такой глубиной истории, 0 - полный clone"""
+        if depth and git_ref.commit and not git_ref.branch:
+            with api.hide('output'):
+                api.sudo('git init {path}'.format(path=path))
+                with api.cd(path):
+                    api.sudo('git remote add origin {.repo_url}'.format(GitTreeHandler))
+                    api.sudo('git fetch --depth {depth} origin {.commit}'.format(git_ref, depth=depth))
+                    api.run('git checkout --detach {.commit}'.format(git_ref))
+        elif git_ref.branch:
             with api.hide('output'):
-                api.sudo('git clone -b {git_ref.branch} {repo_url} {path}'.format(
-                    repo_url=GitTreeHandler.repo_url, path=path, git_ref=git_ref
+                api.sudo('git clone {shallow}-b {git_ref.branch} {repo_url} {path}'.format(
+                    repo_url=GitTreeHandler.repo_url, path=path, git_ref=git_ref,
+                    shallow='--depth %d --single-branch ' % depth if depth else '',
                 ))
         elif git_ref.commit:
             with api.hide('output'):
@@ -43,8 +58,12 @@ class GitTreeHandler(object):
             raise RuntimeError
 
     @staticmethod
-    def force_pull(path, git_ref):
-        if git_ref.branch:
+    @fabric_utils.tracing.traced('git.force_pull')
+    def force_pull(path, git_ref, depth=0):
+        """depth - fetch только нужной ветки или коммита с такой глубиной истории, 0 - git fetch --all"""
+        if depth:
+            GitTreeHandler.shallow_pull(path, git_ref, depth)
+        elif git_ref.branch:
             with api.cd(path):
                 api.sudo('git fetch --all')
                 api.sudo('git reset --hard origin/{.branch}'.format(git_ref))
@@ -55,3 +74,57 @@ class GitTreeHandler(object):
                 api.run('git checkout --detach {.commit}'.format(git_ref))
         else:
             raise RuntimeError
+
+    @staticmethod
+    @fabric_utils.tracing.traced('git.shallow_pull')
+    def shallow_pull(path, git_ref, depth):
+        if git_ref.branch:
+            with api.cd(path):
+                api.sudo('git fetch --depth {depth} origin +refs/heads/{0.branch}:refs/remotes/origin/{0.branch}'.format(
+                    git_ref, depth=depth
+                ))
+                api.sudo('git reset --hard origin/{.branch}'.format(git_ref))
+        elif git_ref.commit:
+            with api.cd(path):
+                api.sudo('git fetch --depth {depth} origin {.commit}'.format(git_ref, depth=depth))
+                api.run('git reset --hard HEAD')
+                api.run('git checkout --detach {.commit}'.format(git_ref))
+        else:
+            raise RuntimeError
+
+    @staticmethod
+    def head(path):
+        """Текущий коммит репозитория на хосте, None если его нет"""
+        with api.settings(warn_only=True), api.hide('everything'):
+            result = api.run('git -C {path} rev-parse HEAD'.format(path=path))
+
+        return result.strip() if result.succeeded else None
+
+    @staticmethod
+    def has_commit(path, sha):
+        """Есть ли коммит в репозитории на хосте (в shallow репозитории истории до границы нет)"""
+        with api.settings(warn_only=True), api.hide('everything'):
+            return api.run('git -C {path} cat-file -e {sha}^{{commit}}'.format(path=path, sha=sha)).succeeded
+
+    @staticmethod
+    def is_shallow(path):
+        with api.settings(warn_only=True), api.hide('everything'):
+            return api.run('test -f {path}/.git/shallow'.format(path=path)).succeeded
+
+    @staticmethod
+    @fabric_utils.tracing.traced('git.pull_bundle')
+    def pull_bundle(path, git_ref, bundle_path, commit):
+        """Обновляет репозиторий на хосте до коммита commit из git bundle вместо fetch с сервера
+
+        bundle_path=None - коммит на хосте уже есть
+        """
+        with api.cd(path):
+            if bundle_path:
+                api.sudo('git fetch {bundle} {ref}'.format(bundle=bundle_path, ref=BUNDLE_REF))
+                api.run('rm -f {bundle}'.format(bundle=bundle_path))
+            if git_ref.branch:
+                api.sudo('git update-ref refs/remotes/origin/{0.branch} {commit}'.format(git_ref, commit=commit))
+                api.sudo('git reset --hard origin/{.branch}'.format(git_ref))
+            else:
+                api.run('git reset --hard HEAD')
+                api.run('git checkout --detach {commit}'.format(commit=commit))
@@ -1,9 +1,15 @@
 # coding: utf-8
 from fabric import api
 from fabric.decorators import task, parallel
+from fabric.exceptions import NetworkError
 
+import fabric_utils.deploy
+import fabric_utils.fanout
+import fabric_utils.remote
 import fabric_utils.svc
+import fabric_utils.tracing
 import fabric_utils.utils
+from fabric_utils.context_managers import with_cd_to_git_root
 
 
 @task
@@ -28,6 +34,106 @@ def readiness_probe_task(hosts_to_run):
         return fabric_utils.utils.readiness_probe()
 
     with api.hide('everything'):
-        host_to_flags = api.execute(probe, hosts=hosts_to_run)
+        host_to_flags = fabric_utils.remote.execute_parallel(probe, hosts_to_run)
 
     return host_to_flags
+
+
+def wait_for_readiness_task(hosts_to_run, timeout=fabric_utils.utils.READINESS_TIMEOUT):
+    """Параллельно ждет готовности сервиса на хостах, на каждом хосте - один долгоживущий опрос
+
+    :return: host -> True, если сервис на хосте стал готов за timeout секунд
+    """
+    @task
+    @parallel
+    def wait():
+        try:
+            return fabric_utils.utils.wait_until_ready(timeout=timeout)
+        except NetworkError:
+            return False
+
+    with api.hide('everything'):
+        host_to_flags = fabric_utils.remote.execute_parallel(wait, hosts_to_run)
+
+    return host_to_flags
+
+
+def error_count_task(hosts_to_run):
+    """host -> количество ERROR в логах сервиса"""
+    @task
+    @parallel
+    @with_cd_to_git_root
+    def count():
+        return fabric_utils.utils.count_errors()
+
+    with api.hide('everything'):
+        host_to_counter = fabric_utils.remote.execute_parallel(count, hosts_to_run)
+
+    return host_to_counter
+
+
+def error_stats_task(hosts_to_run, top=5):
+    """host -> статистика по строкам, дописанным в лог сервиса с прошлого вызова, см. fabric_utils/log_stats.py
+
+    Для недоступных хостов - пустой dict
+    """
+    @task
+    @parallel
+    @with_cd_to_git_root
+    def stats():
+        try:
+            return fabric_utils.utils.error_stats(top=top)
+        except (NetworkError, ValueError, IndexError):
+            return {}
+
+    with api.hide('everything'):
+        host_to_stats = fabric_utils.remote.execute_parallel(stats, hosts_to_run)
+
+    return host_to_stats
+
+
+def prewarm_task(hosts_to_run, budget_mb=0, staged=False):
+    """host -> сводка прогрева page cache файлами артефактов, см. fabric_utils.deploy.prewarm
+
+    Для недоступных хостов - None
+    """
+    fabric_utils.deploy.prepare_prewarm(budget_mb)
+
+    @task
+    @parallel
+    def prewarm():
+        try:
+            return fabric_utils.deploy.prewarm(budget_mb, staged=staged)
+        except NetworkError:
+            return None
+
+    with api.hide('everything'):
+        host_to_report = fabric_utils.remote.execute_parallel(prewarm, hosts_to_run)
+
+    return host_to_report
+
+
+def prestage_task(hosts_to_run, fanout=0):
+    """Параллельно на всех хостах готовит код и артефакты для деплоя, см. fabric_utils.deploy.prestage_service
+
+    :param hosts_to_run:
+    :param fanout: если не 0, артефакты раздаются деревом с этим ветвлением, см. fabric_utils.fanout.fan_out
+    """
+
+    @task
+    @parallel
+    def _prestage():
+        fabric_utils.deploy.prestage_service()
+
+    @task
+    @parallel
+    def _pull():
+        fabric_utils.deploy.pull_service_code()
+
+    fabric_utils.deploy.prepare_code_sync()
+    with api.hide('output'), fabric_utils.tracing.phase('prestage', hosts=len(hosts_to_run)):
+        if fanout:
+            api.execute(_pull, hosts=hosts_to_run)
+            fabric_utils.fanout.fan_out(hosts_to_run, fanout=fanout, staged=True)
+        else:
+            api.execute(_prestage, hosts=hosts_to_run)
@@ -0,0 +1,146 @@
+# coding: utf-8
+"""Время фаз деплоя по хостам, см. таску trace
+
+Фазы пишутся построчно в json файл: при @parallel каждый хост выполняется в отдельном процессе, и дописывание
+в один файл - самый простой способ собрать их вместе. В конце запуска fab строится сводная таблица
+(фаза -> сколько раз, суммарное, среднее и максимальное время, самый медленный хост), отчет в json
+и trace для chrome://tracing (или ui.perfetto.dev).
+"""
+from __future__ import print_function
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+from fabric import api
+
+import fabric_utils.remote
+
+SPANS_FILE = 'spans.jsonl'
+REPORT_FILE = 'report.json'
+CHROME_TRACE_FILE = 'trace.json'
+
+
+class Tracer(object):
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # при повторном запуске с той же папкой старые фазы не смешиваются с новыми
+        open(os.path.join(folder, SPANS_FILE), 'w').close()
+
+    def record(self, name, host, start, duration, **args):
+        line = json.dumps({'name': name, 'host': host, 'start': start, 'duration': duration, 'args': args})
+        with self._lock, open(os.path.join(self.folder, SPANS_FILE), 'a') as f:
+            f.write(line + '\n')
+
+    def spans(self):
+        with open(os.path.join(self.folder, SPANS_FILE)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def finish(self):
+        """Пишет отчеты, возвращает сводную таблицу"""
+        spans = self.spans()
+        with open(os.path.join(self.folder, REPORT_FILE), 'w') as f:
+            json.dump({'spans': spans, 'phases': phase_stats(spans)}, f, indent=2)
+        with open(os.path.join(self.folder, CHROME_TRACE_FILE), 'w') as f:
+            json.dump(chrome_trace(spans), f)
+
+        return render_summary(spans)
+
+
+def get_tracer():
+    return api.env.get('tracer')
+
+
+def current_host():
+    host = fabric_utils.remote.current_host()
+    return host.host if host else api.env.get('host_string') or 'local'
+
+
+@contextlib.contextmanager
+def phase(name, **args):
+    """Замеряет время блока на текущем хосте. В yield-нутый dict можно дописать подробности (байты и т.п.)"""
+    tracer = get_tracer()
+    start = time.time()
+    try:
+        yield args
+    finally:
+        if tracer:
+            tracer.record(name, current_host(), start, time.time() - start, **args)
+
+
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def phase_stats(spans):
+    by_phase = collections.OrderedDict()
+    for span in sorted(spans, key=lambda span: span['start']):
+        by_phase.setdefault(span['name'], []).append(span)
+
+    stats = []
+    for name, group in by_phase.items():
+        durations = [span['duration'] for span in group]
+        slowest = max(group, key=lambda span: span['duration'])
+        stats.append({
+            'phase': name,
+            'count': len(group),
+            'total': sum(durations),
+            'mean': sum(durations) / len(durations),
+            'max': slowest['duration'],
+            'slowest_host': slowest['host'],
+            'bytes': sum(span['args'].get('bytes') or 0 for span in group),
+        })
+
+    return stats
+
+
+def render_summary(spans):
+    lines = ['%-28s %5s %9s %9s %9s  %-16s %10s' % ('phase', 'count', 'total, s', 'mean, s', 'max, s', 'slowest', 'MB')]
+    for stat in phase_stats(spans):
+        lines.append('%-28s %5d %9.1f %9.1f %9.1f  %-16s %10.1f' % (
+            stat['phase'], stat['count'], stat['total'], stat['mean'], stat['max'],
+            stat['slowest_host'].split('.')[0], stat['bytes'] / 1024.0 / 1024,
+        ))
+
+    artifacts = [span['args'] for span in spans if 'downloaded' in span['args']]
+    if artifacts:
+        lines.append('artifacts: %d downloaded, %d from local store, %d up to date, %d failed' % tuple(
+            sum(args.get(key) or 0 for args in artifacts) for key in ('downloaded', 'cached', 'skipped', 'failed')
+        ))
+
+    return '\n'.join(lines)
+
+
+def chrome_trace(spans):
+    """Формат Trace Event: процесс - хост, длительности в микросекундах"""
+    host_to_pid = dict((host, pid) for pid, host in enumerate(sorted(set(span['host'] for span in spans)), 1))
+    events = [
+        {'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': host}}
+        for host, pid in host_to_pid.items()
+    ]
+    for span in spans:
+        events.append({
+            'name': span['name'],
+            'cat': 'deploy',
+            'ph': 'X',
+            'ts': int(span['start'] * 1e6),
+            'dur': int(span['duration'] * 1e6),
+            'pid': host_to_pid[span['host']],
+            'tid': 1,
+            'args': span['args'],
+        })
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
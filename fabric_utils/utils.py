@@ -1,8 +1,32 @@
+# coding: utf-8
+import base64
+import inspect
+import json
+import pipes
 from collections import namedtuple
 
 from fabric import api
 
+import fabric_utils.log_stats
+
 _GitRef = namedtuple('GitRef', ['branch', 'commit'])
+_DeployOptions = namedtuple('DeployOptions', [
+    'staged', 'retention', 'fanout', 'readiness_timeout', 'canary', 'growth', 'max_wave', 'min_healthy', 'max_errors',
+    'git_sync', 'git_depth', 'prewarm_mb', 'handover', 'drain_timeout',
+])
+
+HEALTH_URL = 'http://localhost:9888/health'
+READINESS_TIMEOUT = 600
+# сколько секунд старый экземпляр сервиса дообрабатывает запросы после SIGTERM при handover
+DRAIN_TIMEOUT = 60
+# порт, на котором новый экземпляр отдает health check при handover, см. fabric_utils/handover.py
+HANDOVER_HEALTH_PORT = 9889
+LOG_STATS_STATE_FILE = '.logs_stats.json'
+
+GIT_SYNC_FULL = 'full'
+GIT_SYNC_SHALLOW = 'shallow'
+GIT_SYNC_BUNDLE = 'bundle'
+GIT_SYNC_MODES = (GIT_SYNC_FULL, GIT_SYNC_SHALLOW, GIT_SYNC_BUNDLE)
 
 
 # noinspection PyPep8Naming
@@ -10,7 +34,84 @@ def GitRef(branch=None, commit=None):
     return _GitRef(branch, commit)
 
 
+def to_bool(value):
+    """аргументы fab тасок приходят строками"""
+    if isinstance(value, basestring):
+        return value.lower() in ('1', 'true', 'yes', 'y', 'on')
+    return bool(value)
+
+
+# noinspection PyPep8Naming
+def DeployOptions(staged=False, retention=3, fanout=0, readiness_timeout=READINESS_TIMEOUT,
+                  canary=1, growth=2, max_wave=0, min_healthy=1, max_errors=-1, git_sync=GIT_SYNC_FULL, git_depth=1,
+                  prewarm_mb=0, handover=False, drain_timeout=DRAIN_TIMEOUT):
+    if git_sync not in GIT_SYNC_MODES:
+        raise ValueError('git_sync should be one of %s, got %r' % (', '.join(GIT_SYNC_MODES), git_sync))
+    if to_bool(handover) and not to_bool(staged):
+        # без staged артефакты распаковываются на место, пока старый экземпляр еще работает с ними
+        raise ValueError('handover requires staged deploy')
+
+    return _DeployOptions(
+        to_bool(staged), int(retention), int(fanout), int(readiness_timeout),
+        int(canary), float(growth), max_wave, int(min_healthy), int(max_errors),
+        git_sync, int(git_depth), float(prewarm_mb), to_bool(handover), int(drain_timeout),
+    )
+
+
 def readiness_probe():
     with api.settings(warn_only=True):
-        cmd = "import requests; print requests.get('http://localhost:9888/health').status_code == requests.codes.ok"
+        cmd = "import requests; print requests.get('%s').status_code == requests.codes.ok" % HEALTH_URL
         return api.run('python -c "%s"' % cmd) == 'True'
+
+
+def count_errors_cmd(log_file='logs.txt'):
+    return 'grep -c ERROR %s' % log_file
+
+
+def parse_error_count(output):
+    return int(output) if output.strip().isdigit() else 0
+
+
+def count_errors(log_file='logs.txt'):
+    with api.settings(warn_only=True):
+        result = api.run(count_errors_cmd(log_file))
+
+    return parse_error_count(result)
+
+
+def inline_script_cmd(module, args):
+    """Команда, выполняющая на хосте исходник модуля (только stdlib) с аргументами, без копирования файлов"""
+    script = base64.b64encode(inspect.getsource(module))
+    return """python -c 'exec(__import__("base64").b64decode("%s"))' %s""" % (
+        script, ' '.join(pipes.quote(str(arg)) for arg in args)
+    )
+
+
+def error_stats_cmd(log_file='logs.txt', top=5):
+    return inline_script_cmd(fabric_utils.log_stats, [log_file, LOG_STATS_STATE_FILE, int(top)])
+
+
+def parse_error_stats(output):
+    return json.loads(output.splitlines()[-1])
+
+
+def error_stats(log_file='logs.txt', top=5):
+    """Статистика по строкам, дописанным в лог после прошлого вызова, см. fabric_utils/log_stats.py"""
+    with api.settings(warn_only=True):
+        output = api.sudo(error_stats_cmd(log_file, top))
+
+    return parse_error_stats(output)
+
+
+def wait_until_ready_cmd(timeout=READINESS_TIMEOUT, interval=0.5):
+    return "timeout %d bash -c 'until curl -sf -o /dev/null %s; do sleep %s; done'" % (timeout, HEALTH_URL, interval)
+
+
+def wait_until_ready(timeout=READINESS_TIMEOUT, interval=0.5):
+    """Ждет на хосте, пока сервис не начнет отвечать на health check, но не дольше timeout секунд
+
+    Опрос идет curl-ом на самом хосте, так что возврат происходит сразу, как только хост готов.
+    :return: True, если сервис готов
+    """
+    with api.settings(warn_only=True):
+        return api.run(wait_until_ready_cmd(timeout, interval)).return_code == 0
@@ -1,20 +1,174 @@
 # coding=utf-8
+import json
+import os
+import tempfile
+import threading
+import time
 
 
-class LazyProvider(object):
-    """Обертка над функциями, которые обращаются к внешним системам.
+class CachingProvider(object):
+    """Кеширующая обертка над функциями, которые обращаются к внешним системам.
 
-    Предоставляет единообразный интерфейс для отложенного выполнения запроса.
+    Потокобезопасна: при одновременных вызовах из нескольких потоков provider вызывается один раз,
+    остальные потоки ждут его результата.
+
+    ttl - сколько секунд значение считается свежим, None - не устаревает.
+    refresh_ahead - доля ttl: если до устаревания осталось меньше refresh_ahead * ttl, значение обновляется
+        в фоновом потоке, а вызывающие продолжают получать текущее.
+    Ошибка provider кешируется на error_ttl секунд, и все это время provide_content сразу бросает ее же,
+        при каждой следующей ошибке подряд время удваивается, но не больше max_error_ttl.
+    persist_path - файл, в котором значение (должно сериализоваться в json) переживает перезапуск процесса,
+        например между запусками fab. Файл доступен только владельцу.
     """
 
-    def __init__(self, provider):
-        self.called_once = False
+    def __init__(self, provider, ttl=None, refresh_ahead=0.0, error_ttl=5.0, max_error_ttl=300.0,
+                 persist_path=None):
         self.provider = provider
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.error_ttl = error_ttl
+        self.max_error_ttl = max_error_ttl
+        self.persist_path = persist_path
+
         self.value = None
+        self.called_once = False
+        self.counters = dict.fromkeys(('hits', 'misses', 'disk_hits', 'errors', 'error_hits', 'refreshes'), 0)
+
+        self._expires_at = None
+        self._error = None
+        self._error_until = 0
+        self._failures = 0
+        self._loading = False
+        self._refreshing = False
+        self._refresh_after = 0
+        self._condition = threading.Condition()
+
+        if persist_path:
+            self._load_persisted()
 
     def provide_content(self):
-        if not self.called_once:
-            self.value = self.provider()
-            self.called_once = True
+        with self._condition:
+            while True:
+                now = time.time()
+                if self._is_fresh(now):
+                    self.counters['hits'] += 1
+                    self._maybe_refresh(now)
+                    return self.value
+                if self._error is not None and now < self._error_until:
+                    self.counters['error_hits'] += 1
+                    raise self._error
+                if not self._loading:
+                    break
+                self._condition.wait()
+
+            self._loading = True
+            self.counters['misses'] += 1
+
+        try:
+            value = self.provider()
+        except Exception as e:
+            with self._condition:
+                self._loading = False
+                self._fail(e)
+                self._condition.notify_all()
+            raise
+
+        with self._condition:
+            self._loading = False
+            self._set(value)
+            self._condition.notify_all()
+
+        return value
+
+    def invalidate(self):
+        with self._condition:
+            self.called_once = False
+            self.value = self._expires_at = self._error = None
+            self._error_until = self._failures = 0
+        if self.persist_path and os.path.exists(self.persist_path):
+            os.remove(self.persist_path)
+
+    def _is_fresh(self, now):
+        return self.called_once and (self._expires_at is None or now < self._expires_at)
+
+    def _maybe_refresh(self, now):
+        if not (self.ttl and self.refresh_ahead) or self._refreshing or now < self._refresh_after:
+            return
+        if self._expires_at - now > self.refresh_ahead * self.ttl:
+            return
 
-        return self.value
+        self._refreshing = True
+        thread = threading.Thread(target=self._refresh, name='provider-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self):
+        try:
+            value = self.provider()
+        except Exception:
+            # текущее значение остается до своего устаревания, повторная попытка - не раньше, чем через error_ttl
+            with self._condition:
+                self.counters['errors'] += 1
+                self._refresh_after = time.time() + self.error_ttl
+                self._refreshing = False
+            return
+
+        with self._condition:
+            self.counters['refreshes'] += 1
+            self._set(value)
+            self._refreshing = False
+
+    def _set(self, value):
+        self.value = value
+        self.called_once = True
+        self._expires_at = time.time() + self.ttl if self.ttl is not None else None
+        self._error = None
+        self._failures = 0
+        if self.persist_path:
+            self._persist()
+
+    def _fail(self, error):
+        self.counters['errors'] += 1
+        self._failures += 1
+        self._error = error
+        self._error_until = time.time() + min(self.error_ttl * 2 ** (self._failures - 1), self.max_error_ttl)
+
+    def _load_persisted(self):
+        try:
+            with open(self.persist_path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        expires_at = data.get('expires_at')
+        if expires_at is not None and expires_at <= time.time():
+            return
+
+        self.value = data.get('value')
+        self.called_once = True
+        self._expires_at = expires_at
+        self.counters['disk_hits'] += 1
+
+    def _persist(self):
+        tmp_path = None
+        try:
+            # уникальное имя: в одном процессе пишут несколько потоков, mkstemp создает файл с правами 0600
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.persist_path) or '.', prefix=os.path.basename(self.persist_path),
+                suffix='.tmp',
+            )
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'value': self.value, 'expires_at': self._expires_at}, f)
+            os.rename(tmp_path, self.persist_path)
+        except (IOError, OSError, TypeError, ValueError):
+            # без файла кеш продолжает работать в памяти
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class LazyProvider(CachingProvider):
+    """Обертка над функциями, которые обращаются к внешним системам.
+
+    Предоставляет единообразный интерфейс для отложенного выполнения запроса.
+    Значение получается один раз и не устаревает, см. CachingProvider.
+    """